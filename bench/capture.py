@@ -0,0 +1,57 @@
+"""Benchmark capture_exception latency for a 30-frame traceback
+
+Run with ``python bench/capture.py``. Events are discarded instead of sent,
+so only the capture work is measured. Cold runs clear the source cache and
+:mod:`linecache` before every capture, warm runs reuse them.
+
+"""
+import linecache
+import sys
+import time
+
+import zilch.client
+from zilch.utils import source_cache
+
+ITERATIONS = 500
+DEPTH = 30
+
+
+def recurse(depth):
+    if depth <= 1:
+        raise ValueError("Exploded at the bottom of the stack")
+    return recurse(depth - 1)
+
+
+def capture(clear):
+    if clear:
+        source_cache.clear()
+        linecache.clearcache()
+    try:
+        recurse(DEPTH - 1)
+    except ValueError:
+        zilch.client.capture_exception()
+
+
+def run(label, clear):
+    timings = []
+    for i in range(ITERATIONS):
+        start = time.time()
+        capture(clear)
+        timings.append(time.time() - start)
+    timings.sort()
+    print "%-6s median %.3f ms, p90 %.3f ms" % (
+        label, timings[len(timings) / 2] * 1000,
+        timings[int(len(timings) * 0.9)] * 1000)
+
+
+def main():
+    zilch.client.send = lambda **kwargs: None
+    run('cold', clear=True)
+    capture(clear=True)
+    run('warm', clear=False)
+    print "source cache: %d hits, %d misses, %d bytes" % (
+        source_cache.hits, source_cache.misses, source_cache.size)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""Benchmark the wire formats in zilch.codec
+
+Run with ``python bench/codec.py``. Events are captured from a few
+different exceptions and repeated with fresh ids and dates, then every
+format is measured for bytes on the wire and recorder decode time.
+
+"""
+import sys
+import time
+import uuid
+
+import zilch.client
+from zilch import codec
+from zilch.utils import dumps
+
+EVENTS = 10000
+FORMATS = [('LEGACY', codec.LEGACY), ('JSON', codec.JSON),
+           ('JSON_DICT', codec.JSON_DICT), ('MARSHAL', codec.MARSHAL)]
+
+
+class Handler(object):
+    def __init__(self, request):
+        self.request = request
+
+    def dispatch(self, depth):
+        if depth:
+            return self.dispatch(depth - 1)
+        return self.request['params'][depth]
+
+
+samples = []
+
+
+def capture_samples():
+    zilch.client.send = lambda **kwargs: samples.append(kwargs)
+    for i in range(20):
+        request = {'params': {}, 'path': '/item/%d' % i, 'user': i}
+        try:
+            Handler(request).dispatch(i % 5)
+        except KeyError:
+            zilch.client.capture_exception(
+                extra={'path': request['path']})
+
+
+def main():
+    capture_samples()
+    events = []
+    for i in range(EVENTS):
+        event = dict(samples[i % len(samples)])
+        event['event_id'] = uuid.uuid4().hex
+        events.append(event)
+
+    json_size = sum(len(dumps(event)) for event in events)
+    print "%d events, %d bytes of JSON per event" % (EVENTS,
+                                                     json_size / EVENTS)
+    for name, format in FORMATS:
+        start = time.time()
+        payloads = [codec.encode(event, format) for event in events]
+        encode_time = time.time() - start
+        size = sum(len(payload) for payload in payloads)
+        start = time.time()
+        for payload in payloads:
+            codec.decode(payload)
+        decode_time = time.time() - start
+        print "%-10s %6d bytes/event  encode %6.0f ms  decode %6.0f ms" % (
+            name, size / EVENTS, encode_time * 1000, decode_time * 1000)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""Benchmark the event data column types in zilch.store
+
+Run with ``python bench/compression.py``. Event data is captured from a
+few different exceptions raised with different variables, then stored in
+a SQLite table with every column type, measuring the size of the table and
+the time to decode the values. The dictionary is trained on the first
+``TRAIN`` events. With stacks, the stack table rows are counted in the
+size, and decoding assembles the frames from the stack cache.
+
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+import simplejson
+
+import zilch.client
+from zilch import store
+
+EVENTS = 10000
+TRAIN = 1000
+
+
+class Handler(object):
+    def __init__(self, request):
+        self.request = request
+
+    def dispatch(self, depth):
+        if depth:
+            return self.dispatch(depth - 1)
+        return self.request['params'][depth]
+
+
+samples = []
+
+
+def capture_samples():
+    zilch.client.send = lambda **kwargs: samples.append(kwargs)
+    for i in range(EVENTS):
+        request = {'params': {}, 'path': '/item/%d' % i, 'user': i,
+                   'session': uuid.uuid4().hex}
+        try:
+            Handler(request).dispatch(i % 5)
+        except KeyError:
+            zilch.client.capture_exception(
+                extra={'path': request['path']})
+
+
+def table_size(directory, name, values):
+    path = os.path.join(directory, name + '.db')
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE event (id INTEGER PRIMARY KEY, '
+                       'data BLOB)')
+    connection.executemany('INSERT INTO event (data) VALUES (?)',
+                           [(sqlite3.Binary(value),) for value in values])
+    connection.commit()
+    connection.execute('VACUUM')
+    connection.close()
+    return os.path.getsize(path)
+
+
+def main():
+    capture_samples()
+    data = []
+    for i in range(EVENTS):
+        message = samples[i]
+        data.append(store.ExceptionCreator.event_data(message)[1])
+
+    training = [simplejson.dumps(value, separators=(',', ':'))
+                for value in data[:TRAIN]]
+    dictionary = store.Dictionary(1, store.train_dictionary(training))
+    store._dictionaries[1] = dictionary
+    legacy = store.GzippedJSON()
+    compressed = store.CompressedJSON()
+    stacks = {}
+
+    def encode_stack(value, level, dictionary=None):
+        value, hash, stack = store.split_stack(value)
+        stacks[hash] = stack
+        store.caches.stacks.set(hash, stack)
+        return store.encode_json(value, level, dictionary)
+
+    def decode_stack(value, dialect):
+        return store.assemble_stack(compressed.process_result_value(
+            value, dialect))
+
+    types = [
+        ('GzippedJSON', legacy.process_bind_param,
+         legacy.process_result_value),
+        ('level 1', lambda value, dialect: store.encode_json(value, 1),
+         store.CompressedJSON().process_result_value),
+        ('level 6', lambda value, dialect: store.encode_json(value, 6),
+         store.CompressedJSON().process_result_value),
+        ('level 6 + dict', lambda value, dialect: store.encode_json(
+            value, 6, dictionary),
+         store.CompressedJSON().process_result_value),
+        ('stacks', lambda value, dialect: encode_stack(value, 6),
+         decode_stack),
+        ('stacks + dict', lambda value, dialect: encode_stack(
+            value, 6, dictionary), decode_stack),
+    ]
+    print "%d events, %d byte dictionary" % (EVENTS, len(dictionary.data))
+    directory = tempfile.mkdtemp()
+    try:
+        for i, (name, encode, decode) in enumerate(types):
+            start = time.time()
+            stacks.clear()
+            values = [encode(value, None) for value in data]
+            values.extend(store.encode_json(stack, 6)
+                          for stack in stacks.values())
+            encode_time = time.time() - start
+            size = sum(len(value) for value in values)
+            start = time.time()
+            for value in values[:EVENTS]:
+                decode(value, None)
+            decode_time = time.time() - start
+            print ("%-15s %5d bytes/event  table %6d KB  "
+                   "encode %5.0f ms  decode %5.0f ms" % (
+                       name, size / EVENTS,
+                       table_size(directory, str(i), values) / 1024,
+                       encode_time * 1000, decode_time * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Benchmark the recorder decode stage with 1 and N decode threads
+
+Run with ``python bench/decode.py``. Captured events are pushed to a
+Recorder with a store that discards them from another thread, and the time
+to receive, decode and hand every message to the store is measured for
+each decode thread count. Without decode threads messages are decoded on the main thread.
+
+"""
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import zmq
+
+import zilch.client
+from zilch import codec
+from zilch.recorder import Recorder
+
+MESSAGES = 10000
+THREADS = [0, 1, 2, 4]
+
+
+class NullStore(object):
+    def message_received(self, message):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Handler(object):
+    def __init__(self, request):
+        self.request = request
+
+    def dispatch(self, depth):
+        if depth:
+            return self.dispatch(depth - 1)
+        return self.request['params'][depth]
+
+
+samples = []
+
+
+def capture_samples():
+    zilch.client.send = lambda **kwargs: samples.append(kwargs)
+    for i in range(20):
+        request = {'params': {}, 'path': '/item/%d' % i, 'user': i}
+        try:
+            Handler(request).dispatch(i % 5)
+        except KeyError:
+            zilch.client.capture_exception(
+                extra={'path': request['path']})
+
+
+def push(bind, payloads):
+    context = zmq.Context()
+    sock = context.socket(zmq.PUSH)
+    sock.connect(bind)
+    for payload in payloads:
+        sock.send(payload)
+    sock.close(linger=-1)
+    context.term()
+
+
+def run(bind, payloads, threads):
+    recorder = Recorder(zeromq_bind=bind, store=NullStore(),
+                        flush_count=MESSAGES * 2, flush_interval=3600,
+                        decode_threads=threads)
+    sender = threading.Thread(target=push, args=(bind, payloads))
+    start = time.time()
+    sender.start()
+    while recorder.pending < len(payloads):
+        recorder.poller.poll(1000)
+        recorder.drain()
+    elapsed = time.time() - start
+    sender.join()
+    print "%d decode threads: %6.0f messages/s" % (
+        threads, recorder.pending / elapsed)
+    if recorder.pool is not None:
+        recorder.pool.close()
+    recorder.sock.close()
+    recorder._context.term()
+
+
+def main():
+    capture_samples()
+    payloads = []
+    for i in range(MESSAGES):
+        event = dict(samples[i % len(samples)])
+        event['event_id'] = uuid.uuid4().hex
+        payloads.append(codec.encode(event, codec.JSON))
+    print "%d messages, %d bytes per message" % (
+        MESSAGES, sum(len(p) for p in payloads) / MESSAGES)
+    directory = tempfile.mkdtemp()
+    try:
+        for threads in THREADS:
+            run('ipc://%s/recorder-%d' % (directory, threads), payloads,
+                threads)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Benchmark encoding of large events for the wire
+
+Run with ``python bench/encode.py``. Compares ``dumps(...).encode('zlib')``
+with :func:`zilch.utils.dumps_compressed` on an event with many frames and
+large ``vars``. Peak memory is read from ``VmHWM`` after resetting it
+through ``/proc/self/clear_refs``, so it requires Linux.
+
+"""
+import sys
+import time
+
+from zilch.utils import dumps
+from zilch.utils import dumps_compressed
+from zilch.utils import shorten
+
+FRAMES = 30
+VARS = 100
+ITERATIONS = 20
+
+
+def make_event():
+    frames = []
+    for i in range(FRAMES):
+        local_vars = dict(('var_%d' % n, 'value %d ' % n * 40)
+                          for n in range(VARS))
+        frames.append({
+            'id': i,
+            'filename': '/srv/app/lib/python2.7/site-packages/app/module_%d.py' % i,
+            'module': 'app.module_%d' % i,
+            'function': 'handler_%d' % i,
+            'lineno': i * 10,
+            'vars': shorten(local_vars),
+            'context_line': '    return self.dispatch(request)\n',
+            'with_context': '    def call(self, request):\n' * 11,
+            'visible': True,
+        })
+    return {'event_type': 'Exception', 'data': {'frames': frames}}
+
+
+def peak_rss():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmHWM:'):
+            return int(line.split()[1])
+
+
+def reset_peak():
+    open('/proc/self/clear_refs', 'w').write('5')
+
+
+def measure(label, encode, event):
+    encode(event)
+    start = time.time()
+    for i in range(ITERATIONS):
+        encode(event)
+    elapsed = (time.time() - start) / ITERATIONS
+    reset_peak()
+    base = peak_rss()
+    size = len(encode(event))
+    print "%-18s %7.2f ms  peak +%6d KB  %d bytes" % (
+        label, elapsed * 1000, peak_rss() - base, size)
+
+
+def main():
+    event = make_event()
+    print "event JSON size: %d bytes" % len(dumps(event))
+    measure('dumps + zlib', lambda e: dumps(e).encode('zlib'), event)
+    measure('dumps_compressed', dumps_compressed, event)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
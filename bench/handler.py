@@ -0,0 +1,51 @@
+"""Benchmark the cost of logging a record through ZilchHandler
+
+Run with ``python bench/handler.py``. Events are discarded instead of sent.
+The emit time is what the logging call costs the application, the drain time
+is the background thread formatting and capturing the queued records.
+
+"""
+import logging
+import sys
+import time
+
+import zilch.client
+
+RECORDS = 10000
+
+
+def run(label, handler):
+    logger = logging.getLogger('bench.%s' % label)
+    logger.propagate = False
+    logger.addHandler(handler)
+    start = time.time()
+    for i in range(RECORDS):
+        logger.warning("Request %s took %.2f seconds", i, 0.5)
+    emitted = time.time() - start
+    handler.flush()
+    drained = time.time() - start
+    print "%-8s emit %.2f us/record, drained in %.3f s" % (
+        label, emitted / RECORDS * 1000000, drained)
+    logger.removeHandler(handler)
+
+
+class SyncHandler(zilch.client.ZilchHandler):
+    """Formats and sends in the logging call, for comparison"""
+    def emit(self, record):
+        self.send_record(record)
+    
+    def flush(self, timeout=None):
+        return True
+
+
+def main():
+    zilch.client.send = lambda **kwargs: None
+    run('null', logging.NullHandler())
+    run('sync', SyncHandler())
+    handler = zilch.client.ZilchHandler(queue_size=RECORDS)
+    run('queued', handler)
+    print "dropped: %d" % handler.dropped
+
+
+if __name__ == '__main__':
+    sys.exit(main())
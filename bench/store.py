@@ -0,0 +1,85 @@
+"""Benchmark SQLAlchemyStore ingestion, per message ORM path vs bulk
+
+Run with ``python bench/store.py [database_uri ...]``, by default against
+an in-memory and a file SQLite database. Captured events are spread over
+a number of groups and hosts, and flushed every ``FLUSH`` events like the
+recorder does.
+
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import zilch.client
+from zilch.store import Session
+from zilch.store import SQLAlchemyStore
+from zilch.store import Base
+
+EVENTS = 5000
+FLUSH = 500
+GROUPS = 50
+HOSTS = 10
+
+samples = []
+
+
+def capture_samples():
+    zilch.client.send = lambda **kwargs: samples.append(kwargs)
+    for i in range(GROUPS):
+        try:
+            raise KeyError(i)
+        except KeyError:
+            zilch.client.capture_exception()
+    for i, sample in enumerate(samples):
+        sample['hash'] = '%032d' % i
+
+
+def messages():
+    for i in range(EVENTS):
+        message = dict(samples[i % len(samples)])
+        message['event_id'] = uuid.uuid4().hex
+        message['tags'] = [['Hostname', 'web%d' % (i % HOSTS)],
+                           ['Application', 'bench']]
+        yield message
+
+
+def run(uri, bulk):
+    store = SQLAlchemyStore(uri, bulk=bulk)
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    batch = list(messages())
+    start = time.time()
+    for i, message in enumerate(batch):
+        store.message_received(message)
+        if (i + 1) % FLUSH == 0:
+            store.flush()
+    store.flush()
+    elapsed = time.time() - start
+    print "%-40s %-5s %7.0f events/s" % (uri, 'bulk' if bulk else 'orm',
+                                         EVENTS / elapsed)
+    Session.remove()
+
+
+def main():
+    capture_samples()
+    uris = sys.argv[1:]
+    directory = None
+    if not uris:
+        directory = tempfile.mkdtemp()
+        uris = ['sqlite://',
+                'sqlite:///%s' % os.path.join(directory, 'bench.db')]
+    try:
+        for uri in uris:
+            run(uri, bulk=False)
+            run(uri, bulk=True)
+    finally:
+        if directory:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,6 +32,7 @@ setup(name='zilch',
       [console_scripts]
       zilch-recorder = zilch.script:zilch_recorder
       zilch-web = zilch.script:zilch_web
+      zilch-migrate = zilch.script:zilch_migrate
       
       [paste.filter_app_factory]
       middleware = zilch.middleware:make_error_middleware
@@ -33,14 +33,110 @@ current process::
         ('Application', 'My Awesome App')
     )
 
+By default, events are serialized and delivered on the calling thread. To
+hand them off to a background thread instead, enable background delivery::
+
+    zilch.client.background = True
+    zilch.client.queue_size = 1000
+    zilch.client.overflow_policy = zilch.client.DROP_OLDEST
+
+Captured events are then placed on a bounded queue and delivered in batches
+by a worker thread. When the queue is full, the ``overflow_policy``
+determines whether the new event is dropped (``DROP_NEWEST``), the oldest
+queued event is dropped (``DROP_OLDEST``), or the caller waits up to
+``overflow_timeout`` seconds for room (``BLOCK``). Call
+:func:`~zilch.client.flush` before shutting down to deliver queued events.
+
+To avoid shipping every occurrence of an exception that fires in a tight
+loop, captures can be rate limited per exception hash::
+
+    zilch.client.rate_limit = 5        # occurrences per second
+    zilch.client.rate_limit_burst = 20
+
+Occurrences over the limit are only counted, and a summary event carrying
+the suppressed count is sent every ``summary_interval`` seconds so the
+recorded totals stay correct. The remaining counts are sent when the
+process exits, waiting up to ``exit_timeout`` seconds for queued events to
+be delivered.
+
+ZeroMQ sockets are pooled per process and share a single context, a new
+pool is created after a fork. At most ``socket_pool_max`` sockets are open
+at once, threads wait up to ``socket_pool_timeout`` seconds for one to be
+checked back in. The number of idle sockets kept open, and the socket high
+water mark, linger and send buffer options can be configured::
+
+    zilch.client.socket_pool_size = 4
+    zilch.client.socket_pool_max = 16
+    zilch.client.socket_hwm = 1000
+    zilch.client.socket_linger = 1000
+
+Frame locals make up most of a captured exception. Which frames have their
+locals captured, and which variables, is set with a :class:`CapturePolicy`::
+
+    zilch.client.capture_policy = zilch.client.CapturePolicy(
+        frames=zilch.client.CapturePolicy.VISIBLE,
+        exclude=['password', 'secret'])
+
+With background delivery, events queued together can be sent to the
+recorder as a single batched message. The worker waits up to
+``batch_window`` seconds to collect up to ``batch_size`` events, and starts
+a new batch after ``batch_bytes`` of event data::
+
+    zilch.client.batch_messages = True
+    zilch.client.batch_window = 0.05
+
+Batched messages require a recorder that understands them.
+
+When the recorder is unreachable, ZeroMQ holds messages in memory up to the
+socket's high water mark. To hold further messages on disk rather than drop
+them, configure a spool directory::
+
+    zilch.client.spool_directory = '/var/spool/zilch'
+
+Every process then spools messages to a memory-mapped ring file of
+``spool_size`` bytes, which is replayed in order once the recorder accepts
+messages again. Spool files are named ``zilch-0.spool``, ``zilch-1.spool``
+and so on, every process locks the first one no other process holds, so
+messages left in the spool of a process that exited are replayed by the
+next process to use it.
+
+Log messages can be recorded as ``Log`` events by adding a
+:class:`ZilchHandler` to a logger. The handler only queues records, they're
+formatted and sent from a background thread::
+
+    logging.getLogger().addHandler(
+        zilch.client.ZilchHandler(level=logging.WARNING))
+
+Processes that can't use ZeroMQ can post events to a recorder started with
+``--http-bind`` instead. Events are sent as gzipped JSON batches over a
+kept-alive HTTP connection per thread::
+
+    zilch.client.recorder_url = 'http://localhost:8001/events'
+
+Messages are sent in the ``LEGACY`` wire format understood by every
+recorder. Once all recorders have been upgraded, a more compact format from
+:mod:`zilch.codec` can be chosen::
+
+    from zilch import codec
+    zilch.client.wire_format = codec.JSON_DICT
+
 """
+import atexit
 import datetime
+import errno
+import fcntl
+import httplib
 import logging
+import os
+import Queue
 import socket
 import sys
+import threading
+import time
 import traceback
+import urlparse
 import uuid
-from threading import local
+import zlib
 
 try:
     import zmq
@@ -49,58 +145,781 @@ except ImportError:
 
 from weberror.collector import collect_exception
 
+from zilch import codec
 from zilch.exc import ConfigurationError
+from zilch.exc import DeliveryError
+from zilch.spool import Spool
+from zilch.utils import Sanitizer
 from zilch.utils import dumps
+from zilch.utils import log_hash
 from zilch.utils import lookup_versions
 from zilch.utils import shorten
+from zilch.utils import source_cache
+from zilch.utils import to_unicode
 from zilch.utils import transform
 from zilch.utils import update_frame_visibility
 
 
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+
+log = logging.getLogger(__name__)
+
 store = None
 recorder_host = None
-_zeromq_socket = local()
+recorder_url = None
+http_timeout = 10
+_http_sender = None
+_http_sender_lock = threading.Lock()
+wire_format = codec.LEGACY
 capture_tags = []
 
+socket_pool_size = 4
+socket_pool_max = 16
+socket_pool_timeout = 10
+socket_hwm = None
+socket_linger = None
+socket_sndbuf = None
+_socket_pool = None
+_socket_pool_lock = threading.Lock()
+
+background = False
+queue_size = 1000
+overflow_policy = DROP_NEWEST
+overflow_timeout = 0.1
+batch_size = 100
+batch_window = 0
+batch_messages = False
+batch_bytes = 1024 * 1024
+
+spool_directory = None
+spool_size = 64 * 1024 * 1024
+spool_retry_interval = 0.5
+_replayer = None
+_replayer_lock = threading.Lock()
+_spool_fd = None
+_sender = None
+_sender_lock = threading.Lock()
+
+rate_limit = None
+rate_limit_burst = 10
+summary_interval = 60
+exit_timeout = 5
+_limiter = None
+_summary_pid = None
+_summary_lock = threading.Lock()
+
+
+class CapturePolicy(object):
+    """Controls which frame locals are captured with an exception
+
+    :param frames: Which frames to capture locals for, ``ALL`` frames,
+                   only ``VISIBLE`` frames, or the ``INNERMOST`` frames
+    :param innermost: The number of innermost frames to capture locals
+                      for when ``frames`` is ``INNERMOST``
+    :param include: When given, only variables with these names are
+                    captured
+    :param exclude: Names of variables whose values are replaced with
+                    ``mask``, to keep them out of the recorded data
+    :param max_frame_bytes: The approximate size budget for the locals of
+                            a single frame
+
+    """
+    ALL = 'all'
+    VISIBLE = 'visible'
+    INNERMOST = 'innermost'
+    mask = '********'
+
+    def __init__(self, frames=ALL, innermost=5, include=None, exclude=None,
+                 max_frame_bytes=64 * 1024):
+        if frames not in (self.ALL, self.VISIBLE, self.INNERMOST):
+            raise ConfigurationError("Unknown frames policy: %s" % frames)
+        self.frames = frames
+        self.innermost = innermost
+        self.include = include and frozenset(include)
+        self.exclude = frozenset(exclude or ())
+        self.sanitizer = Sanitizer(max_depth=10, max_items=20, max_keys=100,
+                                   max_string=255, max_bytes=max_frame_bytes)
+
+    def wants_locals(self, frame, depth):
+        """Whether to capture the locals of a frame ``depth`` frames
+        away from the innermost frame"""
+        if self.frames == self.VISIBLE:
+            return frame.visible
+        elif self.frames == self.INNERMOST:
+            return depth < self.innermost
+        return True
+
+    def capture_locals(self, local_vars):
+        if self.include is not None:
+            local_vars = dict((name, value)
+                              for name, value in local_vars.iteritems()
+                              if name in self.include)
+        if self.exclude:
+            local_vars = dict((name, self.mask if name in self.exclude else
+                               value) for name, value in local_vars.iteritems())
+        return self.sanitizer.sanitize(local_vars)
+
+
+capture_policy = CapturePolicy()
+
+
+class SocketPool(object):
+    """Pool of ZeroMQ PUSH sockets sharing a single context
+
+    ZeroMQ sockets may only be used by one thread at a time, so a socket
+    is checked out for every send and checked back in afterwards. Up to
+    ``size`` idle sockets are kept open for re-use. At most ``max_size``
+    sockets are open at once, once they're all checked out threads wait
+    for one to be checked in, raising a :class:`~zilch.exc.DeliveryError`
+    after ``timeout`` seconds.
+
+    The pool records the PID of the process that created it, a forked
+    child should create its own pool rather than use the parent's.
+
+    """
+    def __init__(self, host, size=4, hwm=None, linger=None, sndbuf=None,
+                 max_size=16, timeout=None):
+        self.pid = os.getpid()
+        self.host = host
+        self.size = size
+        self.max_size = max(size, max_size)
+        self.timeout = timeout
+        self.options = []
+        if hwm is not None:
+            self.options.append((getattr(zmq, 'SNDHWM', None) or zmq.HWM,
+                                 hwm))
+        if linger is not None:
+            self.options.append((zmq.LINGER, linger))
+        if sndbuf is not None:
+            self.options.append((zmq.SNDBUF, sndbuf))
+        self.context = zmq.Context()
+        self._idle = []
+        self._open = 0
+        self._available = threading.Condition(threading.Lock())
+
+    def checkout(self):
+        available = self._available
+        if self.timeout is not None:
+            end = time.time() + self.timeout
+        available.acquire()
+        try:
+            while not self._idle and self._open >= self.max_size:
+                if self.timeout is None:
+                    available.wait()
+                    continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise DeliveryError("No ZeroMQ socket checked in "
+                                        "within %s seconds" % self.timeout)
+                available.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+        finally:
+            available.release()
+        try:
+            zero_socket = self.context.socket(zmq.PUSH)
+            for option, value in self.options:
+                zero_socket.setsockopt(option, value)
+            zero_socket.connect(self.host)
+        except:
+            self._closed()
+            raise
+        return zero_socket
+
+    def checkin(self, zero_socket):
+        self._available.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(zero_socket)
+                self._available.notify()
+                return
+        finally:
+            self._available.release()
+        zero_socket.close()
+        self._closed()
+
+    def _closed(self):
+        self._available.acquire()
+        try:
+            self._open -= 1
+            self._available.notify()
+        finally:
+            self._available.release()
+
+
+def get_pool():
+    """ZeroMQ Socket Pool
+
+    Creates the :class:`SocketPool` for the current process on first
+    use, and again after a fork.
+
+    """
+    global _socket_pool
+    pool = _socket_pool
+    if pool is None or pool.pid != os.getpid():
+        _socket_pool_lock.acquire()
+        try:
+            pool = _socket_pool
+            if pool is None or pool.pid != os.getpid():
+                # Sockets inherited across a fork are abandoned, not closed
+                pool = _socket_pool = SocketPool(
+                    recorder_host, size=socket_pool_size, hwm=socket_hwm,
+                    linger=socket_linger, sndbuf=socket_sndbuf,
+                    max_size=socket_pool_max, timeout=socket_pool_timeout)
+        finally:
+            _socket_pool_lock.release()
+    return pool
+
 
 def get_socket():
     """ZeroMQ Socket
 
-    Caches the ZeroMQ socket on the module.
+    Checks out a socket from the process's :class:`SocketPool`, it should
+    be returned with :func:`release_socket` when done.
 
     """
     if not recorder_host:
         raise ConfigurationError("Recorder host string not configured.")
-    
-    if not hasattr(_zeromq_socket, 'sock'):
-        context = zmq.Context()
-        zero_socket = context.socket(zmq.PUSH)
-        zero_socket.connect(recorder_host)
-        _zeromq_socket.sock = zero_socket
-    return _zeromq_socket.sock
+    return get_pool().checkout()
 
 
-def send(**kwargs):
-    """Send a message to the recorder
-    
-    If there is no recorder_host and ``zilch.client.store`` is not
-    None, then it is assumed to be a valid Storage backend and will
-    immediately recieve the message and be flushed.
+def release_socket(zero_socket):
+    """Return a socket from :func:`get_socket` to the pool"""
+    get_pool().checkin(zero_socket)
+
+
+def wait_for_queue(queue, timeout=None):
+    """Wait until every item put on ``queue`` has been marked done
+
+    Returns False if items were still unfinished after ``timeout``
+    seconds.
+
+    """
+    done = queue.all_tasks_done
+    if timeout is not None:
+        end = time.time() + timeout
+    done.acquire()
+    try:
+        while queue.unfinished_tasks:
+            if timeout is None:
+                done.wait()
+                continue
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            done.wait(remaining)
+        return True
+    finally:
+        done.release()
+
+
+class BackgroundSender(object):
+    """Bounded message queue drained by a daemon worker thread
+
+    Messages are handed to ``deliver`` in lists of up to ``batch_size``
+    messages, waiting up to ``window`` seconds after the first message
+    for more to arrive. When the queue is full, ``overflow`` decides which message
+    is dropped, every dropped message is counted in ``dropped``.
+
+    """
+    def __init__(self, deliver, maxsize=1000, overflow=DROP_NEWEST,
+                 timeout=0.1, batch_size=100, window=0):
+        if overflow not in (DROP_NEWEST, DROP_OLDEST, BLOCK):
+            raise ConfigurationError("Unknown overflow policy: %s" % overflow)
+        self.deliver = deliver
+        self.overflow = overflow
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.window = window
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(maxsize)
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='zilch-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, message):
+        """Queue a message for delivery
+
+        Returns False if the message was dropped.
+
+        """
+        try:
+            if self.overflow == BLOCK:
+                self.queue.put(message, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(message)
+            return True
+        except Queue.Full:
+            pass
+
+        if self.overflow == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            except Queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(message)
+                return True
+            except Queue.Full:
+                pass
+        self.dropped += 1
+        return False
+
+    def flush(self, timeout=None):
+        """Wait for all queued messages to be delivered
+
+        Returns False if the queue was not drained within ``timeout``
+        seconds.
+
+        """
+        return wait_for_queue(self.queue, timeout)
+
+    def _run(self):
+        while 1:
+            batch = [self.queue.get()]
+            end = time.time() + self.window
+            while len(batch) < self.batch_size:
+                try:
+                    remaining = end - time.time()
+                    if remaining > 0:
+                        batch.append(self.queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.deliver(batch)
+                self.delivered += len(batch)
+            except (Exception, ConfigurationError, DeliveryError):
+                self.failed += len(batch)
+                log.exception("Unable to deliver %s zilch messages",
+                              len(batch))
+            finally:
+                for message in batch:
+                    self.queue.task_done()
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter keyed by event hash
+
+    Every key gets a bucket holding up to ``burst`` tokens which refills
+    at ``rate`` tokens per second. Occurrences that find the bucket empty
+    are not allowed and only counted, :meth:`summaries` returns and resets
+    these counts at most once per ``interval`` seconds.
+
+    """
+    def __init__(self, rate, burst=10, interval=60):
+        self.rate = rate
+        self.burst = burst
+        self.interval = interval
+        self.suppressed = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_summary = time.time()
+
+    def allow(self, key, now=None):
+        """Take a token for ``key``, returns False if the bucket is empty"""
+        now = now or time.time()
+        self._lock.acquire()
+        try:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                # [tokens, last refill, suppressed count]
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            tokens = min(self.burst,
+                         bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return True
+            bucket[0] = tokens
+            bucket[2] += 1
+            self.suppressed += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def summaries(self, now=None, force=False):
+        """Return a list of ``(key, suppressed count)`` tuples
+
+        Counts are reset once returned. Unless ``force`` is set, an empty
+        list is returned if the last summary was less than ``interval``
+        seconds ago. Idle buckets are forgotten to keep memory bounded.
+
+        """
+        now = now or time.time()
+        self._lock.acquire()
+        try:
+            if not force and now - self._last_summary < self.interval:
+                return []
+            self._last_summary = now
+            counts = []
+            for key, bucket in self._buckets.items():
+                if bucket[2]:
+                    counts.append((key, bucket[2]))
+                    bucket[2] = 0
+                elif bucket[0] + (now - bucket[1]) * self.rate >= self.burst:
+                    del self._buckets[key]
+            return counts
+        finally:
+            self._lock.release()
+
+
+def get_limiter():
+    """Rate Limiter
+
+    Creates the module wide :class:`RateLimiter` on first use. A daemon
+    thread sends its summaries every ``summary_interval`` seconds, started
+    again after a fork, and the last ones are sent at exit.
+
+    """
+    global _limiter, _summary_pid
+    if _limiter is None:
+        _limiter = RateLimiter(rate_limit, burst=rate_limit_burst,
+                               interval=summary_interval)
+        atexit.register(_send_summaries_at_exit)
+    if _summary_pid != os.getpid():
+        _summary_lock.acquire()
+        try:
+            if _summary_pid != os.getpid():
+                thread = threading.Thread(target=_send_summaries_periodically,
+                                          name='zilch-summaries')
+                thread.daemon = True
+                thread.start()
+                _summary_pid = os.getpid()
+        finally:
+            _summary_lock.release()
+    return _limiter
+
+
+def _send_summaries_periodically():
+    while 1:
+        time.sleep(summary_interval)
+        try:
+            send_summaries()
+        except (Exception, ConfigurationError, DeliveryError):
+            log.exception("Unable to send zilch summaries")
+
+
+def _send_summaries_at_exit():
+    try:
+        flush(timeout=exit_timeout)
+    except (Exception, ConfigurationError, DeliveryError):
+        log.exception("Unable to send zilch summaries")
+
+
+def send_summaries(force=False):
+    """Send summary events for occurrences suppressed by the rate limit"""
+    if _limiter is None:
+        return
+    for (event_type, hash), count in _limiter.summaries(force=force):
+        send(event_type=event_type, hash=hash, suppressed=count,
+             summary=True, date=transform(datetime.datetime.utcnow()))
+
+
+class SpoolReplayer(object):
+    """Spools messages the recorder can't accept, and replays them
+
+    Once a message has been spooled, following messages are spooled as
+    well so that the recorder receives them in order. A daemon thread
+    replays the spool every ``interval`` seconds until it's empty. The
+    counts of spooled, replayed and dropped messages are kept on the
+    :class:`~zilch.spool.Spool`.
+
+    """
+    def __init__(self, spool, interval=0.5):
+        self.pid = os.getpid()
+        self.spool = spool
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._replay_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name='zilch-spool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, zero_socket, payload):
+        if not len(self.spool):
+            try:
+                zero_socket.send(payload, flags=zmq.NOBLOCK)
+                return
+            except zmq.ZMQError, e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+        self.spool.append(payload)
+        self._wakeup.set()
+
+    def replay(self):
+        """Send spooled messages until the spool is empty or the recorder
+        stops accepting them"""
+        self._replay_lock.acquire()
+        sock = None
+        try:
+            sock = get_socket()
+            while 1:
+                payload = self.spool.peek()
+                if payload is None:
+                    return
+                try:
+                    sock.send(payload, flags=zmq.NOBLOCK)
+                except zmq.ZMQError, e:
+                    if e.errno != zmq.EAGAIN:
+                        log.exception("Unable to replay spooled message")
+                    return
+                self.spool.pop()
+        finally:
+            if sock is not None:
+                release_socket(sock)
+            self._replay_lock.release()
+
+    def _run(self):
+        while 1:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not len(self.spool):
+                continue
+            try:
+                self.replay()
+            except (Exception, ConfigurationError):
+                log.exception("Unable to replay spooled messages")
+
+
+def lock_spool(directory):
+    """Lock the first spool file in ``directory`` no other process holds
+
+    Returns the path of the spool file and the file descriptor holding the
+    lock, which is released when the process exits.
+
+    """
+    index = 0
+    while 1:
+        path = os.path.join(directory, 'zilch-%d.spool' % index)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            index += 1
+            continue
+        return path, fd
+
+
+def get_replayer():
+    """Spool Replayer
+
+    Creates the :class:`SpoolReplayer` for the current process on first
+    use, and again after a fork, with the spool file it locks with
+    :func:`lock_spool`. Messages left in the spool file by a process that
+    has exited are replayed.
+
+    """
+    global _replayer, _spool_fd
+    if _replayer is None or _replayer.pid != os.getpid():
+        _replayer_lock.acquire()
+        try:
+            if _replayer is None or _replayer.pid != os.getpid():
+                if _spool_fd is not None:
+                    # The parent process keeps its spool file locked
+                    os.close(_spool_fd)
+                path, _spool_fd = lock_spool(spool_directory)
+                _replayer = SpoolReplayer(Spool(path, size=spool_size),
+                                          interval=spool_retry_interval)
+        finally:
+            _replayer_lock.release()
+    return _replayer
+
+
+class HTTPSender(object):
+    """Posts events to a recorder's HTTP endpoint
+
+    Every thread keeps its own connection alive across posts, and
+    reconnects once when a kept-alive connection turns out to be closed.
+    Events are posted as a gzipped JSON list, a response other than 2xx
+    closes the connection and raises a :class:`~zilch.exc.DeliveryError`.
+
+    """
+    def __init__(self, url, timeout=10):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = parsed.netloc
+        self.path = parsed.path or '/'
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._local = threading.local()
+
+    def get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connection_class(self.netloc,
+                                               timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def send(self, messages):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(dumps(messages)) + compressor.flush()
+        headers = {'Content-Type': 'application/json',
+                   'Content-Encoding': 'gzip'}
+        for attempt in (1, 2):
+            connection = self.get_connection()
+            try:
+                connection.request('POST', self.path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed a kept-alive connection
+                self.close()
+                if attempt == 2:
+                    raise
+        if response.status // 100 != 2:
+            # The recorder may not have read the body, don't reuse the
+            # connection
+            self.close()
+            raise DeliveryError("Recorder responded %d: %s" % (
+                response.status, content))
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+
+
+def get_http_sender():
+    """HTTP Sender
+
+    Creates the :class:`HTTPSender` for ``recorder_url`` on first use, and
+    again after a fork so processes don't share connections.
+
+    """
+    global _http_sender
+    if _http_sender is None or _http_sender.pid != os.getpid():
+        _http_sender_lock.acquire()
+        try:
+            if _http_sender is None or _http_sender.pid != os.getpid():
+                _http_sender = HTTPSender(recorder_url, timeout=http_timeout)
+        finally:
+            _http_sender_lock.release()
+    return _http_sender
+
+
+def get_sender():
+    """Background Sender
+
+    Creates the :class:`BackgroundSender` for the current process on
+    first use, and again after a fork as the worker thread doesn't survive
+    it.
+
+    """
+    global _sender
+    if _sender is None or _sender.pid != os.getpid():
+        _sender_lock.acquire()
+        try:
+            if _sender is None or _sender.pid != os.getpid():
+                _sender = BackgroundSender(
+                    deliver, maxsize=queue_size, overflow=overflow_policy,
+                    timeout=overflow_timeout, batch_size=batch_size,
+                    window=batch_window)
+        finally:
+            _sender_lock.release()
+    return _sender
+
+
+def flush(timeout=None):
+    """Wait for events queued for background delivery to be sent
+
+    Counts of occurrences suppressed by the rate limit are sent first.
+    Returns False if events were still queued after ``timeout`` seconds.
+
+    """
+    send_summaries(force=True)
+    if _sender is None:
+        return True
+    return _sender.flush(timeout)
+
+
+def deliver(messages):
+    """Deliver a list of messages to the recorder or store
+
+    When ``batch_messages`` is enabled, the list is sent to the recorder
+    as batched messages. Over HTTP, the list is always posted as one
+    batch. When delivering to a ``Store``, it is flushed once for the
+    entire list of messages.
 
     """
     if recorder_host:
-        data = dumps(kwargs).encode('zlib')
-        get_socket().send(data, flags=zmq.NOBLOCK)
+        if batch_messages and len(messages) > 1:
+            payloads = codec.encode_batches(messages, wire_format,
+                                            max_bytes=batch_bytes)
+        else:
+            payloads = [codec.encode(message, wire_format)
+                        for message in messages]
+        sock = get_socket()
+        try:
+            if spool_directory:
+                replayer = get_replayer()
+                for payload in payloads:
+                    replayer.send(sock, payload)
+            else:
+                for payload in payloads:
+                    sock.send(payload, flags=zmq.NOBLOCK)
+        finally:
+            release_socket(sock)
+    elif recorder_url:
+        get_http_sender().send(messages)
     elif store:
-        store.message_received(kwargs)
+        for message in messages:
+            store.message_received(message)
         store.flush()
     else:
         raise ConfigurationError("No Record host or Store configured.")
 
 
+def send(**kwargs):
+    """Send a message to the recorder
+    
+    If there is no recorder_host but a ``recorder_url``, the message is
+    posted to the recorder over HTTP. Otherwise, if ``zilch.client.store``
+    is not None, then it is assumed to be a valid Storage backend and will
+    immediately recieve the message and be flushed.
+
+    When ``zilch.client.background`` is enabled, the message is queued
+    and delivered by a background thread instead.
+
+    """
+    if not recorder_host and not recorder_url and not store:
+        raise ConfigurationError("No Record host or Store configured.")
+    if background:
+        get_sender().put(kwargs)
+    else:
+        deliver([kwargs])
+
+
 def capture_exception(event_type="Exception", exc_info=None, 
                       level=logging.ERROR, tags=None, extra=None):
-    """Capture the current exception"""
+    """Capture the current exception
+    
+    Returns None if the exception was suppressed by the rate limit.
+    
+    """
     exc_info = exc_info or sys.exc_info()
     
     # Ensure that no matter what happens, we always del the exc_info
@@ -108,24 +927,35 @@ def capture_exception(event_type="Exception", exc_info=None,
         collected = collect_exception(*exc_info)
 
         # Check to see if this hash has been reported past the threshold
-        # TODO: Use this in the future
-        # cur_sec = int(time.time())
-        # capture_key = '%s %s' % (hash, cur_sec)
+        if rate_limit:
+            allowed = get_limiter().allow(
+                (event_type, collected.identification_code))
+            send_summaries()
+            if not allowed:
+                return None
     
         frames = []
+        mtimes = {}
         update_frame_visibility(collected.frames)
-        for frame in collected.frames:
+        frame_count = len(collected.frames)
+        for index, frame in enumerate(collected.frames):
             fdata = {
                 'id': frame.tbid,
                 'filename': frame.filename,
                 'module': frame.modname or '?',
                 'function': frame.name or '?',
                 'lineno': frame.lineno,
-                'vars': frame.locals,
-                'context_line': frame.get_source_line(),
-                'with_context': frame.get_source_line(context=5),
+                'vars': {},
+                'context_line': source_cache.get_source_line(
+                    frame, mtimes=mtimes),
+                'with_context': source_cache.get_source_line(
+                    frame, context=5, mtimes=mtimes),
                 'visible': frame.visible,
             }
+            if capture_policy.wants_locals(frame, frame_count - index - 1):
+                fdata['vars'] = capture_policy.capture_locals(frame.locals)
+            else:
+                fdata['vars_omitted'] = True
             frames.append(fdata)
     
         data = {
@@ -183,3 +1013,98 @@ def capture(event_type, tags=None, data=None, date=None, time_spent=None,
     send(event_type=event_type, tags=tags, data=data, date=date,
          time_spent=time_spent, event_id=event_id, extra=extra, **kwargs)
     return event_id
+
+
+class ZilchHandler(logging.Handler):
+    """Logging handler that records log messages as ``Log`` events
+
+    :meth:`emit` only puts the record on a bounded queue, records are
+    turned into events and sent by a daemon thread. Records that don't fit
+    in the queue are dropped and counted in ``dropped``. Records from
+    zilch's own loggers are ignored.
+
+    Events are grouped by logger name and message template, so messages
+    from the same logging call end up in the same group.
+
+    The thread doesn't survive a fork, a new queue and thread are started
+    in the child process the first time it logs. :meth:`flush`, which
+    :func:`logging.shutdown` calls at exit, waits at most
+    ``flush_timeout`` seconds.
+
+    """
+    def __init__(self, level=logging.NOTSET, queue_size=10000, tags=None,
+                 flush_timeout=5):
+        logging.Handler.__init__(self, level)
+        self.tags = tags or []
+        self.dropped = 0
+        self.queue_size = queue_size
+        self.flush_timeout = flush_timeout
+        self._start()
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._run,
+                                        args=(self.queue,),
+                                        name='zilch-logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check_pid(self):
+        # Records queued by the parent process are its own to send
+        if self.pid != os.getpid():
+            self.acquire()
+            try:
+                if self.pid != os.getpid():
+                    self._start()
+            finally:
+                self.release()
+
+    def emit(self, record):
+        if record.name.startswith('zilch'):
+            return
+        self._check_pid()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        """Wait for queued records to be sent, at most ``timeout`` seconds
+        or ``flush_timeout`` by default
+
+        Returns False if records were still queued.
+
+        """
+        self._check_pid()
+        if timeout is None:
+            timeout = self.flush_timeout
+        return wait_for_queue(self.queue, timeout)
+
+    def send_record(self, record):
+        template = to_unicode(record.msg)
+        data = {
+            'message': record.getMessage(),
+            'logger': record.name,
+            'template': template,
+            'level': record.levelno,
+            'filename': record.pathname,
+            'lineno': record.lineno,
+            'function': record.funcName,
+        }
+        if record.exc_info:
+            data['traceback'] = ''.join(
+                traceback.format_exception(*record.exc_info))
+        date = datetime.datetime.utcfromtimestamp(record.created)
+        capture('Log', tags=list(self.tags), data=data,
+                date=transform(date), hash=log_hash(record.name, template))
+
+    def _run(self, queue):
+        while 1:
+            record = queue.get()
+            try:
+                self.send_record(record)
+            except (Exception, ConfigurationError, DeliveryError):
+                self.handleError(record)
+            finally:
+                queue.task_done()
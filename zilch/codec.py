@@ -0,0 +1,244 @@
+"""Wire formats for messages sent to the Recorder
+
+Every encoded message starts with a format byte, which lets the recorder
+detect the format of each message it receives. Messages from clients that
+predate the format byte are a bare zlib stream, which always starts with
+``0x78``, and are decoded as ``LEGACY`` messages.
+
+``LEGACY``
+    zlib compressed JSON without a format byte, understood by all
+    recorders.
+``JSON``
+    zlib compressed JSON.
+``JSON_DICT``
+    zlib compressed JSON, using :data:`DICTIONARY` as preset dictionary.
+``MARSHAL``
+    :mod:`marshal` encoded and zlib compressed with :data:`DICTIONARY`
+    as preset dictionary. Messages holding values marshal can't encode
+    are sent as ``JSON_DICT`` instead. As with any marshal data, these
+    should only be accepted from trusted clients, they're not part of
+    :data:`SAFE_FORMATS`.
+
+Several messages can be encoded as a single batch with
+:func:`encode_batches`, which sets the ``BATCH`` bit of the format byte.
+Batches are compressed as a whole, and always carry a format byte, so a
+``LEGACY`` batch is sent as ``JSON``. :func:`decode_batch` returns the
+messages of batches and single messages alike. Both take the set of
+formats to accept, messages in other formats raise a
+:class:`~zilch.exc.DecodeError`.
+
+"""
+import marshal
+import zlib
+
+from zilch.exc import DecodeError
+from zilch.utils import CompressingWriter
+from zilch.utils import dumps_compressed
+from zilch.utils import encode_chunks
+from zilch.utils import loads
+
+LEGACY = 0
+JSON = 1
+JSON_DICT = 2
+MARSHAL = 3
+BATCH = 0x80
+
+# Formats that can be decoded from untrusted clients
+SAFE_FORMATS = frozenset([LEGACY, JSON, JSON_DICT])
+
+_zlib_header = '\x78'
+
+# Fragments common to most zilch messages. zlib can refer back to any of
+# them from the first message byte, so the most frequent come last. The
+# dictionary is part of the wire format, changing it requires new formats.
+DICTIONARY = (
+    '"CGI Variables": {"HTTP_ACCEPT_ENCODING": "gzip, deflate", '
+    '"HTTP_ACCEPT": "text/html,application/xhtml+xml,application/xml;'
+    'q=0.9,*/*;q=0.8", "HTTP_USER_AGENT": "Mozilla/5.0 (", '
+    '"SERVER_PROTOCOL": "HTTP/1.1", "REQUEST_METHOD": "GET", '
+    '"PATH_INFO": "/", "QUERY_STRING": "", "SERVER_NAME": "localhost", '
+    '"SERVER_PORT": "80", "REMOTE_ADDR": "127.0.0.1", "HTTP_HOST": "'
+    '"WSGI Variables": {"wsgi process": "Multithreaded", "application": '
+    '"<function <bound method  object at 0x<module \''
+    '"event_type": "HTTPException", "extra": {}, '
+    '"versions": {"weberror": "0.", "level": "40", '
+    '"type": "<type \'exceptions.", "type": "<class \''
+    '"value": "", "message": "", "time_spent": null, '
+    '"traceback": "Traceback (most recent call last):\\n  File \\"'
+    '/lib/python2.7/site-packages/", line , in \\n    \\n"'
+    '"event_type": "Exception", "tags": [["Hostname", "'
+    '"event_id": "", "hash": "", "date": "20", "data": {'
+    '"frames": [{"function": "", "vars": {"self": "<", "request": "<'
+    '"with_context": "", "module": "", "filename": "/'
+    '"visible": "True", "lineno": "", "id": "", "context_line": "'
+    '"}, {"function": "'
+)
+
+
+class PresetDictionary(object):
+    """zlib compression against a preset dictionary
+
+    :mod:`zlib` doesn't expose preset dictionaries, so the same effect is
+    had by compressing the dictionary and flushing, then copying the
+    compressor for every message and leaving out the dictionary's output.
+    The decompressor is primed with the dictionary in the same way, which
+    doesn't depend on both ends producing the same compressed dictionary.
+
+    """
+    def __init__(self, dictionary, level=zlib.Z_DEFAULT_COMPRESSION):
+        compressor = zlib.compressobj(level)
+        primer = compressor.compress(dictionary)
+        primer += compressor.flush(zlib.Z_SYNC_FLUSH)
+        decompressor = zlib.decompressobj()
+        decompressor.decompress(primer)
+        self._compressor = compressor
+        self._decompressor = decompressor
+
+    def compressobj(self):
+        return self._compressor.copy()
+
+    def compress(self, data):
+        compressor = self._compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+preset = PresetDictionary(DICTIONARY)
+
+
+def encode(message, format=LEGACY):
+    """Encode a message dict for the wire"""
+    if format == LEGACY:
+        return dumps_compressed(message)
+    elif format == JSON:
+        return chr(JSON) + dumps_compressed(message)
+    elif format == JSON_DICT:
+        return chr(JSON_DICT) + dumps_compressed(
+            message, compressor=preset.compressobj())
+    elif format == MARSHAL:
+        try:
+            data = marshal.dumps(message, 2)
+        except ValueError:
+            return encode(message, JSON_DICT)
+        return chr(MARSHAL) + preset.compress(data)
+    raise ValueError("Unknown wire format: %r" % format)
+
+
+def encode_batches(messages, format=JSON, max_bytes=1024 * 1024):
+    """Encode a list of messages as one or more batches
+
+    A new batch is started once a batch holds more than ``max_bytes`` of
+    uncompressed data. Returns a list of batch payloads.
+
+    """
+    if format == LEGACY:
+        format = JSON
+    if format == MARSHAL:
+        return _marshal_batches(messages, max_bytes)
+    elif format == JSON:
+        new_compressor = zlib.compressobj
+    elif format == JSON_DICT:
+        new_compressor = preset.compressobj
+    else:
+        raise ValueError("Unknown wire format: %r" % format)
+
+    header = chr(format | BATCH)
+    payloads = []
+    writer = None
+    for message in messages:
+        if writer is None:
+            writer = CompressingWriter(new_compressor())
+            writer.write('[')
+        else:
+            writer.write(', ')
+        encode_chunks(message, writer.write)
+        if writer.size >= max_bytes:
+            writer.write(']')
+            payloads.append(header + writer.close())
+            writer = None
+    if writer is not None:
+        writer.write(']')
+        payloads.append(header + writer.close())
+    return payloads
+
+
+def _marshal_batches(messages, max_bytes):
+    header = chr(MARSHAL | BATCH)
+    payloads = []
+    batch = []
+    size = 0
+    for message in messages:
+        try:
+            data = marshal.dumps(message, 2)
+        except ValueError:
+            payloads.extend(encode_batches([message], JSON_DICT, max_bytes))
+            continue
+        batch.append(data)
+        size += len(data)
+        if size >= max_bytes:
+            payloads.append(header + preset.compress(marshal.dumps(batch, 2)))
+            batch = []
+            size = 0
+    if batch:
+        payloads.append(header + preset.compress(marshal.dumps(batch, 2)))
+    return payloads
+
+
+def _check_format(format, formats):
+    if formats is not None and format not in formats:
+        raise DecodeError("Message format not allowed: %d" % format)
+
+
+def decode_batch(payload, formats=None):
+    """Decode a batch or a single message from the wire, in one of
+    ``formats`` or any format when None
+
+    Returns a list of messages.
+
+    """
+    if not payload:
+        raise DecodeError("Empty message")
+    format = ord(payload[0])
+    if not format & BATCH:
+        return [decode(payload, formats)]
+    format &= ~BATCH
+    _check_format(format, formats)
+    try:
+        if format == JSON:
+            return loads(zlib.decompress(payload[1:]))
+        elif format == JSON_DICT:
+            return loads(preset.decompress(payload[1:]))
+        elif format == MARSHAL:
+            return [marshal.loads(data) for data in
+                    marshal.loads(preset.decompress(payload[1:]))]
+    except (zlib.error, ValueError, EOFError, TypeError), e:
+        raise DecodeError("Unable to decode batch: %s" % e)
+    raise DecodeError("Unknown batch format: %r" % payload[0])
+
+
+def decode(payload, formats=None):
+    """Decode a message from the wire, in one of ``formats`` or any
+    format when None"""
+    if not payload:
+        raise DecodeError("Empty message")
+    header = payload[0]
+    if header == _zlib_header:
+        _check_format(LEGACY, formats)
+    else:
+        _check_format(ord(header), formats)
+    try:
+        if header == _zlib_header:
+            return loads(zlib.decompress(payload))
+        format = ord(header)
+        if format == JSON:
+            return loads(zlib.decompress(payload[1:]))
+        elif format == JSON_DICT:
+            return loads(preset.decompress(payload[1:]))
+        elif format == MARSHAL:
+            return marshal.loads(preset.decompress(payload[1:]))
+    except (zlib.error, ValueError, EOFError, TypeError), e:
+        raise DecodeError("Unable to decode message: %s" % e)
+    raise DecodeError("Unknown message format: %r" % header)
@@ -5,3 +5,11 @@ class ZilchException(BaseException):
 
 class ConfigurationError(ZilchException):
     """Configuration not setup properly"""
+
+
+class DecodeError(ZilchException):
+    """Message could not be decoded"""
+
+
+class DeliveryError(ZilchException):
+    """Message could not be delivered to the recorder"""
@@ -0,0 +1,169 @@
+"""Write-ahead journal of messages received by the recorder"""
+import os
+import struct
+import threading
+import zlib
+
+_record = struct.Struct('<II')
+_suffix = '.seg'
+
+
+class Journal(object):
+    """Append-only log of messages in rotating segment files
+
+    Messages are appended to the newest segment, each stored as a 4 byte
+    length and a 4 byte CRC-32 followed by the message. Once a segment
+    holds ``segment_size`` bytes, a new one is started.
+
+    Positions in the journal are ``(segment, offset)`` tuples. A reader
+    records how far it got with :meth:`commit`, which persists the
+    position in a checkpoint file and removes the segments before it.
+    Re-opening the journal continues reading from the checkpoint, and a
+    record cut short by a crash ends the segment.
+
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 fsync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.appended = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.checkpoint_path = os.path.join(directory, 'checkpoint')
+        self.checkpoint = self._read_checkpoint()
+
+        segments = self.segments()
+        if segments:
+            self.segment = segments[-1]
+        else:
+            self.segment = self.checkpoint[0]
+        self._file = open(self._path(self.segment), 'ab')
+        self.size = self._file.tell()
+        self._recover()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%012d%s' % (segment, _suffix))
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (IOError, ValueError):
+            return 0, 0
+
+    def _recover(self):
+        """Cut off a record left incomplete by a crash at the end of the
+        newest segment, so new messages are appended after the last
+        complete one"""
+        end = 0
+        with open(self._path(self.segment), 'rb') as f:
+            while 1:
+                header = f.read(_record.size)
+                if len(header) < _record.size:
+                    break
+                length, crc = _record.unpack(header)
+                message = f.read(length)
+                if len(message) < length or \
+                   zlib.crc32(message) & 0xffffffff != crc:
+                    break
+                end += _record.size + length
+        if end < self.size:
+            self._file.truncate(end)
+            self._file.seek(end)
+            self.size = end
+
+    def segments(self):
+        """Return the numbers of the segments on disk, oldest first"""
+        return sorted(int(name[:-len(_suffix)]) for name in
+                      os.listdir(self.directory) if name.endswith(_suffix))
+
+    @property
+    def position(self):
+        """Position after the last appended message"""
+        return self.segment, self.size
+
+    def append(self, message):
+        """Append a message to the journal"""
+        with self._lock:
+            if self.size >= self.segment_size:
+                self._rotate()
+            self._file.write(_record.pack(
+                len(message), zlib.crc32(message) & 0xffffffff))
+            self._file.write(message)
+            self.size += _record.size + len(message)
+            self.appended += 1
+
+    def _rotate(self):
+        self._file.close()
+        self.segment += 1
+        self._file = open(self._path(self.segment), 'ab')
+        self.size = 0
+
+    def flush(self):
+        """Write appended messages to the segment file, and to disk when
+        ``fsync`` is set"""
+        with self._lock:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def read(self, position, limit=None):
+        """Read messages written to the journal after ``position``
+
+        Returns a list of ``(position, message)`` tuples, with the
+        position after each message, for up to ``limit`` messages. Only
+        flushed messages are read.
+
+        """
+        segment, offset = position
+        # Segments before the one being appended to are complete
+        with self._lock:
+            last = self.segment
+        messages = []
+        while limit is None or len(messages) < limit:
+            path = self._path(segment)
+            if not os.path.exists(path):
+                break
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while limit is None or len(messages) < limit:
+                    header = f.read(_record.size)
+                    if len(header) < _record.size:
+                        break
+                    length, crc = _record.unpack(header)
+                    message = f.read(length)
+                    if len(message) < length or \
+                       zlib.crc32(message) & 0xffffffff != crc:
+                        break
+                    offset += _record.size + length
+                    messages.append(((segment, offset), message))
+            if segment >= last:
+                break
+            if limit is not None and len(messages) >= limit:
+                break
+            segment, offset = segment + 1, 0
+        return messages
+
+    def commit(self, position):
+        """Persist ``position`` as the checkpoint and remove the segments
+        that were fully read"""
+        segment, offset = position
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('%d %d' % (segment, offset))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp_path, self.checkpoint_path)
+        self.checkpoint = position
+        for old in self.segments():
+            if old >= segment:
+                break
+            os.remove(self._path(old))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
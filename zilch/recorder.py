@@ -1,14 +1,228 @@
 """Zilch Recorder"""
-import time
+import BaseHTTPServer
+import SocketServer
+import bisect
+import errno
+import functools
+import logging
+import marshal
+import multiprocessing
+import shutil
 import signal
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 try:
     import zmq
 except:
     pass
 
+from zilch.codec import BATCH
+from zilch.codec import JSON
+from zilch.codec import SAFE_FORMATS
+from zilch.codec import decode_batch
+from zilch.codec import encode
+from zilch.exc import DecodeError
+from zilch.journal import Journal
+from zilch.utils import dumps
 from zilch.utils import loads
 
+log = logging.getLogger(__name__)
+
+# Dead letter records: the time quarantined and the payload length
+_dead_letter_header = struct.Struct('<dI')
+
+
+def read_dead_letters(path):
+    """Iterate over the ``(timestamp, payload)`` records of a dead letter
+    file"""
+    with open(path, 'rb') as f:
+        while 1:
+            header = f.read(_dead_letter_header.size)
+            if len(header) < _dead_letter_header.size:
+                return
+            timestamp, length = _dead_letter_header.unpack(header)
+            yield timestamp, f.read(length)
+
+
+class Histogram(object):
+    """Histogram of durations in seconds, counted in fixed buckets"""
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+              0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of
+        observations"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        buckets = [[bound, count] for bound, count in
+                   zip(self.bounds, self.counts)]
+        buckets.append([None, self.counts[-1]])
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': buckets,
+        }
+
+
+class RecorderStats(object):
+    """Counters and histograms of a Recorder's work since it started"""
+    def __init__(self):
+        self.started = time.time()
+        self.messages = 0
+        self.bytes = 0
+        self.events = 0
+        self.event_types = {}
+        self.flushes = 0
+        self.flush_seconds = Histogram()
+        self.record_seconds = Histogram()
+
+    def snapshot(self):
+        return {
+            'uptime': time.time() - self.started,
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'events': self.events,
+            'event_types': dict(self.event_types),
+            'flushes': self.flushes,
+            'flush_seconds': self.flush_seconds.snapshot(),
+            'record_seconds': self.record_seconds.snapshot(),
+        }
+
+
+class HTTPIngestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Accepts events posted as a JSON list, or a single JSON object,
+    optionally gzipped"""
+    protocol_version = 'HTTP/1.1'
+    # Idle kept-alive connections are closed after this many seconds
+    timeout = 60
+
+    def respond(self, status, body, close=False):
+        """Send a JSON response, closing the connection afterwards with
+        ``close``, as when the request body wasn't read"""
+        body = dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        # The body of requests rejected before reading it would be parsed
+        # as the next request, so their connection is closed
+        if self.path.split('?')[0] != server.path:
+            return self.respond(404, {'error': 'Not found'}, close=True)
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            return self.respond(411, {'error': 'Content-Length required'},
+                                close=True)
+        if length < 0:
+            return self.respond(400, {'error': 'Bad Content-Length'},
+                                close=True)
+        if length > server.max_bytes:
+            return self.respond(413, {'error': 'Request too large'},
+                                close=True)
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, server.max_bytes)
+            except zlib.error, e:
+                return self.respond(400, {'error': 'Bad gzip data: %s' % e})
+            if decompressor.unconsumed_tail:
+                return self.respond(413, {'error': 'Request too large'})
+        try:
+            data = loads(body)
+        except ValueError, e:
+            return self.respond(400, {'error': 'Bad JSON: %s' % e})
+        if isinstance(data, dict):
+            count, format = 1, JSON
+        elif isinstance(data, list) and \
+             all(isinstance(message, dict) for message in data):
+            count, format = len(data), JSON | BATCH
+        else:
+            return self.respond(400, {'error': 'Expected events'})
+        if not server.push(chr(format) + zlib.compress(body)):
+            return self.respond(503, {'error': 'Recorder shutting down'})
+        self.respond(202, {'accepted': count})
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+class HTTPIngestServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    """HTTP server handing posted events to a Recorder
+
+    Posted events are forwarded to the recorder's socket as a single
+    :mod:`zilch.codec` message, so they're recorded like events received
+    over ZeroMQ.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, context, endpoint, path='/events',
+                 max_bytes=16 * 1024 * 1024):
+        BaseHTTPServer.HTTPServer.__init__(self, address, HTTPIngestHandler)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.sock = context.socket(zmq.PUSH)
+        self.sock.connect(endpoint)
+
+    def push(self, payload):
+        """Forward a payload to the recorder, returns False once the
+        server has been closed"""
+        with self._lock:
+            if self.sock is None:
+                return False
+            self.sock.send(payload)
+            return True
+
+    def close(self):
+        """Stop serving and close the socket to the recorder"""
+        self.shutdown()
+        self.server_close()
+        with self._lock:
+            self.sock.close()
+            self.sock = None
+
+
 class Recorder(object):
     """ZeroMQ Recorder
     
@@ -16,10 +230,99 @@ class Recorder(object):
     over ZeroMQ, a ``store`` instance should be provided that
     implements a ``message_received`` and ``flush`` method.
     
+    Received messages are flushed to the store once ``flush_count``
+    messages or ``flush_bytes`` bytes of messages have been received, or
+    ``flush_interval`` seconds after the first message that hasn't been
+    flushed yet, whichever comes first.
+    
+    With ``decode_threads``, messages are decoded on a pool of threads
+    while the main thread receives and records them, in the order they
+    were received. Messages are handed to the threads in chunks of up to
+    ``decode_chunk``, and at most ``decode_ahead`` chunks are decoded ahead
+    of the store.
+    
+    Messages that can't be decoded, and events the store rejects as
+    malformed, are logged and appended to the ``dead_letter`` file when
+    one is given, see :func:`read_dead_letters`. Only messages in the
+    :mod:`zilch.codec` formats of ``allowed_formats`` are decoded, which
+    leaves out ``MARSHAL`` unless the clients are trusted.
+    
+    Runtime statistics are kept in ``stats`` and returned as a dict by
+    :meth:`stats_snapshot`. With ``stats_bind``, a ZeroMQ REP socket is
+    bound there that answers every request with the snapshot as JSON.
+    With ``stats_interval``, the snapshot is logged every
+    ``stats_interval`` seconds.
+    
+    With ``journal_directory``, received messages are first appended to a
+    :class:`~zilch.journal.Journal` there, and an ingest thread hands them
+    from the journal to the store. The journal checkpoint is moved after
+    every flush of the store, so messages received but not flushed before
+    a crash are recorded when the recorder is restarted. As they're
+    replayed from the checkpoint, messages flushed right before a crash
+    may be handed to the store again. Journaled messages are decoded on
+    the ingest thread, ``decode_threads`` only applies without a journal.
+    When the store fails to record them, the ingest thread reads them
+    again from the checkpoint, waiting ``ingest_retry_delay`` seconds,
+    doubled after every failure up to ``ingest_retry_max``, as long as
+    the checkpoint doesn't move. After ``ingest_isolate_after`` failures
+    at the same checkpoint, the messages from there are recorded and
+    flushed one at a time, and the first one the store fails on is
+    quarantined so that the ones after it can be recorded.
+    
+    With ``http_bind``, a ``host:port`` address, events can also be posted
+    to ``http_path`` over HTTP, see :class:`HTTPIngestHandler`. They're
+    handed to the ZeroMQ socket and recorded like any other message.
+    
     """
-    def __init__(self, zeromq_bind=None, store=None):
+    ingest_retry_delay = 1
+    ingest_retry_max = 60
+    ingest_isolate_after = 3
+    
+    def __init__(self, zeromq_bind=None, store=None, flush_count=1000,
+                 flush_bytes=8 * 1024 * 1024, flush_interval=5,
+                 decode=None, decode_threads=0, decode_chunk=32,
+                 decode_ahead=32, dead_letter=None, stats_bind=None,
+                 stats_interval=None, journal_directory=None,
+                 journal_segment_size=64 * 1024 * 1024, poll_timeout=1,
+                 http_bind=None, http_path='/events',
+                 allowed_formats=SAFE_FORMATS):
         self.zeromq_bind = zeromq_bind
         self.store = store
+        self.allowed_formats = allowed_formats
+        if decode is None:
+            decode = functools.partial(decode_batch, formats=allowed_formats)
+        self.decode = decode
+        self.dead_letter = dead_letter
+        self.quarantined = 0
+        self._quarantine_lock = threading.Lock()
+        self.decode_chunk = decode_chunk
+        self.decode_ahead = decode_ahead
+        self.decoding = deque()
+        self.pool = None
+        if decode_threads:
+            self.pool = ThreadPool(decode_threads)
+        self.flush_count = flush_count
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.poll_timeout = poll_timeout
+        self.running = True
+        self.stopping = False
+        self.pending = 0
+        self.pending_events = 0
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.stats = RecorderStats()
+        self.stats_interval = stats_interval
+        self.stats_logged = time.time()
+        self.journal = None
+        self.ingested = None
+        self._ingest_thread = None
+        self._ingest_wakeup = threading.Event()
+        self._ingest_stop = False
+        if journal_directory:
+            self.journal = Journal(journal_directory,
+                                   segment_size=journal_segment_size)
+            self.ingested = self.journal.checkpoint
         signal.signal(signal.SIGTERM, self.shutdown)
         signal.signal(signal.SIGINT, self.shutdown)
         signal.signal(signal.SIGUSR1, self.shutdown)
@@ -28,56 +331,604 @@ class Recorder(object):
         zero_socket = context.socket(zmq.PULL)
         zero_socket.bind(self.zeromq_bind)
         self.sock = zero_socket
+        self.poller = zmq.Poller()
+        self.poller.register(zero_socket, zmq.POLLIN)
+        self.stats_sock = None
+        if stats_bind:
+            self.stats_sock = context.socket(zmq.REP)
+            self.stats_sock.bind(stats_bind)
+            self.poller.register(self.stats_sock, zmq.POLLIN)
+        self.http_server = None
+        if http_bind:
+            endpoint = 'inproc://zilch-http-%x' % id(self)
+            zero_socket.bind(endpoint)
+            host, port = http_bind.rsplit(':', 1)
+            self.http_server = HTTPIngestServer(
+                (host, int(port)), context, endpoint, path=http_path)
+            thread = threading.Thread(target=self.http_server.serve_forever,
+                                      name='zilch-http')
+            thread.daemon = True
+            thread.start()
     
     def shutdown(self, signum, stack):
-        """Shutdown the main loop and handle remaining messages"""
-        self.sock.close()
-        messages = True
-        message_count = 0
-        while messages:
+        """Stop the main loop, which then handles remaining messages"""
+        self.running = False
+        self.stopping = True
+    
+    def close(self):
+        """Handle the messages still waiting on the socket, flush the store
+        and close the sockets"""
+        if self.http_server is not None:
+            self.http_server.close()
+        while 1:
             try:
                 message = self.sock.recv(flags=zmq.NOBLOCK)
-                data = loads(message.decode('zlib'))
-                self.store.message_received(data)
-                message_count += 1
             except zmq.ZMQError, e:
-                messages = False
-        if message_count:
-            self.store.flush()
+                if e.errno != zmq.EAGAIN:
+                    raise
+                break
+            if self.journal is not None:
+                self.journal.append(message)
+            else:
+                self.message_received(message)
+        self.sock.close()
+        if self.stats_sock is not None:
+            self.stats_sock.close()
+        while self.decoding:
+            self.record_next()
+        if self.pool is not None:
+            self.pool.close()
+        if self.journal is not None:
+            self.journal.flush()
+            self.stop_ingest()
+            self.journal.close()
+        else:
+            self.flush()
         self._context.term()
-        raise SystemExit("Finished processing remaining messages, exiting.")
+    
+    def quarantine(self, payload, error):
+        """Log a malformed message and append it to the dead letter file"""
+        log.error("Quarantined malformed message: %s", error)
+        with self._quarantine_lock:
+            self.quarantined += 1
+            if not self.dead_letter:
+                return
+            with open(self.dead_letter, 'ab') as f:
+                f.write(_dead_letter_header.pack(time.time(), len(payload)))
+                f.write(payload)
+    
+    def decode_message(self, message):
+        """Decode a message, quarantining it when it's malformed"""
+        if not isinstance(message, str):
+            message = message.bytes
+        try:
+            return self.decode(message)
+        except DecodeError, e:
+            self.quarantine(message, e)
+            return []
+    
+    def record(self, messages, size):
+        """Hand decoded events to the store"""
+        stats = self.stats
+        event_types = stats.event_types
+        for data in messages:
+            start = time.time()
+            try:
+                self.store.message_received(data)
+            except (KeyError, TypeError, ValueError, AttributeError), e:
+                self.quarantine(encode(data, JSON), e)
+                continue
+            stats.record_seconds.observe(time.time() - start)
+            event_type = data.get('event_type')
+            event_types[event_type] = event_types.get(event_type, 0) + 1
+        stats.messages += 1
+        stats.bytes += size
+        stats.events += len(messages)
+        if not self.pending:
+            self.pending_since = time.time()
+        self.pending += 1
+        self.pending_events += len(messages)
+        self.pending_bytes += size
+    
+    def record_next(self):
+        """Record the oldest chunk of messages handed to the decode
+        threads"""
+        sizes, result = self.decoding.popleft()
+        for size, messages in zip(sizes, result.get()):
+            self.record(messages, size)
+            if self.flush_due(time.time()):
+                self.flush()
+    
+    def message_received(self, message):
+        """Hand the events in a received message to the store"""
+        self.record(self.decode_message(message), len(message))
+    
+    def flush_due(self, now):
+        """Whether a flush threshold has been reached"""
+        if not self.pending:
+            return False
+        return (self.pending >= self.flush_count or
+                self.pending_bytes >= self.flush_bytes or
+                now - self.pending_since >= self.flush_interval)
+    
+    def flush(self):
+        """Flush the store if any messages were received since the last
+        flush"""
+        if not self.pending:
+            return
+        start = time.time()
+        self.store.flush()
+        self.stats.flush_seconds.observe(time.time() - start)
+        self.stats.flushes += 1
+        self.pending = self.pending_events = self.pending_bytes = 0
+        self.pending_since = None
+        if self.journal is not None:
+            self.journal.commit(self.ingested)
+    
+    def stats_snapshot(self):
+        """Return the recorder statistics as a dict
+        
+        Besides the counters in ``stats``, this has the number of
+        messages, events and bytes not flushed yet, the age in seconds of
+        the oldest of them, and the number of objects the store holds
+        for the next flush when it has a ``pending_objects`` method, and
+        its identity cache counters when it has a ``cache_stats`` method.
+        
+        """
+        snapshot = self.stats.snapshot()
+        snapshot.update({
+            'quarantined': self.quarantined,
+            'pending_messages': self.pending,
+            'pending_events': self.pending_events,
+            'pending_bytes': self.pending_bytes,
+            'pending_age': (time.time() - self.pending_since
+                            if self.pending else 0),
+            'decoding': len(self.decoding),
+        })
+        if hasattr(self.store, 'pending_objects'):
+            snapshot['pending_objects'] = self.store.pending_objects()
+        if hasattr(self.store, 'cache_stats'):
+            snapshot['caches'] = self.store.cache_stats()
+        if self.journal is not None:
+            snapshot['journal_appended'] = self.journal.appended
+            snapshot['journal_segments'] = len(self.journal.segments())
+        return snapshot
+    
+    def answer_stats(self):
+        """Answer a request on the stats socket"""
+        try:
+            self.stats_sock.recv(flags=zmq.NOBLOCK)
+        except zmq.ZMQError, e:
+            if e.errno != zmq.EAGAIN:
+                raise
+            return
+        self.stats_sock.send(dumps(self.stats_snapshot()))
+    
+    def log_stats(self, now):
+        """Log the statistics when ``stats_interval`` has passed"""
+        if now - self.stats_logged < self.stats_interval:
+            return
+        self.stats_logged = now
+        log.info("Recorder stats: %s", dumps(self.stats_snapshot()))
+    
+    def drain(self):
+        """Receive every message that's waiting on the socket, flushing
+        whenever a threshold is reached along the way"""
+        if self.journal is not None:
+            return self.drain_journal()
+        if self.pool is not None:
+            return self.drain_pipelined()
+        while self.running:
+            try:
+                message = self.sock.recv(flags=zmq.NOBLOCK)
+            except zmq.ZMQError, e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                return
+            self.message_received(message)
+            if self.flush_due(time.time()):
+                self.flush()
+    
+    def drain_pipelined(self):
+        """Receive every message that's waiting on the socket and decode
+        them on the thread pool, recording decoded messages in order as
+        they become ready"""
+        decoding = self.decoding
+        chunk = []
+        while self.running:
+            try:
+                chunk.append(self.sock.recv(flags=zmq.NOBLOCK, copy=False))
+            except zmq.ZMQError, e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                break
+            if len(chunk) >= self.decode_chunk:
+                self.decode_chunk_async(chunk)
+                chunk = []
+            while decoding and (decoding[0][1].ready() or
+                                len(decoding) >= self.decode_ahead):
+                self.record_next()
+        if chunk:
+            self.decode_chunk_async(chunk)
+        while decoding:
+            self.record_next()
+    
+    def drain_journal(self):
+        """Append every message that's waiting on the socket to the
+        journal and wake up the ingest thread"""
+        journal = self.journal
+        while self.running:
+            try:
+                journal.append(self.sock.recv(flags=zmq.NOBLOCK))
+            except zmq.ZMQError, e:
+                if e.errno != zmq.EAGAIN:
+                    raise
+                break
+        journal.flush()
+        self._ingest_wakeup.set()
+    
+    def start_ingest(self):
+        self._ingest_thread = threading.Thread(target=self._ingest,
+                                               name='zilch-ingest')
+        self._ingest_thread.daemon = True
+        self._ingest_thread.start()
+    
+    def stop_ingest(self):
+        """Wait for the ingest thread to record every journaled message"""
+        if self._ingest_thread is None:
+            return
+        self._ingest_stop = True
+        self._ingest_wakeup.set()
+        self._ingest_thread.join()
+        self._ingest_thread = None
+    
+    def _ingest(self):
+        delay = self.ingest_retry_delay
+        failed_at = None
+        failures = 0
+        while 1:
+            try:
+                if failures >= self.ingest_isolate_after:
+                    failures = 0
+                    self.isolate()
+                self.ingest()
+                return
+            except Exception:
+                # The store rolled back what wasn't flushed, read it again
+                # from the checkpoint after waiting a little longer every
+                # time the checkpoint hasn't moved since the last failure
+                self.pending = self.pending_events = self.pending_bytes = 0
+                self.pending_since = None
+                self.ingested = self.journal.checkpoint
+                if self._ingest_stop:
+                    # Unrecorded messages stay in the journal for the next
+                    # start
+                    log.exception("Failed to record journaled messages")
+                    return
+                if self.ingested != failed_at:
+                    delay = self.ingest_retry_delay
+                    failures = 0
+                failed_at = self.ingested
+                failures += 1
+                log.exception("Failed to record journaled messages, "
+                              "retrying in %s seconds", delay)
+                self.ingest_wait(delay)
+                delay = min(delay * 2, self.ingest_retry_max)
+    
+    def isolate(self):
+        """Record and flush the journaled messages after the checkpoint
+        one at a time, until the store fails on one of them, which is
+        quarantined and skipped"""
+        journal = self.journal
+        for position, message in journal.read(self.ingested,
+                                              limit=self.flush_count):
+            try:
+                self.message_received(message)
+                self.ingested = position
+                self.flush()
+            except Exception, e:
+                self.pending = self.pending_events = self.pending_bytes = 0
+                self.pending_since = None
+                self.quarantine(message, e)
+                self.ingested = position
+                journal.commit(position)
+                return
+    
+    def ingest_wait(self, seconds):
+        """Wait ``seconds`` before ingesting again, unless
+        :meth:`stop_ingest` is called first"""
+        deadline = time.time() + seconds
+        while not self._ingest_stop:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._ingest_wakeup.wait(remaining)
+            self._ingest_wakeup.clear()
+    
+    def ingest(self):
+        """Hand journaled messages to the store, starting from the journal
+        checkpoint, until :meth:`stop_ingest` is called"""
+        journal = self.journal
+        while 1:
+            stopping = self._ingest_stop
+            messages = journal.read(self.ingested, limit=self.flush_count)
+            for position, message in messages:
+                self.message_received(message)
+                self.ingested = position
+                if self.flush_due(time.time()):
+                    self.flush()
+            if not messages:
+                if stopping:
+                    break
+                if self.pending:
+                    remaining = self.pending_since + self.flush_interval - \
+                        time.time()
+                    self._ingest_wakeup.wait(max(0, remaining))
+                else:
+                    self._ingest_wakeup.wait()
+                self._ingest_wakeup.clear()
+            if self.flush_due(time.time()):
+                self.flush()
+        self.flush()
+    
+    def decode_chunk_async(self, frames):
+        """Hand a list of received frames to the decode threads"""
+        sizes = [len(frame) for frame in frames]
+        self.decoding.append((sizes, self.pool.apply_async(
+            map, (self.decode_message, frames))))
     
     def main_loop(self):
         """Run the main collector loop
         
         Every message recieved will result in ``message_recieved`` being
-        called with the de-serialized JSON data.
+        called with the decoded data, in any of the formats in
+        :mod:`zilch.codec`. Batched messages are unpacked and handed to
+        the store one at a time.
+        
+        The loop blocks in a :class:`zmq.Poller` until messages arrive or
+        the next flush is due, then receives everything that's waiting.
+        ``flush`` is *only* called on the store when there were messages
+        since the last flush. With a journal, the loop only appends
+        messages to it, and the ingest thread records and flushes them.
         
-        Every 10 seconds, the ``flush`` method will be called for storage
-        instances that wish to flush collected messages periodically for
-        efficiency. ``flush`` will *only* be called if there actually
-        were messages in the prior 10 seconds.
+        On shutdown, the messages still waiting on the socket are handled
+        before the recorder exits.
         
-        The main_loop executes in a serial single-threaded fashion.
+        Without a journal, the main_loop executes in a serial
+        single-threaded fashion, see :class:`ShardedRecorder` to spread the
+        work over several processes.
         
         """
         print "Running zilch-recorder on port: %s" % self.zeromq_bind
-        messages = False
-        now = time.time()
-        last_flush = now
+        if self.journal is not None:
+            self.start_ingest()
+        while self.running:
+            # Signals don't interrupt a poll, so wake up regularly to see
+            # whether the loop was stopped
+            deadlines = [time.time() + self.poll_timeout]
+            if self.pending and self.journal is None:
+                deadlines.append(self.pending_since + self.flush_interval)
+            if self.stats_interval:
+                deadlines.append(self.stats_logged + self.stats_interval)
+            remaining = min(deadlines) - time.time()
+            events = dict(self.poller.poll(max(0, int(remaining * 1000))))
+            if events.get(self.sock) == zmq.POLLIN:
+                self.drain()
+            if self.stats_sock is not None and \
+               events.get(self.stats_sock) == zmq.POLLIN:
+                self.answer_stats()
+            now = time.time()
+            if self.journal is None and self.flush_due(now):
+                self.flush()
+            if self.stats_interval:
+                self.log_stats(now)
+        if self.stopping:
+            self.close()
+            raise SystemExit("Finished processing remaining messages, exiting.")
 
-        while 1:
+
+class WorkerRecorder(Recorder):
+    """Recorder running in a :class:`ShardedRecorder` worker process
+
+    Receives lists of decoded messages from the front process, marshalled.
+    An empty message marks the end of the stream, after which the worker
+    flushes its store and exits.
+
+    """
+    def __init__(self, zeromq_bind=None, store=None, **kwargs):
+        Recorder.__init__(self, zeromq_bind, store, decode=marshal.loads,
+                          **kwargs)
+        # The front process decides when workers stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+
+    def message_received(self, message):
+        if not message:
+            self.running = False
+            return
+        Recorder.message_received(self, message)
+
+    def main_loop(self):
+        try:
+            Recorder.main_loop(self)
+            self.flush()
+        finally:
+            self.sock.close()
+            self._context.term()
+
+
+def run_worker(zeromq_bind, store_factory, options):
+    """Entry point of :class:`ShardedRecorder` worker processes"""
+    recorder = WorkerRecorder(zeromq_bind, store_factory(), **options)
+    recorder.main_loop()
+
+
+class ShardedRecorder(object):
+    """ZeroMQ Recorder that spreads messages over worker processes
+
+    The front process receives messages, decodes them to find their group
+    hash, and forwards each event to the worker chosen by the hash. All
+    events of a group are recorded by the same worker, so workers don't
+    contend for the same ``Group`` rows.
+
+    Every worker process runs a :class:`WorkerRecorder` with its own
+    ``store``, created by calling ``store_factory`` in the worker. Workers
+    that die are restarted. Events already handed to a worker that dies
+    before flushing are lost, events still queued for it are kept for its
+    replacement.
+
+    Events are forwarded to a worker in lists of up to ``forward_count``
+    events or about ``forward_bytes`` bytes of received messages. Like
+    the :class:`Recorder`, the front process only decodes messages in the
+    formats of ``allowed_formats``.
+
+    On shutdown the front process forwards the messages it has already
+    received, then waits for every worker to record and flush the events
+    sent to it.
+
+    """
+    def __init__(self, zeromq_bind=None, store_factory=None, workers=2,
+                 supervise_interval=1, forward_count=1000,
+                 forward_bytes=1024 * 1024, allowed_formats=SAFE_FORMATS,
+                 **options):
+        self.zeromq_bind = zeromq_bind
+        self.allowed_formats = allowed_formats
+        self.store_factory = store_factory
+        self.workers = workers
+        self.supervise_interval = supervise_interval
+        self.forward_count = forward_count
+        self.forward_bytes = forward_bytes
+        self.options = options
+        self.running = True
+        self.restarts = 0
+        self.forwarded = 0
+        self.directory = tempfile.mkdtemp(prefix='zilch-recorder-')
+        self.endpoints = ['ipc://%s/worker-%d' % (self.directory, i)
+                          for i in range(workers)]
+        self.processes = [self.start_worker(i) for i in range(workers)]
+
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGUSR1, self.shutdown)
+
+        self._context = context = zmq.Context()
+        self.sock = context.socket(zmq.PULL)
+        self.sock.bind(self.zeromq_bind)
+        self.worker_socks = []
+        for endpoint in self.endpoints:
+            worker_sock = context.socket(zmq.PUSH)
+            worker_sock.connect(endpoint)
+            self.worker_socks.append(worker_sock)
+        self.poller = zmq.Poller()
+        self.poller.register(self.sock, zmq.POLLIN)
+
+    def start_worker(self, index):
+        process = multiprocessing.Process(
+            target=run_worker, name='zilch-recorder-%d' % index,
+            args=(self.endpoints[index], self.store_factory, self.options))
+        process.daemon = True
+        process.start()
+        return process
+
+    def supervise(self):
+        """Restart workers that have exited"""
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            log.error("Recorder worker %d exited with code %s, restarting",
+                      index, process.exitcode)
+            self.restarts += 1
+            self.processes[index] = self.start_worker(index)
+
+    def route(self, message):
+        """Return the index of the worker that records ``message``, raises
+        a ``ValueError`` when it isn't an event with a string hash"""
+        if not isinstance(message, dict):
+            raise ValueError("Expected an event, got %r" % (message,))
+        key = message.get('hash') or ''
+        if not isinstance(key, basestring):
+            raise ValueError("Malformed hash: %r" % (key,))
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % self.workers
+
+    def forward(self, index, messages):
+        """Send a list of messages to a worker"""
+        self.worker_socks[index].send(marshal.dumps(messages, 2))
+        self.forwarded += len(messages)
+
+    def drain(self, stopping=False):
+        """Forward the messages waiting on the socket, until there are
+        none left or the recorder is shut down, unless ``stopping``"""
+        shards = {}
+        while self.running or stopping:
             try:
-                message = self.sock.recv(flags=zmq.NOBLOCK)
-                data = loads(message.decode('zlib'))
-                self.store.message_received(data)
-                messages = True
+                payload = self.sock.recv(flags=zmq.NOBLOCK)
             except zmq.ZMQError, e:
                 if e.errno != zmq.EAGAIN:
                     raise
-                time.sleep(0.2)
-            now = time.time()
-            if now - last_flush > 5 and messages:
-                self.store.flush()
-                last_flush = now
-                messages = False
+                break
+            try:
+                messages = decode_batch(payload, self.allowed_formats)
+            except DecodeError, e:
+                log.error("Dropping message: %s", e)
+                continue
+            size = len(payload) // len(messages) if messages else 0
+            for message in messages:
+                try:
+                    index = self.route(message)
+                except ValueError, e:
+                    log.error("Dropping message: %s", e)
+                    continue
+                shard = shards.get(index)
+                if shard is None:
+                    shard = shards[index] = [[], 0]
+                shard[0].append(message)
+                shard[1] += size
+                if len(shard[0]) >= self.forward_count or \
+                   shard[1] >= self.forward_bytes:
+                    self.forward(index, shard[0])
+                    del shards[index]
+        for index, (messages, size) in shards.items():
+            self.forward(index, messages)
+
+    def shutdown(self, signum, stack):
+        """Stop the main loop, which then drains the workers"""
+        self.running = False
+
+    def stop(self):
+        """Forward the remaining messages and wait for the workers to
+        record them"""
+        self.supervise()
+        self.drain(stopping=True)
+        self.sock.close()
+        for worker_sock in self.worker_socks:
+            worker_sock.send('')
+            worker_sock.close(linger=-1)
+        for index, process in enumerate(self.processes):
+            process.join()
+            if process.exitcode:
+                log.error("Recorder worker %d exited with code %s",
+                          index, process.exitcode)
+        self._context.term()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def main_loop(self):
+        """Run the front process loop until shutdown"""
+        print "Running zilch-recorder on port: %s with %d workers" % (
+            self.zeromq_bind, self.workers)
+        timeout = int(self.supervise_interval * 1000)
+        try:
+            while self.running:
+                try:
+                    events = dict(self.poller.poll(timeout))
+                except zmq.ZMQError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+                if events.get(self.sock) == zmq.POLLIN:
+                    self.drain()
+                self.supervise()
+        finally:
+            self.stop()
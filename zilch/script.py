@@ -3,20 +3,92 @@ from optparse import OptionParser
 
 from paste.httpserver import serve
 
+from zilch import codec
 from zilch.recorder import Recorder
+from zilch.recorder import ShardedRecorder
 
 class ZilchRecorder(object):
     def main(self):
         from zilch.store import SQLAlchemyStore
         usage = "usage: %prog zeromq_bind database_uri"
         parser = OptionParser(usage=usage)
+        parser.add_option("--flush-count", dest="flush_count", type="int",
+                          default=1000,
+                          help="Flush after this many messages")
+        parser.add_option("--flush-bytes", dest="flush_bytes", type="int",
+                          default=8 * 1024 * 1024,
+                          help="Flush after this many bytes of messages")
+        parser.add_option("--flush-interval", dest="flush_interval",
+                          type="float", default=5,
+                          help="Flush this many seconds after a message")
+        parser.add_option("--decode-threads", dest="decode_threads",
+                          type="int", default=0,
+                          help="Decode messages on this many threads")
+        parser.add_option("--dead-letter", dest="dead_letter",
+                          help="File to write malformed messages to")
+        parser.add_option("--journal-directory", dest="journal_directory",
+                          help="Journal received messages in this directory "
+                               "before recording them")
+        parser.add_option("--journal-segment-size",
+                          dest="journal_segment_size", type="int",
+                          default=64 * 1024 * 1024,
+                          help="Size in bytes of journal segment files")
+        parser.add_option("--http-bind", dest="http_bind",
+                          help="host:port to accept events posted over "
+                               "HTTP on")
+        parser.add_option("--stats-bind", dest="stats_bind",
+                          help="ZeroMQ address to answer stats requests on")
+        parser.add_option("--stats-interval", dest="stats_interval",
+                          type="float",
+                          help="Log stats every this many seconds")
+        parser.add_option("--coalesce-samples", dest="coalesce_samples",
+                          type="int",
+                          help="Coalesce events of the same group between "
+                               "flushes, recording this many of them")
+        parser.add_option("--workers", dest="workers", type="int", default=0,
+                          help="Record messages in this many worker "
+                               "processes")
+        parser.add_option("--allow-marshal", dest="allow_marshal",
+                          action="store_true", default=False,
+                          help="Accept messages in the marshal format, "
+                               "only from trusted clients")
         (options, args) = parser.parse_args()
         
         if len(args) < 2:
             sys.exit("Error: Failed to provide necessary arguments")
         
-        store = SQLAlchemyStore(uri=args[1])
-        recorder = Recorder(zeromq_bind=args[0], store=store)
+        allowed_formats = codec.SAFE_FORMATS
+        if options.allow_marshal:
+            allowed_formats = allowed_formats | set([codec.MARSHAL])
+        flush_options = dict(flush_count=options.flush_count,
+                             flush_bytes=options.flush_bytes,
+                             flush_interval=options.flush_interval,
+                             stats_interval=options.stats_interval,
+                             allowed_formats=allowed_formats)
+        if options.workers > 0:
+            unsupported = [name for name in ('decode_threads', 'dead_letter',
+                                             'stats_bind', 'http_bind',
+                                             'journal_directory')
+                           if getattr(options, name)]
+            if unsupported:
+                parser.error("--workers can't be used with %s" % ', '.join(
+                    '--' + name.replace('_', '-') for name in unsupported))
+            recorder = ShardedRecorder(
+                zeromq_bind=args[0], workers=options.workers,
+                store_factory=lambda: SQLAlchemyStore(
+                    uri=args[1], coalesce_samples=options.coalesce_samples),
+                **flush_options)
+        else:
+            store = SQLAlchemyStore(
+                uri=args[1], coalesce_samples=options.coalesce_samples)
+            recorder = Recorder(zeromq_bind=args[0], store=store,
+                                decode_threads=options.decode_threads,
+                                dead_letter=options.dead_letter,
+                                stats_bind=options.stats_bind,
+                                http_bind=options.http_bind,
+                                journal_directory=options.journal_directory,
+                                journal_segment_size=options.journal_segment_size,
+                                **flush_options)
         recorder.main_loop()
 
 
@@ -45,10 +117,47 @@ class ZilchWeb(object):
         return serve(app, host=options.hostname, port=options.port)
 
 
+class ZilchMigrate(object):
+    def main(self):
+        import logging
+        from zilch import store
+        usage = "usage: %prog database_uri"
+        parser = OptionParser(usage=usage)
+        parser.add_option("--batch-size", dest="batch_size", type="int",
+                          default=1000,
+                          help="Rewrite this many events per transaction")
+        parser.add_option("--compression-level", dest="compression_level",
+                          type="int", default=store.compression_level,
+                          help="zlib level to compress event data with, "
+                               "0 to store it uncompressed")
+        parser.add_option("--train-dictionary", dest="train_dictionary",
+                          type="int", metavar="EVENTS",
+                          help="Train a compression dictionary on this many "
+                               "of the latest events first")
+        (options, args) = parser.parse_args()
+        
+        if len(args) < 1:
+            sys.exit("Error: Failed to provide a database_uri")
+        
+        logging.basicConfig(level=logging.INFO)
+        store.init_db(args[0])
+        store.migrate_groups()
+        store.migrate_scores(batch_size=options.batch_size)
+        if options.train_dictionary:
+            samples = store.sample_event_data(options.train_dictionary)
+            store.add_dictionary(store.train_dictionary(samples))
+        store.migrate_event_data(batch_size=options.batch_size,
+                                 level=options.compression_level)
+
+
 def zilch_recorder():
     zilch = ZilchRecorder()
     sys.exit(zilch.main())
 
+def zilch_migrate():
+    migrate = ZilchMigrate()
+    sys.exit(migrate.main())
+
 def zilch_web():
     try:
         import pyramid
@@ -0,0 +1,132 @@
+"""Disk spool for messages the recorder can't accept yet"""
+import mmap
+import os
+import struct
+import threading
+
+_header = struct.Struct('<4sIIII')
+_length = struct.Struct('<I')
+_magic = 'ZSP1'
+_wrap = 0xFFFFFFFF
+
+
+class Spool(object):
+    """Fixed-size ring of messages in a memory-mapped file
+
+    Messages are appended at the tail and read back in order from the
+    head. Each is stored as a 4 byte length followed by the message, a
+    message that doesn't fit before the end of the ring is stored at the
+    start instead, and a wrap marker is left behind. When the ring is
+    full, new messages are dropped.
+
+    The head and tail are kept in a header at the start of the file, so a
+    spool file re-opened with the same size continues where it left off.
+
+    """
+    def __init__(self, path, size=64 * 1024 * 1024):
+        self.path = path
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            existing = os.fstat(fd).st_size
+            if existing != size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.capacity = size - _header.size
+
+        magic, head, tail, used, count = _header.unpack_from(self._map, 0)
+        if existing == size and magic == _magic:
+            self.head, self.tail, self.used, self.count = \
+                head, tail, used, count
+        else:
+            self.head = self.tail = self.used = self.count = 0
+            self._write_header()
+
+    def __len__(self):
+        return self.count
+
+    def _write_header(self):
+        _header.pack_into(self._map, 0, _magic, self.head, self.tail,
+                          self.used, self.count)
+
+    def append(self, message):
+        """Add a message to the tail, returns False if it was dropped"""
+        size = _length.size + len(message)
+        self._lock.acquire()
+        try:
+            position = self.tail
+            waste = 0
+            if self.capacity - position < size:
+                # Skip the rest of the ring and continue at the start
+                waste = self.capacity - position
+                position = 0
+            if self.used + waste + size > self.capacity:
+                self.dropped += 1
+                return False
+            if waste >= _length.size:
+                _length.pack_into(self._map, _header.size + self.tail, _wrap)
+            offset = _header.size + position
+            _length.pack_into(self._map, offset, len(message))
+            self._map[offset + _length.size:offset + size] = message
+            self.tail = position + size
+            self.used += waste + size
+            self.count += 1
+            self.spooled += 1
+            self._write_header()
+            return True
+        finally:
+            self._lock.release()
+
+    def _locate(self):
+        """Return the offset and length of the message at the head, and
+        the bytes skipped to reach it"""
+        position = self.head
+        wrapped = self.capacity - position < _length.size
+        if not wrapped:
+            length = _length.unpack_from(self._map,
+                                         _header.size + position)[0]
+            wrapped = length == _wrap
+        waste = 0
+        if wrapped:
+            waste = self.capacity - position
+            position = 0
+            length = _length.unpack_from(self._map, _header.size)[0]
+        return position, length, waste
+
+    def peek(self):
+        """Return the message at the head, or None if the spool is empty"""
+        self._lock.acquire()
+        try:
+            if not self.count:
+                return None
+            position, length, waste = self._locate()
+            offset = _header.size + position + _length.size
+            return self._map[offset:offset + length]
+        finally:
+            self._lock.release()
+
+    def pop(self):
+        """Remove the message at the head"""
+        self._lock.acquire()
+        try:
+            if not self.count:
+                return
+            position, length, waste = self._locate()
+            self.head = position + _length.size + length
+            self.used -= waste + _length.size + length
+            self.count -= 1
+            self.replayed += 1
+            if not self.count:
+                self.head = self.tail = self.used = 0
+            self._write_header()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._map.close()
@@ -1,27 +1,46 @@
 """SQLAlchemy Storage Backend"""
 import base64
 import datetime
+import hashlib
 import math
 import logging
+import struct
+import threading
+import zlib
+from collections import OrderedDict
 
 import simplejson
 
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import Index
 from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import func
+from sqlalchemy import case
+from sqlalchemy import literal_column
+from sqlalchemy import or_
+from sqlalchemy import select
 from sqlalchemy import text
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql.expression import type_coerce
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.types import DateTime
 from sqlalchemy.types import Float
 from sqlalchemy.types import Integer
+from sqlalchemy.types import LargeBinary
+from sqlalchemy.types import String
 from sqlalchemy.types import Text
 from sqlalchemy.types import TypeDecorator
 
+from zilch.utils import log_hash
+
 
 log = logging.getLogger(__name__)
 
@@ -75,7 +94,12 @@ class DatabaseTable(object):
 
 class GzippedJSON(TypeDecorator):
     """Implements a gzipped JSON type to store additional event
-    information"""
+    information
+
+    Superseded by :class:`CompressedJSON`, which reads values written by
+    this type.
+
+    """
     impl = Text
     
     def process_bind_param(self, value, dialect):
@@ -94,13 +118,340 @@ class GzippedJSON(TypeDecorator):
         return GzippedJSON(self.impl.length)
 
 
+# zlib level of CompressedJSON values, 0 stores them uncompressed
+compression_level = 6
+
+# Id of the compression dictionary to compress new values with, set by
+# init_db to the newest one in the database
+compression_dictionary = None
+
+_RAW = '\x00'
+_ZLIB = '\x01'
+_ZLIB_DICTIONARY = '\x02'
+_dictionary_id = struct.Struct('<I')
+
+
+class Dictionary(object):
+    """A preset dictionary for zlib
+
+    Python 2's zlib can't set a dictionary, so the dictionary is
+    compressed once and the compressor and decompressor states after it
+    are copied for each value. Only what follows the compressed
+    dictionary is stored.
+
+    """
+    def __init__(self, id, data):
+        self.id = id
+        self.data = data
+        self._levels = {}
+        decompressor = zlib.decompressobj()
+        decompressor.decompress(self._compressor(6)[1])
+        self._decompressor = decompressor
+
+    def _compressor(self, level):
+        compressor = zlib.compressobj(level)
+        prefix = compressor.compress(self.data)
+        prefix += compressor.flush(zlib.Z_SYNC_FLUSH)
+        return compressor, prefix
+
+    def compress(self, value, level):
+        compressor = self._levels.get(level)
+        if compressor is None:
+            compressor = self._levels[level] = self._compressor(level)[0]
+        compressor = compressor.copy()
+        return compressor.compress(value) + compressor.flush()
+
+    def decompress(self, value):
+        return self._decompressor.copy().decompress(value)
+
+
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+
+
+def get_dictionary(id):
+    """Return the compression dictionary with the given id, reading it
+    from the database the first time"""
+    dictionary = _dictionaries.get(id)
+    if dictionary is None:
+        with _dictionaries_lock:
+            dictionary = _dictionaries.get(id)
+            if dictionary is None:
+                table = CompressionDictionary.__table__
+                data = Session.execute(select(
+                    [table.c.data]).where(table.c.id == id)).scalar()
+                if data is None:
+                    raise KeyError('No compression dictionary %s' % id)
+                dictionary = _dictionaries[id] = Dictionary(id, str(data))
+    return dictionary
+
+
+class CompressedJSON(TypeDecorator):
+    """JSON compressed with zlib in a binary column
+
+    Values start with a byte telling how the rest is stored: as is,
+    compressed with zlib, or compressed with zlib and the preset
+    dictionary whose id follows, see :class:`CompressionDictionary`.
+    Values written by :class:`GzippedJSON` as base64 text are read as
+    well.
+
+    With ``text``, set by :func:`init_db` on databases whose column is
+    still the text column of :class:`GzippedJSON`, values are written the
+    way it writes them until ``zilch-migrate`` has turned the column into
+    a binary one.
+
+    """
+    impl = LargeBinary
+
+    def __init__(self, level=None, *args, **kwargs):
+        TypeDecorator.__init__(self, *args, **kwargs)
+        self.level = level
+        self.text = False
+
+    def load_dialect_impl(self, dialect):
+        if self.text:
+            return dialect.type_descriptor(Text())
+        return dialect.type_descriptor(self.impl)
+
+    def process_bind_param(self, value, dialect):
+        if self.text:
+            return GzippedJSON().process_bind_param(value, dialect)
+        return encode_json(value or {}, self.level)
+
+    def process_result_value(self, value, dialect):
+        if value:
+            return decode_json(value)
+        else:
+            return dict()
+
+    def copy(self):
+        copy = CompressedJSON(self.level)
+        copy.text = self.text
+        return copy
+
+
+def encode_json(value, level=None, dictionary=None):
+    """Encode a value for a :class:`CompressedJSON` column"""
+    if level is None:
+        level = compression_level
+    if dictionary is None and compression_dictionary is not None:
+        dictionary = get_dictionary(compression_dictionary)
+    value = simplejson.dumps(value, separators=(',', ':'))
+    if not level:
+        return _RAW + value
+    elif dictionary is not None:
+        return (_ZLIB_DICTIONARY + _dictionary_id.pack(dictionary.id) +
+                dictionary.compress(value, level))
+    else:
+        return _ZLIB + zlib.compress(value, level)
+
+
+def decode_json(value):
+    """Decode a :class:`CompressedJSON` or :class:`GzippedJSON` value"""
+    value = str(value)
+    header = value[:1]
+    if header == _ZLIB:
+        value = zlib.decompress(value[1:])
+    elif header == _ZLIB_DICTIONARY:
+        id, = _dictionary_id.unpack_from(value, 1)
+        value = get_dictionary(id).decompress(
+            value[1 + _dictionary_id.size:])
+    elif header == _RAW:
+        value = value[1:]
+    else:
+        value = base64.b64decode(value).decode('zlib')
+    return simplejson.loads(value)
+
+
+class IdentityCache(object):
+    """LRU cache of primary keys, or other row values, by natural key
+
+    The cache is shared by the threads of the process. Values written by
+    a transaction that isn't committed yet are added with :meth:`stage`,
+    and only seen by the thread that staged them until it calls
+    :meth:`commit`.
+
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key):
+        staged = getattr(self._local, 'staged', None)
+        with self._lock:
+            if staged and key in staged:
+                self.hits += 1
+                return staged[key]
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def stage(self, key, value):
+        """Add a value of the current thread's transaction, see
+        :meth:`commit`"""
+        staged = getattr(self._local, 'staged', None)
+        if staged is None:
+            staged = self._local.staged = {}
+        staged[key] = value
+
+    def commit(self):
+        """Share the values staged by the current thread"""
+        staged = getattr(self._local, 'staged', None)
+        if not staged:
+            return
+        self._local.staged = None
+        with self._lock:
+            for key, value in staged.iteritems():
+                self._set(key, value)
+
+    def rollback(self):
+        """Drop the values staged by the current thread"""
+        self._local.staged = None
+
+    def discard(self, key):
+        staged = getattr(self._local, 'staged', None)
+        if staged:
+            staged.pop(key, None)
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        self.rollback()
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._items)}
+
+
+class IdentityCaches(object):
+    """The identity caches used by the event creators and the store
+
+    ``event_types`` maps names to event type ids, ``tags`` maps
+    ``(name, value)`` tuples to tag ids and ``groups`` maps
+    ``(type_id, hash)`` tuples to dicts with the ``id``, ``count``,
+    ``first_seen`` and ``last_seen`` of the group as last written by this
+    process. ``stacks`` maps stack hashes to their data, and holds fewer
+    entries as stacks are larger.
+
+    Ids and groups written by the bulk writer are staged until its
+    transaction is committed. The caches are cleared whenever a
+    transaction is rolled back, as rows they refer to may not exist
+    anymore, and when the database changes.
+
+    """
+    def __init__(self, max_size=10000):
+        self.event_types = IdentityCache(max_size)
+        self.tags = IdentityCache(max_size)
+        self.groups = IdentityCache(max_size)
+        self.stacks = IdentityCache(max_size // 10)
+
+    def commit(self, *args):
+        self.event_types.commit()
+        self.tags.commit()
+        self.groups.commit()
+        self.stacks.commit()
+
+    def rollback(self, *args):
+        self.event_types.rollback()
+        self.tags.rollback()
+        self.groups.rollback()
+        self.stacks.rollback()
+
+    def clear(self, *args):
+        self.event_types.clear()
+        self.tags.clear()
+        self.groups.clear()
+        self.stacks.clear()
+
+    def stats(self):
+        return {
+            'event_types': self.event_types.stats(),
+            'tags': self.tags.stats(),
+            'groups': self.groups.stats(),
+            'stacks': self.stacks.stats(),
+        }
+
+
+caches = IdentityCaches()
+event.listen(Session.session_factory, 'after_commit', caches.commit)
+event.listen(Session.session_factory, 'after_rollback', caches.clear)
+# Values staged by a transaction that was closed without committing
+event.listen(Session.session_factory, 'after_begin', caches.rollback)
+
+# Whether the group table has the unique index on type_id and hash, which
+# create_all doesn't add to tables created by earlier versions, see
+# migrate_groups
+group_index = False
+
+
+def _index_names(engine, table):
+    from sqlalchemy.engine.reflection import Inspector
+    return set(index['name'] for index in
+               Inspector.from_engine(engine).get_indexes(table))
+
+
 def init_db(uri, **kwargs):
     """Initialize the Session and create the database tables if
     necessary"""
+    global compression_dictionary, group_index
+    caches.clear()
     engine = create_engine(uri, **kwargs)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _sqlite_functions)
     Session.configure(bind=engine)
     Base.metadata.bind = engine
     Base.metadata.create_all(engine)
+    group_index = 'idx_type_hash' in _index_names(engine, 'group')
+    if not group_index:
+        log.warning("The group table has no unique index on type_id and "
+                    "hash, run zilch-migrate to add it")
+    Event.__table__.c.data.type.text = _text_data_column(engine)
+    if Event.__table__.c.data.type.text:
+        log.warning("The event data column is still a text column, event "
+                    "data is written base64 encoded until zilch-migrate "
+                    "has made it a binary one")
+    _dictionaries.clear()
+    table = CompressionDictionary.__table__
+    compression_dictionary = engine.execute(select(
+        [func.max(table.c.id)])).scalar()
+
+
+def _sqlite_functions(dbapi_connection, connection_record):
+    """Add the math functions scores are combined with, which SQLite
+    lacks unless built with them"""
+    dbapi_connection.create_function('ln', 1, math.log)
+    dbapi_connection.create_function('exp', 1, math.exp)
+
+
+def parse_date(value):
+    """Parse the date of a message"""
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
 
 
 class HelperMixin(object):
@@ -146,11 +497,121 @@ class Event(Base, HelperMixin):
     hash = Column(Text, nullable=False, index=True)
     datetime = Column(DateTime, default=datetime.datetime.now, nullable=False)
     time_spent = Column(Integer)
-    data = Column(GzippedJSON)
+    data = Column(CompressedJSON)
     
     tags = relationship('Tag', secondary=event_tags, backref='events')
 
 
+class Stack(Base):
+    """Frames of exception events without their variables, and the frames
+    part of their traceback, shared by the events with the same stack, see
+    :func:`split_stack`"""
+    __tablename__ = 'stack'
+
+    hash = Column(String(40), primary_key=True)
+    data = Column(CompressedJSON, nullable=False)
+
+
+# Keys of captured frames that differ between events with the same stack
+_frame_variables = ('id', 'vars', 'vars_omitted')
+
+
+def _split_traceback(traceback):
+    """Split a formatted traceback after its frames, before the
+    exception"""
+    lines = traceback.splitlines(True)
+    end = 1
+    while end < len(lines) and lines[end].startswith('  '):
+        end += 1
+    return ''.join(lines[:end]), ''.join(lines[end:])
+
+
+def split_stack(data):
+    """Split the stack out of event data
+
+    Returns the data with its ``frames`` replaced by the hash of their
+    :class:`Stack` in ``stack`` and their variables in ``frame_vars``,
+    followed by the hash and the data of the stack. The frames part of
+    the ``traceback`` goes to the stack as well, leaving the exception in
+    ``traceback_tail``. Data without frames is returned as is, with None
+    for the hash and the stack.
+
+    """
+    frames = data.get('frames')
+    if not frames:
+        return data, None, None
+    stack = {'frames': []}
+    variables = []
+    for frame in frames:
+        stack['frames'].append(dict(
+            (key, value) for key, value in frame.iteritems()
+            if key not in _frame_variables))
+        variables.append(dict((key, frame[key]) for key in _frame_variables
+                              if key in frame))
+    data = dict(data, frame_vars=variables)
+    del data['frames']
+    if isinstance(data.get('traceback'), basestring):
+        stack['traceback'], data['traceback_tail'] = _split_traceback(
+            data.pop('traceback'))
+    data['stack'] = hash = hashlib.sha1(simplejson.dumps(
+        stack, sort_keys=True, separators=(',', ':'))).hexdigest()
+    return data, hash, stack
+
+
+def assemble_stack(data):
+    """Return event data split by :func:`split_stack` with its stack"""
+    stack = caches.stacks.get(data['stack'])
+    if stack is None:
+        table = Stack.__table__
+        stack = Session.execute(select([table.c.data]).where(
+            table.c.hash == data['stack'])).scalar()
+        caches.stacks.set(data['stack'], stack)
+    data = dict(data)
+    del data['stack']
+    data['frames'] = [dict(frame, **variables) for frame, variables in
+                      zip(stack['frames'], data.pop('frame_vars'))]
+    if 'traceback_tail' in data:
+        data['traceback'] = stack['traceback'] + data.pop('traceback_tail')
+    return data
+
+
+def save_stacks(stacks):
+    """Insert the stacks of a dict of stack data by hash that aren't in
+    the database yet"""
+    missing = set(hash for hash in stacks if caches.stacks.get(hash) is None)
+    if missing:
+        table = Stack.__table__
+        for chunk in _chunks(list(missing)):
+            query = Session.execute(select([table.c.hash]).where(
+                table.c.hash.in_(chunk)))
+            missing.difference_update(row.hash for row in query)
+        if missing:
+            Session.execute(table.insert(), [
+                {'hash': hash, 'data': stacks[hash]} for hash in missing])
+    for hash, stack in stacks.iteritems():
+        caches.stacks.stage(hash, stack)
+
+
+def _assemble_event_stack(target, *args):
+    data = target.__dict__.get('data')
+    if data and 'stack' in data:
+        set_committed_value(target, 'data', assemble_stack(data))
+
+event.listen(Event, 'load', _assemble_event_stack)
+event.listen(Event, 'refresh', _assemble_event_stack)
+
+
+class CompressionDictionary(Base):
+    """Preset zlib dictionaries for :class:`CompressedJSON` values, see
+    :func:`train_dictionary`"""
+    __tablename__ = 'compression_dictionary'
+
+    id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    created = Column(DateTime, default=datetime.datetime.now,
+                     nullable=False)
+
+
 class EventType(Base, HelperMixin):
     __tablename__ = 'event_type'
     key_lookup = 'name'
@@ -183,12 +644,15 @@ class Group(Base, HelperMixin):
     last_seen = Column(DateTime, default=datetime.datetime.now, nullable=False)
     first_seen = Column(DateTime, default=datetime.datetime.now, nullable=False)
 
-    score = Column(Float, default=0)
+    # Time-decayed count, see _score
+    score = Column(Float, default=0, index=True)
     events = relationship('Event', secondary=group_events, lazy='dynamic',
                           backref='groups')
     
     def generate_score(self):
-        return int(math.log(self.count) * 600 + int(self.last_seen.strftime('%s')))
+        """Score the group as if all its occurrences were at its last
+        seen date"""
+        return _score(None, self.count, self.last_seen)
     
     def last_event(self):
         return self.events.order_by(Event.datetime.desc()).first()
@@ -207,62 +671,60 @@ class Group(Base, HelperMixin):
     def recently_seen(cls, limit=20):
         return Session.query(cls).order_by(cls.last_seen.desc()).limit(limit)
     
+    @classmethod
+    def hottest(cls, limit=20):
+        """Groups with the most occurrences lately, see :func:`_score`"""
+        return Session.query(cls).order_by(cls.score.desc()).limit(limit)
+    
     event_type = relationship(EventType)
 
+Index('idx_type_hash', Group.type_id, Group.hash, unique=True)
 
-class ExceptionCreator(object):
-    @classmethod
-    def create_from_message(cls, message, db_uri):
-        data = message['data']
-        date = datetime.datetime.strptime(message['date'], '%Y-%m-%dT%H:%M:%S.%f')
-        level = int(data.get('level', 0))
-        class_name = data.get('type')
-        value = data.get('value', '')
-
-        traceback = data.pop('traceback', None)
 
+class EventCreator(object):
+    """Base class for creating an Event and updating its Group from a
+    message"""
+    @classmethod
+    def create_event(cls, message, db_uri, group_message, data):
+        date = parse_date(message['date'])
         hash = message['hash']
-        group_message = data['message']
 
-        event_type = EventType.get_or_create(name=message['event_type'])
-        tags = [Tag.get_or_create(name=x, value=y) for x,y in message.get('tags', [])]
+        event_type_id = caches.event_types.get(message['event_type'])
+        if event_type_id is None:
+            event_type_id = EventType.get_or_create(
+                name=message['event_type']).id
+            caches.event_types.set(message['event_type'], event_type_id)
+        tags = []
+        for x, y in message.get('tags', []):
+            tag_id = caches.tags.get((x, y))
+            if tag_id is None:
+                tag = Tag.get_or_create(name=x, value=y)
+                caches.tags.set((x, y), tag.id)
+            else:
+                tag = Session.query(Tag).get(tag_id)
+            tags.append(tag)
 
-        group = Group.get_or_create(
-            type_id=event_type.id,
-            hash=hash,
-            defaults=dict(
-                message=group_message,
-                first_seen=date,
-                last_seen=date)
-        )
-
-        if group.count == 0:
-            group.count = 1
-            group.score = int(math.log(1) * 600 + int(date.strftime('%s')))
-        elif db_uri.startswith('postgres'):
-            group.score = text('log(count) * 600 + last_seen::abstime::int')
-        elif db_uri.startswith('mysql'):
-            group.score = text('log(times_seen) * 600 + unix_timestamp(last_seen)')
-        else:
-            group.count = group.count or 0
-            group.score = group.generate_score()
-        group.last_seen = date
-
-        # Atomically update the group count
-        group.count = Group.count + 1
+        # Create the group or count the event in one statement, then load
+        # it with the new count
+        upsert_groups([{
+            'type_id': event_type_id, 'hash': hash,
+            'message': group_message, 'count': 1,
+            'first_seen': date, 'last_seen': date,
+            'score': _score(None, 1, date),
+        }])
+        # Databases without the unique index may hold duplicates
+        group = Session.query(Group).populate_existing().filter_by(
+            type_id=event_type_id, hash=hash).order_by(Group.id).first()
+        # The batch writer must read the group again
+        caches.groups.discard((event_type_id, hash))
 
-        data = {
-            'frames': data.get('frames'),
-            'versions': data.get('versions'),
-            'type': class_name,
-            'value': value,
-            'extra': message.get('extra'),
-            'traceback': traceback,
-        }
+        data, stack, stack_data = split_stack(data)
+        if stack is not None:
+            save_stacks({stack: stack_data})
 
         event = Event(
             hash=hash,
-            type_id=event_type.id,
+            type_id=event_type_id,
             event_id=message['event_id'],
             datetime=date,
             data=data,
@@ -274,23 +736,848 @@ class ExceptionCreator(object):
         return event
 
 
+class ExceptionCreator(EventCreator):
+    @classmethod
+    def create_from_message(cls, message, db_uri):
+        return cls.create_event(message, db_uri, *cls.event_data(message))
+
+    @classmethod
+    def event_data(cls, message):
+        """Return the group message and event data of a message"""
+        data = message['data']
+        data = {
+            'frames': data.get('frames'),
+            'versions': data.get('versions'),
+            'type': data.get('type'),
+            'value': data.get('value', ''),
+            'extra': message.get('extra'),
+            'traceback': data.get('traceback'),
+        }
+        return message['data']['message'], data
+
+
+class LogCreator(EventCreator):
+    """Creates Log events
+
+    Log events are grouped by their logger name and message template, so
+    the many messages logged from one logging call share a group.
+
+    """
+    @classmethod
+    def create_from_message(cls, message, db_uri):
+        return cls.create_event(message, db_uri, *cls.event_data(message))
+
+    @classmethod
+    def event_data(cls, message):
+        """Return the group message and event data of a message"""
+        data = message['data']
+        logger = data.get('logger', '')
+        template = data.get('template', data.get('message', ''))
+        if not message.get('hash'):
+            message['hash'] = log_hash(logger, template)
+        group_message = '%s: %s' % (logger, template)
+        data = {
+            'message': data.get('message', ''),
+            'logger': logger,
+            'template': template,
+            'level': data.get('level'),
+            'filename': data.get('filename'),
+            'lineno': data.get('lineno'),
+            'function': data.get('function'),
+            'extra': message.get('extra'),
+            'traceback': data.get('traceback'),
+        }
+        return group_message, data
+
+
 event_classes = {
     'Exception': ExceptionCreator,
     'HTTPException': ExceptionCreator,
+    'Log': LogCreator,
+}
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Time it takes for an occurrence to count half as much in a group's score
+score_half_life = 6 * 3600
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+
+def _logaddexp(a, b):
+    """Return ``log(exp(a) + exp(b))``, where None stands for ``log(0)``"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b) + math.log1p(math.exp(-abs(a - b)))
+
+
+def _score(score, count, date):
+    """Return a group's ``score`` after ``count`` more occurrences at
+    ``date``
+
+    The score is the log of the group's count, with each occurrence
+    weighted by ``2 ** (seconds since the epoch / score_half_life)``.
+    Weighting by the date of the occurrence rather than decaying the
+    counts as time passes keeps the order of the scores of groups the
+    same as the order of their decayed counts at any time, so the score
+    can be indexed and only changes when the group is seen.
+
+    """
+    seconds = (date - _epoch).total_seconds()
+    return _logaddexp(score, math.log(count) +
+                      seconds * math.log(2) / score_half_life)
+
+
+def _logaddexp_sql(a, b):
+    """Return the SQL expression of :func:`_logaddexp` for the score
+    expressions ``a``, which may be NULL, and ``b``
+
+    Scores apart by more than ``40`` would add less than the precision of
+    a float, and ``EXP`` of them underflows on PostgreSQL, so the larger
+    one is kept as is.
+
+    """
+    limit = literal_column('40')
+    one = literal_column('1')
+    return case([
+        ((a == None) | (b - a > limit), b),
+        (a - b > limit, a),
+        (a >= b, a + func.ln(one + func.exp(b - a)))],
+        else_=b + func.ln(one + func.exp(a - b)))
+
+
+_upsert_updates = {
+    'postgresql': ('ON CONFLICT (type_id, hash) DO UPDATE SET '
+                   '%(count)s = %(table)s.%(count)s + excluded.%(count)s, '
+                   'first_seen = LEAST(%(table)s.first_seen, '
+                   'excluded.first_seen), '
+                   'last_seen = GREATEST(%(table)s.last_seen, '
+                   'excluded.last_seen), '
+                   'score = %(score)s'),
+    'sqlite': ('ON CONFLICT (type_id, hash) DO UPDATE SET '
+               '%(count)s = %(count)s + excluded.%(count)s, '
+               'first_seen = min(first_seen, excluded.first_seen), '
+               'last_seen = max(last_seen, excluded.last_seen), '
+               'score = %(score)s'),
+    'mysql': ('ON DUPLICATE KEY UPDATE '
+              '%(count)s = %(count)s + VALUES(%(count)s), '
+              'first_seen = LEAST(first_seen, VALUES(first_seen)), '
+              'last_seen = GREATEST(last_seen, VALUES(last_seen)), '
+              'score = %(score)s'),
 }
 
 
+def _upsert_clause(dialect):
+    """Return the clause turning an INSERT into groups into an upsert on
+    ``dialect``, or None when it has none or the database lacks the
+    unique index it relies on"""
+    if not group_index:
+        return None
+    elif dialect.name == 'sqlite':
+        if dialect.dbapi.sqlite_version_info < (3, 24):
+            return None
+    elif dialect.name == 'postgresql':
+        if dialect.server_version_info < (9, 5):
+            return None
+    elif dialect.name != 'mysql':
+        return None
+    preparer = dialect.identifier_preparer
+    table = Group.__table__
+    if dialect.name == 'mysql':
+        inserted = literal_column('VALUES(score)')
+    else:
+        inserted = literal_column('excluded.score')
+    score = _logaddexp_sql(table.c.score, inserted).compile(dialect=dialect)
+    return _upsert_updates[dialect.name] % {
+        'table': preparer.format_table(table),
+        'count': preparer.format_column(table.c.count),
+        'score': score}
+
+
+def upsert_groups(rows):
+    """Create groups or count occurrences of existing ones
+
+    ``rows`` are dicts with the ``type_id``, ``hash``, ``message``,
+    ``count``, ``first_seen``, ``last_seen`` and ``score`` of the
+    occurrences of a group. A new group is inserted with them; an existing
+    group gets ``count`` added to its count, its first and last seen dates
+    extended and ``score`` combined with its score, see
+    :func:`_logaddexp_sql`. Every change is computed by the database from
+    the group as it is, so concurrent writers don't lose each other's
+    occurrences.
+
+    On PostgreSQL, SQLite and MySQL, each group is written with one
+    atomic statement relying on the unique index on ``type_id`` and
+    ``hash``. Other databases, and databases without the index yet, are
+    updated, and the groups that didn't exist inserted afterwards.
+
+    """
+    if not rows:
+        return
+    table = Group.__table__
+    dialect = Session.bind.dialect
+    clause = _upsert_clause(dialect)
+    if clause is not None:
+        preparer = dialect.identifier_preparer
+        columns = ['type_id', 'hash', 'message', 'count', 'first_seen',
+                   'last_seen', 'score']
+        statement = text('INSERT INTO %s (%s, state) VALUES (%s, 1) %s' % (
+            preparer.format_table(table),
+            ', '.join(preparer.format_column(table.c[name])
+                      for name in columns),
+            ', '.join(':' + name for name in columns),
+            clause), bindparams=[bindparam(name, type_=table.c[name].type)
+                                 for name in columns])
+        Session.execute(statement, rows)
+        return
+
+    update = table.update().where(
+        (table.c.type_id == bindparam('_type_id')) &
+        (table.c.hash == bindparam('_hash'))).values(
+            count=table.c.count + bindparam('_count'),
+            first_seen=case([(table.c.first_seen > bindparam('_first_seen'),
+                              bindparam('_first_seen'))],
+                            else_=table.c.first_seen),
+            last_seen=case([(table.c.last_seen < bindparam('_last_seen'),
+                             bindparam('_last_seen'))],
+                           else_=table.c.last_seen),
+            score=_logaddexp_sql(table.c.score,
+                                 bindparam('_score', type_=Float)))
+    missing = []
+    for row in rows:
+        result = Session.execute(update, dict(
+            ('_' + key, value) for key, value in row.items()))
+        if not result.rowcount:
+            missing.append(dict(row, state=1))
+    if missing:
+        Session.execute(table.insert(), missing)
+
+
+def migrate_groups():
+    """Merge the groups with the same type and hash, which databases
+    created by earlier versions can hold, and add the unique index on
+    ``type_id`` and ``hash``
+
+    The events of merged groups are moved to the group created first,
+    which gets the sum of their counts. Returns the number of groups
+    removed.
+
+    """
+    global group_index
+    table = Group.__table__
+    if 'idx_type_hash' in _index_names(Session.connection(), 'group'):
+        group_index = True
+        return 0
+    duplicates = Session.execute(select([
+        table.c.type_id, table.c.hash, func.min(table.c.id),
+        func.sum(table.c.count), func.min(table.c.first_seen),
+        func.max(table.c.last_seen)]).group_by(
+            table.c.type_id, table.c.hash).having(
+                func.count(table.c.id) > 1)).fetchall()
+    removed = 0
+    for type_id, hash, keep, count, first_seen, last_seen in duplicates:
+        ids = [id for id, in Session.execute(select([table.c.id]).where(
+            (table.c.type_id == type_id) & (table.c.hash == hash) &
+            (table.c.id != keep)))]
+        Session.execute(group_events.update().where(
+            group_events.c.group_id.in_(ids)).values(group_id=keep))
+        Session.execute(table.delete().where(table.c.id.in_(ids)))
+        Session.execute(table.update().where(table.c.id == keep).values(
+            count=count, first_seen=first_seen, last_seen=last_seen))
+        removed += len(ids)
+    index = [index for index in table.indexes
+             if index.name == 'idx_type_hash'][0]
+    index.create(Session.connection())
+    Session.commit()
+    group_index = True
+    log.info("Merged %d duplicate groups", removed)
+    return removed
+
+
+def migrate_scores(batch_size=1000):
+    """Recompute the scores of groups written by earlier versions and add
+    the index on the score, unless the index is already there
+
+    Returns whether the scores were recomputed.
+
+    """
+    if 'ix_group_score' in _index_names(Session.connection(), 'group'):
+        return False
+    rescore_groups(batch_size)
+    index = [index for index in Group.__table__.indexes
+             if index.name == 'ix_group_score'][0]
+    index.create(Session.connection())
+    Session.commit()
+    log.info("Recomputed group scores and added their index")
+    return True
+
+
+def rescore_groups(batch_size=1000):
+    """Recompute the score of every group from its count and last seen
+    date, as scores written by earlier versions aren't comparable"""
+    table = Group.__table__
+    query = select([table.c.id, table.c.count, table.c.last_seen]).order_by(
+        table.c.id)
+    update = table.update().where(table.c.id == bindparam('_id')).values(
+        score=bindparam('_score'))
+    last_id = None
+    while 1:
+        page = query
+        if last_id is not None:
+            page = page.where(table.c.id > last_id)
+        rows = Session.execute(page.limit(batch_size)).fetchall()
+        if not rows:
+            break
+        Session.execute(update, [
+            {'_id': id, '_score': _score(None, max(count, 1), last_seen)}
+            for id, count, last_seen in rows])
+        Session.commit()
+        last_id = rows[-1].id
+    caches.groups.clear()
+
+
+def train_dictionary(samples, size=32 * 1024):
+    """Build a preset dictionary out of sample JSON documents
+
+    The dictionary holds the fragments between commas found in the most
+    samples, weighted by their length, up to ``size`` bytes. The most
+    common come last, as zlib encodes closer matches in fewer bits.
+
+    """
+    counts = {}
+    for sample in samples:
+        for fragment in set(sample.split(',')):
+            counts[fragment] = counts.get(fragment, 0) + 1
+    scored = sorted(((count * len(fragment), fragment) for fragment, count
+                     in counts.iteritems() if count > 1), reverse=True)
+    fragments = []
+    total = 0
+    for score, fragment in scored:
+        if total + len(fragment) + 1 <= size:
+            fragments.append(fragment)
+            total += len(fragment) + 1
+    fragments.reverse()
+    return ''.join(fragment + ',' for fragment in fragments)
+
+
+def add_dictionary(data):
+    """Save a compression dictionary and compress new values with it"""
+    global compression_dictionary
+    table = CompressionDictionary.__table__
+    result = Session.execute(table.insert(), {
+        'data': data, 'created': datetime.datetime.now()})
+    Session.commit()
+    compression_dictionary = result.inserted_primary_key[0]
+    return compression_dictionary
+
+
+def sample_event_data(limit=1000):
+    """Return the JSON of the data of the latest events, to train a
+    dictionary with"""
+    query = Session.query(Event.data).order_by(Event.datetime.desc())
+    return [simplejson.dumps(data, separators=(',', ':'))
+            for data, in query.limit(limit)]
+
+
+def _text_data_column(engine):
+    """Return whether the event data column is the Text column of
+    databases created for GzippedJSON, which binary values can't be
+    written to; SQLite stores them in any column"""
+    from sqlalchemy.engine.reflection import Inspector
+    if engine.dialect.name == 'sqlite':
+        return False
+    columns = Inspector.from_engine(engine).get_columns('event')
+    column = [c for c in columns if c['name'] == 'data'][0]
+    return isinstance(column['type'], Text)
+
+
+def _binary_data_column():
+    """Turn the Text event data column of databases created for
+    GzippedJSON into a binary one, keeping the base64 values"""
+    connection = Session.connection()
+    if not _text_data_column(connection):
+        return
+    if connection.dialect.name == 'postgresql':
+        Session.execute("ALTER TABLE event ALTER COLUMN data TYPE bytea "
+                        "USING convert_to(data, 'UTF8')")
+    elif connection.dialect.name == 'mysql':
+        Session.execute("ALTER TABLE event MODIFY data LONGBLOB")
+
+
+def migrate_event_data(batch_size=1000, level=None):
+    """Rewrite the data of events stored by GzippedJSON, or with another
+    compression setting, in batches of ``batch_size``
+
+    Returns the number of events rewritten.
+
+    """
+    _binary_data_column()
+    if level is None:
+        level = compression_level
+    if not level:
+        current = _RAW
+    elif compression_dictionary is not None:
+        current = _ZLIB_DICTIONARY + _dictionary_id.pack(
+            compression_dictionary)
+    else:
+        current = _ZLIB
+    table = Event.__table__
+    query = select([table.c.event_id,
+                    type_coerce(table.c.data, LargeBinary)]).order_by(
+                        table.c.event_id)
+    update = table.update().where(
+        table.c.event_id == bindparam('_event_id')).values(
+            data=bindparam('_data', type_=LargeBinary))
+    rewritten = 0
+    last_id = None
+    while 1:
+        page = query
+        if last_id is not None:
+            page = page.where(table.c.event_id > last_id)
+        rows = Session.execute(page.limit(batch_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = [{'_event_id': event_id,
+                    '_data': encode_json(decode_json(data), level)}
+                   for event_id, data in rows
+                   if data and not str(data).startswith(current)]
+        if updates:
+            Session.execute(update, updates)
+        Session.commit()
+        rewritten += len(updates)
+        log.info("Rewrote %d events, up to %s", rewritten, last_id)
+    return rewritten
+
+
+def _thread_local(name, factory):
+    """Property holding a value per thread, created with ``factory``"""
+    def get(self):
+        value = getattr(self._local, name, None)
+        if value is None:
+            value = factory()
+            setattr(self._local, name, value)
+        return value
+    def set(self, value):
+        setattr(self._local, name, value)
+    return property(get, set)
+
+
 class SQLAlchemyStore(object):
-    def __init__(self, uri=None):
+    """Store recording events in a database with SQLAlchemy
+
+    Events are written in bulk when the store is flushed, see
+    :meth:`messages_received`. With ``bulk=False``, every message is
+    turned into ORM objects as it's received instead.
+
+    With ``coalesce_samples``, messages with the same event type and hash
+    received between two flushes are coalesced. Only the first
+    ``coalesce_samples`` of them, at least one, are recorded as events,
+    the others are only added to the count of their group, and extend its
+    first and last seen dates.
+
+    Like the ``Session``, the messages waiting for the next flush are
+    kept per thread, and every thread flushes its own.
+
+    """
+    _pending = _thread_local('pending', OrderedDict)
+    _batch = _thread_local('batch', list)
+    _summaries = _thread_local('summaries', list)
+
+    def __init__(self, uri=None, coalesce_samples=None, bulk=True):
         init_db(uri)
         self.uri = uri
+        self.coalesce_samples = coalesce_samples
+        self.bulk = bulk
+        self.coalesced = 0
+        self.dropped_occurrences = 0
+        self._local = threading.local()
 
     def message_received(self, message):
+        if self.coalesce_samples is not None:
+            self.coalesce(message)
+        elif message.get('summary'):
+            if self.bulk:
+                # Applied after the batch, which may create the group
+                parse_date(message['date'])
+                self._summaries.append(message)
+            else:
+                self.summary_received(message)
+        else:
+            self.record(message)
+
+    def record(self, message):
         EventClass = event_classes.get(message['event_type'])
-        if EventClass:
+        if not EventClass:
+            return
+        if self.bulk:
+            self._batch.append(self.prepare(message))
+        elif not Session.query(Event.event_id).filter_by(
+                event_id=message['event_id']).first():
             event = EventClass.create_from_message(message, self.uri)
             Session.add(event)
 
+    def prepare(self, message):
+        """Extract the values needed to write an event from a message
+
+        The values the bulk writer relies on are checked here, raising a
+        ``ValueError`` for a malformed message when it's received rather
+        than failing the whole batch when the store is flushed.
+
+        """
+        for key in ('event_id', 'hash'):
+            value = message[key]
+            if not isinstance(value, basestring) or not value:
+                raise ValueError("Malformed %s: %r" % (key, value))
+        time_spent = message['time_spent']
+        if time_spent is not None and (
+                isinstance(time_spent, bool) or
+                not isinstance(time_spent, (int, long, float))):
+            raise ValueError("Malformed time_spent: %r" % (time_spent,))
+        tags = message.get('tags', [])
+        if not isinstance(tags, (list, tuple)):
+            raise ValueError("Malformed tags: %r" % (tags,))
+        for tag in tags:
+            if not isinstance(tag, (list, tuple)) or len(tag) != 2 or \
+               not all(isinstance(value, basestring) for value in tag):
+                raise ValueError("Malformed tag: %r" % (tag,))
+        EventClass = event_classes[message['event_type']]
+        group_message, data = EventClass.event_data(message)
+        data, stack, stack_data = split_stack(data)
+        return {
+            'event_type': message['event_type'],
+            'event_id': message['event_id'],
+            'hash': message['hash'],
+            'date': parse_date(message['date']),
+            'time_spent': message['time_spent'],
+            'tags': set((name, value) for name, value in tags),
+            'group_message': group_message,
+            'data': data,
+            'stack': stack,
+            'stack_data': stack_data,
+        }
+
+    def messages_received(self, messages):
+        """Write a batch of event messages in the current transaction
+
+        Event types, tags and groups are taken from the identity caches,
+        the others looked up with one query per kind and the missing event
+        types and tags inserted together. Groups are created or updated
+        with one upsert statement for the batch, see :func:`upsert_groups`.
+        The stacks of exceptions not in the stack cache are looked up and
+        inserted the same way, see :func:`split_stack`. Events, their tags
+        and group memberships are inserted with one statement each.
+
+        Events already recorded, such as messages delivered twice or
+        replayed from the recorder's journal, are left out after one query
+        for the ids of the batch.
+
+        """
+        prepared = [self.prepare(message) for message in messages
+                    if message['event_type'] in event_classes]
+        self.write_batch(prepared)
+
+    def write_batch(self, prepared):
+        prepared = self._new_events(prepared)
+        if not prepared:
+            return
+        types = self._event_type_ids(set(p['event_type'] for p in prepared))
+        save_stacks(dict((p['stack'], p['stack_data']) for p in prepared
+                         if p['stack'] is not None))
+        tags = self._tag_ids(set().union(*[p['tags'] for p in prepared]))
+
+        # Sum up the batch per group
+        batch_groups = OrderedDict()
+        for p in prepared:
+            key = (types[p['event_type']], p['hash'])
+            group = batch_groups.get(key)
+            if group is None:
+                batch_groups[key] = group = {
+                    'message': p['group_message'], 'count': 0,
+                    'first_seen': p['date'], 'last_seen': p['date'],
+                    'score': None}
+            group['count'] += 1
+            group['score'] = _score(group['score'], 1, p['date'])
+            group['first_seen'] = min(group['first_seen'], p['date'])
+            group['last_seen'] = max(group['last_seen'], p['date'])
+        groups = self._groups(batch_groups)
+
+        rows = []
+        states = {}
+        for (type_id, hash), batch_group in batch_groups.items():
+            group = groups.get((type_id, hash), {
+                'count': 0, 'first_seen': batch_group['first_seen'],
+                'last_seen': batch_group['last_seen']})
+            states[(type_id, hash)] = state = {
+                'count': group['count'] + batch_group['count'],
+                'first_seen': min(group['first_seen'],
+                                  batch_group['first_seen']),
+                'last_seen': max(group['last_seen'],
+                                 batch_group['last_seen'])}
+            rows.append({
+                'type_id': type_id,
+                'hash': hash,
+                'message': batch_group['message'],
+                'count': batch_group['count'],
+                'first_seen': batch_group['first_seen'],
+                'last_seen': batch_group['last_seen'],
+                'score': batch_group['score'],
+            })
+        upsert_groups(rows)
+        created = set(batch_groups).difference(groups)
+        if created:
+            groups.update(self._lookup_groups(created))
+        for key, state in states.items():
+            state['id'] = groups[key]['id']
+            caches.groups.stage(key, state)
+
+        events = []
+        memberships = []
+        event_tag_rows = []
+        for p in prepared:
+            type_id = types[p['event_type']]
+            events.append({
+                'event_id': p['event_id'],
+                'type_id': type_id,
+                'hash': p['hash'],
+                'datetime': p['date'],
+                'time_spent': p['time_spent'],
+                'data': p['data'],
+            })
+            memberships.append({
+                'group_id': groups[(type_id, p['hash'])]['id'],
+                'event_id': p['event_id'],
+            })
+            for tag in p['tags']:
+                event_tag_rows.append({'event_id': p['event_id'],
+                                       'tag_id': tags[tag]})
+        Session.execute(Event.__table__.insert(), events)
+        Session.execute(group_events.insert(), memberships)
+        if event_tag_rows:
+            Session.execute(event_tags.insert(), event_tag_rows)
+
+    def _new_events(self, prepared):
+        """Leave out the events already in the database or earlier in the
+        batch, so that messages delivered or replayed again are recorded
+        once"""
+        events = OrderedDict()
+        for p in prepared:
+            events.setdefault(p['event_id'], p)
+        if events:
+            table = Event.__table__
+            for chunk in _chunks(events):
+                query = Session.execute(select([table.c.event_id]).where(
+                    table.c.event_id.in_(chunk)))
+                for event_id, in query:
+                    del events[event_id]
+        return events.values()
+
+    def _cached(self, cache, keys):
+        """Split ``keys`` into a dict of the values found in ``cache`` and
+        a set of the keys that weren't"""
+        found = {}
+        for key in keys:
+            value = cache.get(key)
+            if value is not None:
+                found[key] = value
+        return found, set(keys).difference(found)
+
+    def _event_type_ids(self, names):
+        """Return a dict of event type ids by name, creating the missing
+        event types"""
+        ids, names = self._cached(caches.event_types, names)
+        def lookup():
+            found = {}
+            for chunk in _chunks(names):
+                found.update(Session.query(
+                    EventType.name, EventType.id).filter(
+                        EventType.name.in_(chunk)))
+            return found
+        if names:
+            found = lookup()
+            missing = names.difference(found)
+            if missing:
+                Session.execute(EventType.__table__.insert(),
+                                [{'name': name} for name in missing])
+                found = lookup()
+            for name, id in found.items():
+                caches.event_types.stage(name, id)
+            ids.update(found)
+        return ids
+
+    def _tag_ids(self, pairs):
+        """Return a dict of tag ids by (name, value), creating the missing
+        tags"""
+        ids, pairs = self._cached(caches.tags, pairs)
+        def lookup(pairs):
+            # Matched on the (name, value) index, a few pairs at a time
+            found = {}
+            for chunk in _chunks(pairs, 100):
+                query = Session.query(Tag.name, Tag.value, Tag.id).filter(
+                    or_(*[and_(Tag.name == name, Tag.value == value)
+                          for name, value in chunk]))
+                for name, value, id in query:
+                    found[(name, value)] = id
+            return found
+        if pairs:
+            found = lookup(pairs)
+            missing = pairs.difference(found)
+            if missing:
+                Session.execute(Tag.__table__.insert(),
+                                [{'name': name, 'value': value}
+                                 for name, value in missing])
+                found.update(lookup(missing))
+            for pair, id in found.items():
+                caches.tags.stage(pair, id)
+            ids.update(found)
+        return ids
+
+    def _groups(self, batch_groups):
+        """Return dicts of the existing groups of the batch by (type id,
+        hash)"""
+        groups, keys = self._cached(caches.groups, batch_groups)
+        if keys:
+            groups.update(self._lookup_groups(keys))
+        return groups
+
+    def _lookup_groups(self, keys):
+        """Read the groups with the given (type id, hash) keys"""
+        table = Group.__table__
+        groups = {}
+        hashes = set(hash for type_id, hash in keys)
+        for chunk in _chunks(hashes):
+            query = Session.execute(select([
+                table.c.id, table.c.type_id, table.c.hash,
+                table.c.count, table.c.first_seen,
+                table.c.last_seen]).where(table.c.hash.in_(chunk)))
+            for row in query:
+                key = (row.type_id, row.hash)
+                if key in keys:
+                    groups[key] = dict(row)
+        return groups
+
+    def coalesce(self, message):
+        """Hold on to a message until the next flush, coalescing it with
+        the others of its group
+
+        Every message is prepared as it's received, so malformed ones fail
+        here like they would without coalescing. The prepared samples are
+        kept for the bulk writer.
+
+        """
+        event_type = message['event_type']
+        summary = message.get('summary')
+        if not summary:
+            if event_type not in event_classes:
+                return
+            if not message.get('hash'):
+                self.record(message)
+                return
+            # Fail on malformed messages now rather than in flush
+            prepared = self.prepare(message)
+        date = parse_date(message['date'])
+        key = (event_type, message['hash'])
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = {
+                'samples': [], 'count': 0, 'first_seen': date,
+                'last_seen': date}
+        if summary:
+            pending['count'] += int(message['suppressed'])
+        elif len(pending['samples']) < max(1, self.coalesce_samples):
+            pending['samples'].append(prepared if self.bulk else message)
+        else:
+            pending['count'] += 1
+            self.coalesced += 1
+        pending['first_seen'] = min(pending['first_seen'], date)
+        pending['last_seen'] = max(pending['last_seen'], date)
+
+    def summary_received(self, message):
+        """Add occurrences suppressed by a client's rate limit to the
+        count of their group"""
+        date = parse_date(message['date'])
+        self.add_occurrences(message['event_type'], message['hash'],
+                             int(message['suppressed']), date, date)
+
+    def add_occurrences(self, event_type, hash, count, first_seen,
+                        last_seen):
+        """Add occurrences that weren't recorded as events to the count
+        of their group
+
+        Summaries don't carry the group message, so occurrences of groups
+        that weren't recorded yet, as when a client dropped the one event
+        it sent, are logged and counted in ``dropped_occurrences``.
+
+        """
+        type_id = caches.event_types.get(event_type)
+        group = None
+        if type_id is None:
+            row = Session.query(EventType).filter_by(name=event_type).first()
+            if row:
+                type_id = row.id
+                caches.event_types.set(event_type, type_id)
+        if type_id is not None:
+            group = Session.query(Group).filter_by(
+                type_id=type_id, hash=hash).first()
+        if not group:
+            log.warning("Dropped %d occurrences of unknown %s group %s",
+                        count, event_type, hash)
+            self.dropped_occurrences += count
+            return
+        caches.groups.discard((type_id, hash))
+        group.first_seen = min(group.first_seen, first_seen)
+        group.last_seen = max(group.last_seen, last_seen)
+        group.score = _logaddexp_sql(Group.score,
+                                     _score(None, count, last_seen))
+        group.count = Group.count + count
+
+    def cache_stats(self):
+        """Hits, misses and sizes of the identity caches"""
+        return caches.stats()
+
+    def pending_objects(self):
+        """Number of new and changed objects the next flush will write"""
+        return (len(Session.new) + len(Session.dirty) + len(self._pending) +
+                len(self._batch) + len(self._summaries))
+
     def flush(self):
-        Session.commit()
-        Session.remove()
+        """Write the pending messages and commit them
+
+        When writing fails, the transaction is rolled back, which clears
+        the identity caches, and the pending messages are dropped before
+        the error is raised again.
+
+        """
+        pending, self._pending = self._pending, OrderedDict()
+        summaries, self._summaries = self._summaries, []
+        try:
+            for coalesced in pending.values():
+                if self.bulk:
+                    self._batch.extend(coalesced['samples'])
+                else:
+                    for message in coalesced['samples']:
+                        self.record(message)
+            batch, self._batch = self._batch, []
+            self.write_batch(batch)
+            for message in summaries:
+                self.summary_received(message)
+            for (event_type, hash), coalesced in pending.items():
+                if coalesced['count']:
+                    self.add_occurrences(event_type, hash,
+                                         coalesced['count'],
+                                         coalesced['first_seen'],
+                                         coalesced['last_seen'])
+            Session.commit()
+        except:
+            self._batch = []
+            Session.rollback()
+            raise
+        finally:
+            Session.remove()
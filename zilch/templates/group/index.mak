@@ -1,4 +1,10 @@
+% if sort == 'hot':
+<h1>Hottest Grouped Events</h1>
+<p><a href="${request.resource_url(request.context)}">Most recent</a></p>
+% else:
 <h1>Recent Grouped Events</h1>
+<p><a href="${request.resource_url(request.context, query={'sort': 'hot'})}">Hottest</a></p>
+% endif
 
 <section>
     <table width="100%">
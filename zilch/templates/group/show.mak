@@ -17,7 +17,11 @@
     % endfor
 </select></p>
 
+% if 'frames' in event.data:
 ${display_httpexception(event)}
+% else:
+${display_log(event)}
+% endif
 
 <%def name="javascript()">
 ${parent.javascript()}
@@ -80,6 +84,30 @@ ${event.data['traceback'].strip()}
     </div>
 </section>
 </%def>
+<%def name="display_log(event)">
+<section class="log">
+    <div class="tags">
+    % for tag in sorted(event.tags, key=lambda v: v.name):
+        <div class="tag"><mark span="name">${tag.name}</mark><em>${tag.value}</em></div>
+    % endfor
+    </div>
+    <div class="message">
+        <h2>${event.data.get('logger')}</h2>
+        <pre>${event.data.get('message')}</pre>
+        <p><cite class="module">${event.data.get('filename')}</cite>:
+            <em class="line">${event.data.get('lineno')}</em>,
+            in <code class="function">${event.data.get('function')}</code></p>
+    </div>
+    % if event.data.get('traceback'):
+    <div class="plain_traceback">
+        <h2>Plaintext Traceback</h2>
+        <pre>
+${event.data['traceback'].strip()}
+</pre>
+    </div>
+    % endif
+</section>
+</%def>
 <%def name="full_traceback(frames)">
 <div class="traceback-frames">
 <% 
@@ -99,7 +127,12 @@ ${event.data['traceback'].strip()}
             <pre class="around">${'\n'.join(frame.get('with_context', '').split('\n')[6:][:3])}</pre>
         </div>
         <div class="localvars">
+        % if frame.get('vars_omitted') == 'True':
+            <h4>Local Variables</h4>
+            <p class="omitted">Local variables were not captured for this frame.</p>
+        % else:
             ${display_table('Local Variables', ('Variable', 'Value'), frame['vars'], 4)}
+        % endif
         </div>
     </div>
 % endfor
@@ -1,4 +1,5 @@
 # coding: utf-8
+import os
 import unittest
 
 from nose.tools import eq_
@@ -20,14 +21,16 @@ class TestSend(unittest.TestCase):
             mock_socket = Mock()
             mock.return_value = mock_socket
             send = self._makeOne()
-            with client_recorder('localhost'):
-                send(
-                    test='data', 
-                    uni = u"\u0644\u064a\u0647\u0645\u0627",
-                    set_of_stuff = set(['a string', 'another string'])
-                )
+            with patch('zilch.client.release_socket') as mock_release:
+                with client_recorder('localhost'):
+                    send(
+                        test='data', 
+                        uni = u"\u0644\u064a\u0647\u0645\u0627",
+                        set_of_stuff = set(['a string', 'another string'])
+                    )
             eq_(mock.call_count, 1)
             eq_(mock_socket.method_calls[0][0], 'send')
+            eq_(mock_release.call_args[0][0], mock_socket)
     
     def test_send_with_store(self):
         mock_store = Mock()
@@ -42,6 +45,15 @@ class TestGetSocket(unittest.TestCase):
         from zilch.client import get_socket
         return get_socket
     
+    def setUp(self):
+        import zilch.client
+        self._prior_pool = zilch.client._socket_pool
+        zilch.client._socket_pool = None
+    
+    def tearDown(self):
+        import zilch.client
+        zilch.client._socket_pool = self._prior_pool
+    
     def test_get_socket(self):
         with patch('zmq.Context') as mock:
             mock_context = Mock()
@@ -51,6 +63,51 @@ class TestGetSocket(unittest.TestCase):
             with client_recorder('localhost'):
                 sock = get_sock()
             eq_(mock_context.method_calls[0][0], 'socket')
+    
+    def test_sockets_are_reused(self):
+        from zilch.client import release_socket
+        with patch('zmq.Context') as mock:
+            mock_context = Mock()
+            mock.return_value = mock_context
+            get_sock = self._makeOne()
+            
+            with client_recorder('localhost'):
+                sock = get_sock()
+                release_socket(sock)
+                eq_(get_sock(), sock)
+                get_sock()
+            eq_(mock.call_count, 1)
+            eq_(mock_context.socket.call_count, 2)
+    
+    def test_pool_size_is_capped(self):
+        import threading
+        from zilch.client import SocketPool
+        from zilch.exc import DeliveryError
+        with patch('zmq.Context') as mock:
+            mock_context = mock.return_value
+            pool = SocketPool('localhost', size=1, max_size=1, timeout=0.05)
+            sock = pool.checkout()
+            self.assertRaises(DeliveryError, pool.checkout)
+            # A waiting thread gets the socket once it's checked in
+            checked_out = []
+            thread = threading.Thread(
+                target=lambda: checked_out.append(pool.checkout()))
+            pool.timeout = 5
+            thread.start()
+            pool.checkin(sock)
+            thread.join(5)
+            eq_(checked_out, [sock])
+            eq_(mock_context.socket.call_count, 1)
+    
+    def test_new_pool_after_fork(self):
+        import zilch.client
+        with patch('zmq.Context') as mock:
+            with client_recorder('localhost'):
+                pool = zilch.client.get_pool()
+                eq_(zilch.client.get_pool(), pool)
+                pool.pid = -1
+                assert zilch.client.get_pool() is not pool
+            eq_(mock.call_count, 2)
 
 
 class TestCapture(unittest.TestCase):
@@ -74,3 +131,397 @@ class TestCapture(unittest.TestCase):
             last_frame = kwargs['data']['frames'][-1]
             eq_(last_frame['function'], 'test_capture_exc')
             eq_(last_frame['module'], 'zilch.tests.test_client')
+
+
+class TestBackgroundSender(unittest.TestCase):
+    def _makeOne(self, deliver, **kwargs):
+        from zilch.client import BackgroundSender
+        return BackgroundSender(deliver, **kwargs)
+    
+    def _blocked_sender(self, **kwargs):
+        import threading
+        started = threading.Event()
+        release = threading.Event()
+        delivered = []
+        def deliver(messages):
+            started.set()
+            release.wait()
+            delivered.append(messages)
+        sender = self._makeOne(deliver, maxsize=2, batch_size=10, **kwargs)
+        sender.put('first')
+        started.wait(1)
+        return sender, release, delivered
+    
+    def test_flush_delivers_batches(self):
+        mock_store = Mock()
+        from zilch.client import deliver
+        sender = self._makeOne(deliver, batch_size=10)
+        with client_store(mock_store):
+            for i in range(5):
+                sender.put({'event_type': 'Exception'})
+            eq_(sender.flush(timeout=1), True)
+        eq_(sender.delivered, 5)
+        received = [c for c in mock_store.method_calls
+                    if c[0] == 'message_received']
+        eq_(len(received), 5)
+    
+    def test_drop_newest(self):
+        sender, release, delivered = self._blocked_sender()
+        sender.put('second')
+        sender.put('third')
+        eq_(sender.put('fourth'), False)
+        eq_(sender.dropped, 1)
+        release.set()
+        eq_(sender.flush(timeout=1), True)
+        eq_(delivered, [['first'], ['second', 'third']])
+    
+    def test_drop_oldest(self):
+        from zilch.client import DROP_OLDEST
+        sender, release, delivered = self._blocked_sender(overflow=DROP_OLDEST)
+        sender.put('second')
+        sender.put('third')
+        eq_(sender.put('fourth'), True)
+        eq_(sender.dropped, 1)
+        release.set()
+        eq_(sender.flush(timeout=1), True)
+        eq_(delivered, [['first'], ['third', 'fourth']])
+    
+    def test_block_times_out(self):
+        from zilch.client import BLOCK
+        sender, release, delivered = self._blocked_sender(overflow=BLOCK,
+                                                          timeout=0.01)
+        sender.put('second')
+        sender.put('third')
+        eq_(sender.put('fourth'), False)
+        eq_(sender.flush(timeout=0.01), False)
+        release.set()
+        eq_(sender.flush(timeout=1), True)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def _makeOne(self, *args, **kwargs):
+        from zilch.client import RateLimiter
+        return RateLimiter(*args, **kwargs)
+    
+    def test_burst_then_suppress(self):
+        limiter = self._makeOne(1, burst=2, interval=60)
+        key = ('Exception', 'abc')
+        eq_(limiter.allow(key, now=100), True)
+        eq_(limiter.allow(key, now=100), True)
+        eq_(limiter.allow(key, now=100), False)
+        eq_(limiter.allow(key, now=100.5), False)
+        eq_(limiter.allow(key, now=101.5), True)
+        eq_(limiter.suppressed, 2)
+    
+    def test_summaries(self):
+        limiter = self._makeOne(1, burst=1, interval=60)
+        key = ('Exception', 'abc')
+        limiter.allow(key, now=100)
+        limiter.allow(key, now=100)
+        eq_(limiter.summaries(now=100), [])
+        eq_(limiter.summaries(now=100, force=True), [(key, 1)])
+        eq_(limiter.summaries(now=100, force=True), [])
+    
+    def test_capture_suppressed(self):
+        import zilch.client
+        prior = zilch.client.rate_limit, zilch.client._limiter
+        zilch.client.rate_limit = 0.001
+        zilch.client._limiter = self._makeOne(0.001, burst=1, interval=60)
+        try:
+            with patch('zilch.client.send') as mock_send:
+                for i in range(3):
+                    try:
+                        fred = smith['no_name']
+                    except:
+                        zilch.client.capture_exception()
+                eq_(mock_send.call_count, 1)
+                zilch.client.send_summaries(force=True)
+                kwargs = mock_send.call_args[1]
+                eq_(kwargs['suppressed'], 2)
+                eq_(kwargs['summary'], True)
+        finally:
+            zilch.client.rate_limit, zilch.client._limiter = prior
+    
+    def test_summaries_sent_periodically(self):
+        import time
+        import zilch.client
+        prior = (zilch.client._limiter, zilch.client._summary_pid,
+                 zilch.client.summary_interval)
+        zilch.client.summary_interval = 0.01
+        zilch.client._limiter = limiter = self._makeOne(0.001, burst=1,
+                                                        interval=0.01)
+        # As if the thread had been started before a fork
+        zilch.client._summary_pid = -1
+        try:
+            with patch('zilch.client.send') as mock_send:
+                eq_(zilch.client.get_limiter(), limiter)
+                limiter.allow(('Exception', 'a'))
+                limiter.allow(('Exception', 'a'))
+                for i in range(100):
+                    if mock_send.call_count:
+                        break
+                    time.sleep(0.01)
+            eq_(mock_send.call_args[1]['suppressed'], 1)
+            eq_(zilch.client._summary_pid, os.getpid())
+        finally:
+            (zilch.client._limiter, zilch.client._summary_pid,
+             zilch.client.summary_interval) = prior
+
+
+class TestCapturePolicy(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from zilch.client import CapturePolicy
+        return CapturePolicy(**kwargs)
+    
+    def _capture(self, policy):
+        import zilch.client
+        prior = zilch.client.capture_policy
+        zilch.client.capture_policy = policy
+        try:
+            with patch('zilch.client.send') as mock_send:
+                password = 'hunter2'
+                try:
+                    fred = smith['no_name']
+                except:
+                    zilch.client.capture_exception()
+                return mock_send.call_args[1]['data']['frames']
+        finally:
+            zilch.client.capture_policy = prior
+    
+    def test_innermost(self):
+        from zilch.client import CapturePolicy
+        frames = self._capture(self._makeOne(frames=CapturePolicy.INNERMOST,
+                                             innermost=1))
+        eq_(frames[-1]['vars']['password'], 'hunter2')
+        eq_('vars_omitted' in frames[-1], False)
+        frames = self._capture(self._makeOne(frames=CapturePolicy.INNERMOST,
+                                             innermost=0))
+        eq_(frames[-1]['vars'], {})
+        eq_(frames[-1]['vars_omitted'], 'True')
+    
+    def test_include_exclude(self):
+        frames = self._capture(self._makeOne(include=['password', 'self'],
+                                             exclude=['password']))
+        eq_(sorted(frames[-1]['vars'].keys()), ['password', 'self'])
+        eq_(frames[-1]['vars']['password'], '********')
+    
+    def test_frame_budget(self):
+        policy = self._makeOne(max_frame_bytes=10)
+        captured = policy.capture_locals({'a': 'x' * 20, 'b': 'y' * 20})
+        eq_(len(captured), 2)
+        assert '(size limit reached)' in captured.values()
+    
+    def test_wants_locals(self):
+        from zilch.client import CapturePolicy
+        frame = Mock()
+        frame.visible = False
+        eq_(self._makeOne().wants_locals(frame, 3), True)
+        eq_(self._makeOne(frames=CapturePolicy.VISIBLE).wants_locals(frame, 0),
+            False)
+        policy = self._makeOne(frames=CapturePolicy.INNERMOST, innermost=2)
+        eq_([policy.wants_locals(frame, depth) for depth in range(3)],
+            [True, True, False])
+
+
+class TestBatchedSend(unittest.TestCase):
+    def test_deliver_batch(self):
+        import zilch.client
+        from zilch.codec import decode_batch
+        messages = [{'event_type': 'Exception', 'hash': str(i)}
+                    for i in range(3)]
+        mock_socket = Mock()
+        prior = zilch.client.batch_messages
+        zilch.client.batch_messages = True
+        try:
+            with patch('zilch.client.get_socket') as mock_get:
+                mock_get.return_value = mock_socket
+                with patch('zilch.client.release_socket'):
+                    with client_recorder('localhost'):
+                        zilch.client.deliver(messages)
+        finally:
+            zilch.client.batch_messages = prior
+        eq_(mock_socket.send.call_count, 1)
+        eq_(decode_batch(mock_socket.send.call_args[0][0]), messages)
+    
+    def test_window_collects_messages(self):
+        import time
+        from zilch.client import BackgroundSender
+        delivered = []
+        sender = BackgroundSender(delivered.append, window=0.2)
+        sender.put('first')
+        time.sleep(0.05)
+        sender.put('second')
+        eq_(sender.flush(timeout=1), True)
+        eq_(delivered, [['first', 'second']])
+
+
+class TestHTTPDelivery(unittest.TestCase):
+    def test_posts_to_recorder_url(self):
+        import zilch.client
+        messages = [{'event_type': 'Exception', 'hash': 'a'}]
+        prior = zilch.client.recorder_url
+        zilch.client.recorder_url = 'http://localhost:8001/events'
+        try:
+            with patch('zilch.client.get_http_sender') as mock_get:
+                zilch.client.send(**messages[0])
+        finally:
+            zilch.client.recorder_url = prior
+        mock_get.return_value.send.assert_called_with(messages)
+    
+    def test_error_response(self):
+        from zilch.client import HTTPSender
+        from zilch.exc import DeliveryError
+        sender = HTTPSender('http://localhost:8001/events')
+        connection = Mock()
+        connection.getresponse.return_value.status = 503
+        sender._local.connection = connection
+        self.assertRaises(DeliveryError, sender.send, [{}])
+        eq_(connection.request.call_args[0][:2], ('POST', '/events'))
+        # The connection isn't reused after an error
+        eq_(connection.close.call_count, 1)
+        eq_(sender._local.connection, None)
+
+
+class TestSpoolReplayer(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from zilch.spool import Spool
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory + '/test.spool', size=4096)
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+    
+    def _makeOne(self):
+        from zilch.client import SpoolReplayer
+        # Replay from the test only, not from the daemon thread
+        with patch('zilch.client.threading.Thread'):
+            return SpoolReplayer(self.spool, interval=60)
+    
+    def test_spools_when_recorder_is_full(self):
+        replayer = self._makeOne()
+        mock_socket = Mock()
+        mock_socket.send.side_effect = zmq.ZMQError(zmq.EAGAIN)
+        replayer.send(mock_socket, 'first')
+        eq_(len(self.spool), 1)
+        
+        replay_socket = Mock()
+        with patch('zilch.client.get_socket') as mock_get:
+            mock_get.return_value = replay_socket
+            with patch('zilch.client.release_socket'):
+                # Later messages queue up behind the spooled ones
+                replayer.send(mock_socket, 'second')
+                eq_(mock_socket.send.call_count, 1)
+                replayer.replay()
+        eq_([c[0][0] for c in replay_socket.send.call_args_list],
+            ['first', 'second'])
+        eq_(len(self.spool), 0)
+        eq_(self.spool.replayed, 2)
+    
+    def test_lock_spool(self):
+        from zilch.client import lock_spool
+        first, first_fd = lock_spool(self.directory)
+        second, second_fd = lock_spool(self.directory)
+        eq_(os.path.basename(first), 'zilch-0.spool')
+        eq_(os.path.basename(second), 'zilch-1.spool')
+        # The spool of a process that exited is reused
+        os.close(first_fd)
+        path, fd = lock_spool(self.directory)
+        eq_(path, first)
+        os.close(fd)
+        os.close(second_fd)
+    
+    def test_adopts_spool_left_behind(self):
+        import zilch.client
+        from zilch.spool import Spool
+        Spool(self.directory + '/zilch-0.spool', size=4096).append('left')
+        prior = (zilch.client.spool_directory, zilch.client.spool_size,
+                 zilch.client._replayer, zilch.client._spool_fd)
+        zilch.client.spool_directory = self.directory
+        zilch.client.spool_size = 4096
+        zilch.client._replayer = zilch.client._spool_fd = None
+        try:
+            with patch('zilch.client.threading.Thread'):
+                replayer = zilch.client.get_replayer()
+            eq_(replayer.spool.peek(), 'left')
+        finally:
+            os.close(zilch.client._spool_fd)
+            (zilch.client.spool_directory, zilch.client.spool_size,
+             zilch.client._replayer, zilch.client._spool_fd) = prior
+
+
+class TestZilchHandler(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from zilch.client import ZilchHandler
+        return ZilchHandler(**kwargs)
+    
+    def _makeRecord(self, name, msg, *args):
+        import logging
+        return logging.LogRecord(name, logging.WARNING, __file__, 10, msg,
+                                 args, None, func='test')
+    
+    def test_sends_log_events(self):
+        from zilch.utils import log_hash
+        handler = self._makeOne()
+        with patch('zilch.client.send') as mock_send:
+            handler.emit(self._makeRecord('app.db', 'Slow query: %s', 42))
+            eq_(handler.flush(timeout=1), True)
+        kwargs = mock_send.call_args[1]
+        eq_(kwargs['event_type'], 'Log')
+        eq_(kwargs['data']['message'], 'Slow query: 42')
+        eq_(kwargs['data']['template'], 'Slow query: %s')
+        eq_(kwargs['hash'], log_hash('app.db', 'Slow query: %s'))
+    
+    def test_ignores_own_records(self):
+        handler = self._makeOne()
+        with patch('zilch.client.send') as mock_send:
+            handler.emit(self._makeRecord('zilch.client', 'Failed'))
+            eq_(handler.flush(timeout=1), True)
+        eq_(mock_send.call_count, 0)
+    
+    def test_drops_when_full(self):
+        import threading
+        handler = self._makeOne(queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        def blocked(record):
+            started.set()
+            release.wait()
+        with patch.object(handler, 'send_record') as mock_send:
+            mock_send.side_effect = blocked
+            handler.emit(self._makeRecord('app', 'sending'))
+            started.wait(1)
+            handler.emit(self._makeRecord('app', 'queued'))
+            handler.emit(self._makeRecord('app', 'dropped'))
+            release.set()
+            eq_(handler.flush(timeout=1), True)
+        eq_(handler.dropped, 1)
+        eq_(mock_send.call_count, 2)
+    
+    def test_restarts_after_fork(self):
+        handler = self._makeOne()
+        thread = handler._thread
+        # As if the handler had been created before a fork
+        handler.pid = -1
+        queue = handler.queue
+        with patch('zilch.client.send') as mock_send:
+            handler.emit(self._makeRecord('app', 'from the child'))
+            eq_(handler.flush(timeout=1), True)
+        assert handler._thread is not thread
+        assert handler.queue is not queue
+        eq_(handler.pid, os.getpid())
+        eq_(mock_send.call_args[1]['data']['message'], 'from the child')
+    
+    def test_flush_is_bounded(self):
+        import threading
+        import time
+        handler = self._makeOne(flush_timeout=0.05)
+        release = threading.Event()
+        with patch.object(handler, 'send_record') as mock_send:
+            mock_send.side_effect = lambda record: release.wait()
+            handler.emit(self._makeRecord('app', 'stuck'))
+            start = time.time()
+            eq_(handler.flush(), False)
+            assert time.time() - start < 1
+            release.set()
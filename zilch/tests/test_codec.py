@@ -0,0 +1,102 @@
+# coding: utf-8
+import unittest
+
+from nose.tools import eq_
+
+
+class TestCodec(unittest.TestCase):
+    def _message(self):
+        return {
+            'event_type': 'Exception',
+            'hash': 'abc',
+            'tags': [['Hostname', 'localhost']],
+            'data': {'frames': [{'function': 'test', 'vars': {'uni': u'لي'}}],
+                     'traceback': 'Traceback (most recent call last):\n'},
+            'time_spent': None,
+        }
+    
+    def test_roundtrip(self):
+        from zilch import codec
+        message = self._message()
+        for format in (codec.LEGACY, codec.JSON, codec.JSON_DICT):
+            eq_(codec.decode(codec.encode(message, format)), message)
+        decoded = codec.decode(codec.encode(message, codec.MARSHAL))
+        eq_(decoded['data'], message['data'])
+    
+    def test_allowed_formats(self):
+        from zilch import codec
+        from zilch.exc import DecodeError
+        message = self._message()
+        for format in (codec.LEGACY, codec.JSON, codec.JSON_DICT):
+            eq_(codec.decode(codec.encode(message, format),
+                             codec.SAFE_FORMATS), message)
+        payload = codec.encode(message, codec.MARSHAL)
+        self.assertRaises(DecodeError, codec.decode, payload,
+                          codec.SAFE_FORMATS)
+        self.assertRaises(DecodeError, codec.decode_batch, payload,
+                          codec.SAFE_FORMATS)
+        batch = codec.encode_batches([message] * 2, codec.MARSHAL)[0]
+        self.assertRaises(DecodeError, codec.decode_batch, batch,
+                          codec.SAFE_FORMATS)
+        self.assertRaises(DecodeError, codec.decode, codec.encode(message),
+                          [codec.JSON])
+    
+    def test_legacy_messages(self):
+        from zilch import codec
+        from zilch.utils import dumps
+        message = self._message()
+        eq_(codec.decode(dumps(message).encode('zlib')), message)
+    
+    def test_marshal_falls_back_to_json(self):
+        import datetime
+        from zilch import codec
+        payload = codec.encode({'date': datetime.date(2012, 1, 13)},
+                               codec.MARSHAL)
+        eq_(ord(payload[0]), codec.JSON_DICT)
+        eq_(codec.decode(payload), {'date': '2012-01-13'})
+    
+    def test_preset_dictionary_compresses_better(self):
+        from zilch import codec
+        message = self._message()
+        assert len(codec.encode(message, codec.JSON_DICT)) < \
+               len(codec.encode(message, codec.JSON))
+    
+    def test_decode_errors(self):
+        from zilch import codec
+        from zilch.exc import DecodeError
+        for payload in ('', '\x7fjunk', '\x02junk', '\x78junk'):
+            self.assertRaises(DecodeError, codec.decode, payload)
+
+
+class TestBatches(unittest.TestCase):
+    def _messages(self, count):
+        return [{'event_type': 'Exception', 'hash': str(i),
+                 'data': {'frames': [{'vars': {'i': str(i)}}]}}
+                for i in range(count)]
+    
+    def test_roundtrip(self):
+        from zilch import codec
+        messages = self._messages(5)
+        for format in (codec.LEGACY, codec.JSON, codec.JSON_DICT,
+                       codec.MARSHAL):
+            payloads = codec.encode_batches(messages, format)
+            eq_(len(payloads), 1)
+            eq_(codec.decode_batch(payloads[0]), messages)
+    
+    def test_split_by_size(self):
+        from zilch import codec
+        messages = self._messages(10)
+        for format in (codec.JSON, codec.MARSHAL):
+            payloads = codec.encode_batches(messages, format, max_bytes=200)
+            assert len(payloads) > 1
+            decoded = []
+            for payload in payloads:
+                decoded.extend(codec.decode_batch(payload))
+            eq_(decoded, messages)
+    
+    def test_single_messages(self):
+        from zilch import codec
+        message = self._messages(1)[0]
+        eq_(codec.decode_batch(codec.encode(message)), [message])
+        eq_(codec.decode_batch(codec.encode(message, codec.MARSHAL)),
+            [message])
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import eq_
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def _makeOne(self, **kwargs):
+        from zilch.journal import Journal
+        return Journal(self.directory, **kwargs)
+    
+    def test_append_and_read(self):
+        journal = self._makeOne()
+        for message in ['first', 'second', 'third']:
+            journal.append(message)
+        journal.flush()
+        read = journal.read((0, 0))
+        eq_([message for position, message in read],
+            ['first', 'second', 'third'])
+        eq_(read[-1][0], journal.position)
+        eq_([m for p, m in journal.read(read[0][0], limit=1)], ['second'])
+    
+    def test_rotates_and_removes_read_segments(self):
+        journal = self._makeOne(segment_size=20)
+        for i in range(6):
+            journal.append('message %d' % i)
+        journal.flush()
+        eq_(journal.segments(), [0, 1, 2])
+        read = journal.read((0, 0), limit=4)
+        eq_([m for p, m in read], ['message %d' % i for i in range(4)])
+        journal.commit(read[-1][0])
+        eq_(journal.segments(), [1, 2])
+        eq_([m for p, m in journal.read(read[-1][0])],
+            ['message 4', 'message 5'])
+    
+    def test_reopen_continues_from_checkpoint(self):
+        journal = self._makeOne()
+        journal.append('flushed')
+        journal.append('not flushed')
+        journal.flush()
+        journal.commit(journal.read((0, 0), limit=1)[0][0])
+        journal.close()
+        
+        journal = self._makeOne()
+        eq_([m for p, m in journal.read(journal.checkpoint)],
+            ['not flushed'])
+    
+    def test_truncated_record_is_cut_off(self):
+        journal = self._makeOne()
+        journal.append('complete')
+        journal.flush()
+        journal.close()
+        with open(os.path.join(self.directory, '%012d.seg' % 0), 'ab') as f:
+            f.write('\x20\x00\x00\x00\x00\x00\x00\x00trunc')
+        
+        journal = self._makeOne()
+        journal.append('after crash')
+        journal.flush()
+        eq_([m for p, m in journal.read((0, 0))], ['complete', 'after crash'])
@@ -0,0 +1,468 @@
+import marshal
+import os
+import signal
+import unittest
+import zlib
+
+from nose.tools import eq_
+from mock import Mock
+
+import zmq
+
+
+class TestRecorder(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.bind = 'ipc://%s/recorder' % self.directory
+        self.handlers = [(s, signal.getsignal(s)) for s in
+                         (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1)]
+    
+    def tearDown(self):
+        import shutil
+        for signum, handler in self.handlers:
+            signal.signal(signum, handler)
+        if not self.recorder._context.closed:
+            if self.recorder.http_server is not None:
+                self.recorder.http_server.close()
+            self.recorder.sock.close()
+            self.recorder._context.term()
+        shutil.rmtree(self.directory)
+    
+    def _makeOne(self, **kwargs):
+        from zilch.recorder import Recorder
+        self.store = Mock()
+        self.recorder = Recorder(zeromq_bind=self.bind, store=self.store,
+                                 **kwargs)
+        return self.recorder
+    
+    def _send(self, messages):
+        from zilch.codec import encode
+        context = zmq.Context()
+        sock = context.socket(zmq.PUSH)
+        sock.connect(self.bind)
+        for message in messages:
+            sock.send(encode(message))
+        sock.close(linger=1000)
+        context.term()
+    
+    def _stopOnFlush(self, recorder):
+        def flush():
+            recorder.running = False
+        self.store.flush.side_effect = flush
+    
+    def test_flush_on_count(self):
+        recorder = self._makeOne(flush_count=3, flush_interval=60)
+        self._stopOnFlush(recorder)
+        self._send([{'hash': str(i)} for i in range(3)])
+        recorder.main_loop()
+        eq_(self.store.message_received.call_count, 3)
+        eq_(self.store.flush.call_count, 1)
+        eq_(recorder.pending, 0)
+    
+    def test_flush_on_bytes(self):
+        recorder = self._makeOne(flush_bytes=1, flush_interval=60)
+        self._stopOnFlush(recorder)
+        self._send([{'hash': 'a'}])
+        recorder.main_loop()
+        eq_(self.store.flush.call_count, 1)
+    
+    def test_flush_on_interval(self):
+        import time
+        recorder = self._makeOne(flush_interval=0.1)
+        self._stopOnFlush(recorder)
+        self._send([{'hash': 'a'}, {'hash': 'b'}])
+        start = time.time()
+        recorder.main_loop()
+        eq_(self.store.message_received.call_count, 2)
+        eq_(self.store.flush.call_count, 1)
+        assert time.time() - start < 2
+    
+    def test_decode_threads_keep_order(self):
+        recorder = self._makeOne(flush_count=50, flush_interval=60,
+                                 decode_threads=3, decode_chunk=4,
+                                 decode_ahead=2)
+        self._stopOnFlush(recorder)
+        self._send([{'hash': str(i)} for i in range(50)])
+        recorder.main_loop()
+        recorder.pool.close()
+        eq_([c[0][0]['hash'] for c in self.store.message_received.call_args_list],
+            [str(i) for i in range(50)])
+    
+    def test_quarantines_malformed_messages(self):
+        from zilch.codec import encode
+        from zilch.recorder import read_dead_letters
+        dead_letter = os.path.join(self.directory, 'dead')
+        recorder = self._makeOne(flush_count=3, flush_interval=60,
+                                 dead_letter=dead_letter)
+        self._stopOnFlush(recorder)
+        def message_received(data):
+            if data['hash'] == 'bad':
+                raise KeyError('date')
+        self.store.message_received.side_effect = message_received
+        context = zmq.Context()
+        sock = context.socket(zmq.PUSH)
+        sock.connect(self.bind)
+        sock.send('\x01not zlib')
+        sock.send(encode({'hash': 'bad'}))
+        sock.send(encode({'hash': 'good'}))
+        sock.close(linger=1000)
+        context.term()
+        recorder.main_loop()
+        eq_(recorder.quarantined, 2)
+        eq_(self.store.message_received.call_count, 2)
+        payloads = [payload for timestamp, payload in
+                    read_dead_letters(dead_letter)]
+        eq_(payloads[0], '\x01not zlib')
+        eq_(len(payloads), 2)
+    
+    def test_quarantines_events_the_store_rejects(self):
+        from zilch.store import Event
+        from zilch.store import Session
+        from zilch.store import SQLAlchemyStore
+        recorder = self._makeOne()
+        recorder.store = SQLAlchemyStore('sqlite://')
+        messages = []
+        for i, hash in enumerate(['a', None, 'b']):
+            messages.append({
+                'event_type': 'Log', 'event_id': '%032d' % i,
+                'time_spent': None, 'hash': hash,
+                'date': '2011-10-01T12:00:%02d.000000' % i,
+                'data': {'message': 'Slow', 'logger': 'app',
+                         'template': 'Slow'}})
+        try:
+            recorder.record(messages, 100)
+            recorder.flush()
+            eq_(recorder.quarantined, 1)
+            eq_(sorted(e.hash for e in Session.query(Event)), ['a', 'b'])
+        finally:
+            Session.remove()
+    
+    def test_rejects_marshal_by_default(self):
+        from zilch import codec
+        recorder = self._makeOne()
+        payload = codec.encode({'hash': 'a'}, codec.MARSHAL)
+        eq_(recorder.decode_message(payload), [])
+        eq_(recorder.quarantined, 1)
+    
+    def test_allows_trusted_formats(self):
+        from zilch import codec
+        recorder = self._makeOne(
+            allowed_formats=codec.SAFE_FORMATS | set([codec.MARSHAL]))
+        payload = codec.encode({'hash': 'a'}, codec.MARSHAL)
+        eq_(recorder.decode_message(payload), [{'hash': 'a'}])
+    
+    def test_stats(self):
+        from zilch.utils import loads
+        stats_bind = 'ipc://%s/stats' % self.directory
+        recorder = self._makeOne(flush_count=3, flush_interval=60,
+                                 stats_bind=stats_bind)
+        self._stopOnFlush(recorder)
+        self.store.pending_objects.return_value = 0
+        self.store.cache_stats.return_value = {}
+        self._send([{'hash': 'a', 'event_type': 'Exception'},
+                    {'hash': 'b', 'event_type': 'Log'},
+                    {'hash': 'c', 'event_type': 'Log'},
+                    {'hash': 'd', 'event_type': 'Log'}])
+        recorder.main_loop()
+        
+        context = zmq.Context()
+        sock = context.socket(zmq.REQ)
+        sock.connect(stats_bind)
+        try:
+            sock.send('stats')
+            recorder.stats_sock.poll(1000)
+            recorder.answer_stats()
+            stats = loads(sock.recv())
+        finally:
+            sock.close(linger=0)
+            context.term()
+            recorder.stats_sock.close()
+        eq_(stats['flushes'], 1)
+        eq_(stats['flush_seconds']['count'], 1)
+        eq_(stats['pending_messages'], stats['messages'] - 3)
+        eq_(stats['event_types']['Exception'], 1)
+        eq_(stats['events'], stats['messages'])
+        eq_(stats['pending_objects'], 0)
+        eq_(stats['caches'], {})
+    
+    def test_journal_replays_unflushed_messages(self):
+        from zilch.codec import encode
+        from zilch.journal import Journal
+        directory = os.path.join(self.directory, 'journal')
+        journal = Journal(directory)
+        journal.append(encode({'hash': 'before restart'}))
+        journal.flush()
+        journal.close()
+        
+        recorder = self._makeOne(flush_count=2, flush_interval=60,
+                                 journal_directory=directory,
+                                 poll_timeout=0.05)
+        self._stopOnFlush(recorder)
+        self._send([{'hash': 'after restart'}])
+        recorder.main_loop()
+        recorder.stop_ingest()
+        eq_([c[0][0]['hash'] for c in self.store.message_received.call_args_list],
+            ['before restart', 'after restart'])
+        eq_(recorder.journal.checkpoint, recorder.journal.position)
+        eq_(Journal(directory).read(recorder.journal.checkpoint), [])
+    
+    def test_journal_ingest_retries_failed_flushes(self):
+        directory = os.path.join(self.directory, 'journal')
+        recorder = self._makeOne(flush_count=2, flush_interval=60,
+                                 journal_directory=directory,
+                                 poll_timeout=0.05)
+        recorder.ingest_retry_delay = 0.01
+        flushes = []
+        def flush():
+            flushes.append(1)
+            if len(flushes) == 1:
+                raise ValueError("database is gone")
+            recorder.running = False
+        self.store.flush.side_effect = flush
+        self._send([{'hash': 'a'}, {'hash': 'b'}])
+        recorder.main_loop()
+        recorder.stop_ingest()
+        eq_([c[0][0]['hash'] for c in self.store.message_received.call_args_list],
+            ['a', 'b', 'a', 'b'])
+        eq_(len(flushes), 2)
+        eq_(recorder.stopping, False)
+        eq_(recorder.journal.checkpoint, recorder.journal.position)
+    
+    def test_journal_ingest_quarantines_poison_messages(self):
+        directory = os.path.join(self.directory, 'journal')
+        recorder = self._makeOne(flush_count=10, flush_interval=0.05,
+                                 journal_directory=directory,
+                                 dead_letter=os.path.join(self.directory,
+                                                          'dead'),
+                                 poll_timeout=0.05)
+        recorder.ingest_retry_delay = 0.01
+        received = []
+        recorded = []
+        self.store.message_received.side_effect = \
+            lambda message: received.append(message['hash'])
+        def flush():
+            batch = received[:]
+            del received[:]
+            if 'poison' in batch:
+                raise ValueError("can't write %r" % batch)
+            recorded.extend(batch)
+            if 'e' in recorded:
+                recorder.running = False
+        self.store.flush.side_effect = flush
+        self._send([{'hash': 'a'}, {'hash': 'poison'}, {'hash': 'b'},
+                    {'hash': 'c'}, {'hash': 'd'}, {'hash': 'e'}])
+        recorder.main_loop()
+        recorder.stop_ingest()
+        eq_(recorded, ['a', 'b', 'c', 'd', 'e'])
+        eq_(recorder.quarantined, 1)
+        from zilch.codec import decode
+        from zilch.recorder import read_dead_letters
+        eq_([decode(payload)['hash'] for timestamp, payload in
+             read_dead_letters(recorder.dead_letter)], ['poison'])
+        eq_(recorder.journal.checkpoint, recorder.journal.position)
+    
+    def test_shutdown_handles_waiting_messages(self):
+        recorder = self._makeOne(flush_interval=60)
+        self._send([{'hash': 'a'}, {'hash': 'b'}])
+        recorder.sock.poll(1000)
+        recorder.shutdown(signal.SIGTERM, None)
+        try:
+            recorder.main_loop()
+        except SystemExit:
+            pass
+        else:
+            raise AssertionError("main_loop didn't exit")
+        eq_(self.store.message_received.call_count, 2)
+        eq_(self.store.flush.call_count, 1)
+    
+    def test_http_ingest(self):
+        from zilch.client import HTTPSender
+        recorder = self._makeOne(flush_count=2, flush_interval=60,
+                                 http_bind='127.0.0.1:0')
+        self._stopOnFlush(recorder)
+        url = 'http://127.0.0.1:%d/events' % \
+            recorder.http_server.server_address[1]
+        sender = HTTPSender(url)
+        sender.send([{'hash': 'a'}, {'hash': 'b'}])
+        connection = sender.get_connection()
+        sender.send([{'hash': 'c'}])
+        # The connection was kept alive for the second post
+        assert sender.get_connection() is connection
+        assert connection.sock is not None
+        sender.close()
+        recorder.main_loop()
+        eq_([c[0][0]['hash'] for c in self.store.message_received.call_args_list],
+            ['a', 'b', 'c'])
+    
+    def test_http_rejects_malformed_posts(self):
+        import httplib
+        recorder = self._makeOne(http_bind='127.0.0.1:0')
+        connection = httplib.HTTPConnection(
+            '127.0.0.1', recorder.http_server.server_address[1], timeout=5)
+        def post(path, body):
+            connection.request('POST', path, body)
+            response = connection.getresponse()
+            response.read()
+            return response.status, response.getheader('connection')
+        try:
+            eq_(post('/events', '{"not": json'), (400, None))
+            eq_(post('/events', '[1, 2]'), (400, None))
+            # Rejected before reading the body, which mustn't be taken
+            # for the next request
+            eq_(post('/other', '{"hash": "a"}'), (404, 'close'))
+            connection.close()
+            connection.putrequest('POST', '/events')
+            connection.putheader('Content-Length', '-1')
+            connection.endheaders()
+            response = connection.getresponse()
+            response.read()
+            eq_((response.status, response.getheader('connection')),
+                (400, 'close'))
+            connection.close()
+            recorder.http_server.max_bytes = 4
+            eq_(post('/events', '{"hash": "a"}'), (413, 'close'))
+            connection.close()
+            connection.putrequest('POST', '/events')
+            connection.endheaders()
+            response = connection.getresponse()
+            response.read()
+            eq_((response.status, response.getheader('connection')),
+                (411, 'close'))
+        finally:
+            connection.close()
+    
+    def test_no_flush_without_messages(self):
+        recorder = self._makeOne()
+        recorder.flush()
+        eq_(recorder.flush_due(0), False)
+        eq_(self.store.flush.call_count, 0)
+
+
+class TestHistogram(unittest.TestCase):
+    def test_histogram(self):
+        from zilch.recorder import Histogram
+        histogram = Histogram()
+        for i in range(99):
+            histogram.observe(0.002)
+        histogram.observe(20)
+        eq_(histogram.count, 100)
+        eq_(histogram.percentile(0.5), 0.0025)
+        eq_(histogram.percentile(0.99), 0.0025)
+        eq_(histogram.percentile(1), 20)
+        eq_(histogram.snapshot()['buckets'][-1], [None, 1])
+
+
+class FileStore(object):
+    """Store writing the pid and hash of recorded messages to a file"""
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+    
+    def message_received(self, message):
+        self.lines.append('%d %s\n' % (os.getpid(), message['hash']))
+    
+    def flush(self):
+        with open(self.path, 'a') as f:
+            f.writelines(self.lines)
+        self.lines = []
+
+
+class TestShardedRecorder(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.bind = 'ipc://%s/recorder' % self.directory
+        self.output = os.path.join(self.directory, 'recorded')
+        self.handlers = [(s, signal.getsignal(s)) for s in
+                         (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1)]
+    
+    def tearDown(self):
+        import shutil
+        for signum, handler in self.handlers:
+            signal.signal(signum, handler)
+        shutil.rmtree(self.directory)
+    
+    def _makeOne(self, **kwargs):
+        from zilch.recorder import ShardedRecorder
+        output = self.output
+        return ShardedRecorder(zeromq_bind=self.bind,
+                               store_factory=lambda: FileStore(output),
+                               flush_interval=60, **kwargs)
+    
+    def _recorded(self):
+        with open(self.output) as f:
+            return [line.split() for line in f]
+    
+    def test_routes_by_hash_and_drains(self):
+        import threading
+        import time
+        from zilch.codec import encode
+        from zilch.codec import encode_batches
+        recorder = self._makeOne(workers=3, supervise_interval=0.05)
+        thread = threading.Thread(target=recorder.main_loop)
+        thread.start()
+        context = zmq.Context()
+        sock = context.socket(zmq.PUSH)
+        sock.connect(self.bind)
+        messages = [{'hash': str(i % 10)} for i in range(100)]
+        # Decoded, but not events with a string hash, so dropped
+        sock.send(zlib.compress('[1, 2]'))
+        sock.send(encode({'hash': 5}))
+        for message in messages[:50]:
+            sock.send(encode(message))
+        for payload in encode_batches(messages[50:]):
+            sock.send(payload)
+        sock.close(linger=1000)
+        context.term()
+        for i in range(100):
+            if recorder.forwarded == 100:
+                break
+            time.sleep(0.05)
+        recorder.running = False
+        thread.join(10)
+        
+        recorded = self._recorded()
+        eq_(len(recorded), 100)
+        pids = {}
+        for pid, hash in recorded:
+            pids.setdefault(hash, set()).add(pid)
+        eq_(sorted(pids), [str(i) for i in range(10)])
+        eq_([len(p) for p in pids.values()], [1] * 10)
+    
+    def test_forwards_in_chunks(self):
+        from zilch.codec import encode_batches
+        recorder = self._makeOne(workers=1, forward_count=10)
+        try:
+            worker_sock = recorder.worker_socks[0] = Mock(
+                wraps=recorder.worker_socks[0])
+            context = zmq.Context()
+            sock = context.socket(zmq.PUSH)
+            sock.connect(self.bind)
+            for payload in encode_batches([{'hash': str(i)}
+                                           for i in range(25)]):
+                sock.send(payload)
+            sock.close(linger=1000)
+            context.term()
+            recorder.sock.poll(1000)
+            recorder.drain()
+        finally:
+            recorder.stop()
+        eq_(recorder.forwarded, 25)
+        sizes = [len(marshal.loads(c[0][0]))
+                 for c in worker_sock.send.call_args_list[:-1]]
+        eq_(sizes, [10, 10, 5])
+        eq_(len(self._recorded()), 25)
+    
+    def test_restarts_workers(self):
+        recorder = self._makeOne(workers=1)
+        try:
+            process = recorder.processes[0]
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+            recorder.supervise()
+            eq_(recorder.restarts, 1)
+            assert recorder.processes[0].is_alive()
+        finally:
+            recorder.stop()
+        eq_(recorder.processes[0].exitcode, 0)
@@ -0,0 +1,65 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import eq_
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.spool')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def _makeOne(self, size=1024):
+        from zilch.spool import Spool
+        return Spool(self.path, size=size)
+    
+    def _drain(self, spool, count=None):
+        messages = []
+        while len(spool) and len(messages) != count:
+            messages.append(spool.peek())
+            spool.pop()
+        return messages
+    
+    def test_in_order(self):
+        spool = self._makeOne()
+        eq_(spool.peek(), None)
+        for message in ('one', 'two', 'three'):
+            spool.append(message)
+        eq_(self._drain(spool), ['one', 'two', 'three'])
+        eq_((spool.spooled, spool.replayed, spool.used), (3, 3, 0))
+    
+    def test_wraps_around(self):
+        # 64 byte ring holds four 12 byte messages plus lengths
+        spool = self._makeOne(size=20 + 64)
+        messages = ['%012d' % i for i in range(20)]
+        received = []
+        for message in messages:
+            eq_(spool.append(message), True)
+            if len(spool) == 3:
+                received.extend(self._drain(spool, 2))
+        received.extend(self._drain(spool))
+        eq_(received, messages)
+    
+    def test_drops_when_full(self):
+        spool = self._makeOne(size=20 + 64)
+        for i in range(5):
+            spool.append('%012d' % i)
+        eq_(spool.dropped, 1)
+        eq_(len(spool), 4)
+        spool.pop()
+        eq_(spool.append('x' * 12), True)
+        eq_(self._drain(spool)[-1], 'x' * 12)
+    
+    def test_reopen(self):
+        spool = self._makeOne()
+        spool.append('one')
+        spool.append('two')
+        spool.pop()
+        spool.close()
+        eq_(self._drain(self._makeOne()), ['two'])
@@ -1,11 +1,14 @@
 # coding: utf-8
 import unittest
+import uuid
 from contextlib import contextmanager
 
 import simplejson
 from nose.tools import eq_
 from mock import patch
 from mock import Mock
+from sqlalchemy import bindparam
+from sqlalchemy.types import Text
 
 import zmq
 
@@ -59,3 +62,733 @@ class TestEventRecord(TestStore):
             eq_(last_frame['module'], 'zilch.tests.test_store')
         finally:
             Session.remove()
+
+
+class TestLogRecord(TestStore):
+    def testStoreLog(self):
+        from zilch.utils import log_hash
+        store = self._makeSAStore()('sqlite://')
+        message = {
+            'event_type': 'Log', 'event_id': 'a' * 32, 'time_spent': None,
+            'date': '2011-10-01T12:00:00.000000', 'tags': [],
+            'hash': log_hash('app.db', 'Slow query: %s'),
+            'data': {'message': 'Slow query: 42', 'logger': 'app.db',
+                     'template': 'Slow query: %s', 'level': '30'}}
+        try:
+            store.message_received(dict(message))
+            store.message_received(dict(message, event_id='b' * 32,
+                data=dict(message['data'], message='Slow query: 7')))
+            store.flush()
+            
+            Session = self._makeSession()
+            Group = self._makeGroup()
+            groups = Session.query(Group).all()
+            eq_(len(groups), 1)
+            eq_(groups[0].message, 'app.db: Slow query: %s')
+            eq_(groups[0].count, 2)
+            eq_(groups[0].last_event().data['logger'], 'app.db')
+        finally:
+            Session.remove()
+
+
+class TestSummaryRecord(TestStore):
+    def testSummaryAddsToCount(self):
+        store = self._makeSAStore()('sqlite://')
+        with patch('zilch.client.send') as mock_send:
+            cap = self._makeCapture()
+            try:
+                fred = smith['no_name']
+            except:
+                cap()
+            kwargs = mock_send.call_args[1]
+        
+        try:
+            jsonified = simplejson.loads(simplejson.dumps(kwargs))
+            store.message_received(jsonified)
+            store.flush()
+            store.message_received({
+                'event_type': kwargs['event_type'], 'hash': kwargs['hash'],
+                'summary': True, 'suppressed': 41, 'date': kwargs['date']})
+            store.flush()
+            
+            Session = self._makeSession()
+            Group = self._makeGroup()
+            group = Session.query(Group).all()[0]
+            eq_(group.count, 42)
+        finally:
+            Session.remove()
+    
+    def testSummaryOfUnknownGroupIsCounted(self):
+        store = self._makeSAStore()('sqlite://')
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        try:
+            store.message_received({
+                'event_type': 'Exception', 'hash': 'a' * 32, 'summary': True,
+                'suppressed': 41, 'date': '2011-10-01T12:00:00.000000'})
+            store.flush()
+            eq_(Session.query(Group).count(), 0)
+            eq_(store.dropped_occurrences, 41)
+        finally:
+            Session.remove()
+
+
+class TestCoalescing(TestStore):
+    def _message(self, event_id, second, **kwargs):
+        message = {
+            'event_type': 'Log', 'event_id': event_id, 'time_spent': None,
+            'date': '2011-10-01T12:00:%02d.000000' % second, 'tags': [],
+            'hash': 'abc', 'data': {'message': 'Slow', 'logger': 'app',
+                                    'template': 'Slow'}}
+        message.update(kwargs)
+        return message
+    
+    def testCoalesceSameHash(self):
+        store = self._makeSAStore()('sqlite://', coalesce_samples=2)
+        try:
+            for i in range(10):
+                store.message_received(self._message('%032d' % i, 10 + i))
+            store.message_received(self._message(
+                None, 5, summary=True, suppressed=5))
+            eq_(store.coalesced, 8)
+            store.flush()
+            
+            Session = self._makeSession()
+            Group = self._makeGroup()
+            group = Session.query(Group).one()
+            eq_(group.count, 15)
+            eq_(group.events.count(), 2)
+            eq_(group.first_seen.second, 5)
+            eq_(group.last_seen.second, 19)
+            
+            # The next window adds to the same group
+            store.message_received(self._message('a' * 32, 30))
+            store.flush()
+            group = Session.query(Group).one()
+            eq_(group.count, 16)
+            eq_(group.events.count(), 3)
+        finally:
+            Session.remove()
+    
+    def testMalformedMessagesFailOnReceipt(self):
+        store = self._makeSAStore()('sqlite://', coalesce_samples=1)
+        try:
+            store.message_received(self._message('a' * 32, 10))
+            # Only counted, but still checked like a recorded event
+            message = self._message('b' * 32, 11)
+            del message['time_spent']
+            self.assertRaises(KeyError, store.message_received, message)
+            eq_(store.coalesced, 0)
+        finally:
+            self._makeSession().remove()
+
+
+class TestBulkRecord(TestStore):
+    def _messages(self):
+        messages = []
+        for i, (hash, host) in enumerate([('a', 'web1'), ('b', 'web2'),
+                                          ('a', 'web2')]):
+            messages.append({
+                'event_type': 'Log', 'event_id': '%032d' % i,
+                'time_spent': None, 'hash': hash,
+                'date': '2011-10-01T12:00:%02d.000000' % i,
+                'tags': [['Hostname', host]],
+                'data': {'message': 'Slow', 'logger': hash,
+                         'template': 'Slow'}})
+        return messages
+    
+    def _check(self):
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        groups = dict((g.hash, g) for g in Session.query(Group))
+        eq_(groups['a'].count, 2)
+        eq_(groups['a'].last_seen.second, 2)
+        eq_(groups['a'].events.count(), 2)
+        eq_(sorted(t.value for t in groups['a'].all_tags()), ['web1', 'web2'])
+        eq_(groups['b'].count, 1)
+        eq_(groups['b'].last_event().data['logger'], 'b')
+    
+    def testBulkMatchesOrm(self):
+        for bulk in (True, False):
+            store = self._makeSAStore()('sqlite://', bulk=bulk)
+            try:
+                for message in self._messages():
+                    store.message_received(message)
+                store.flush()
+                self._check()
+            finally:
+                self._makeSession().remove()
+    
+    def testMessagesReceived(self):
+        store = self._makeSAStore()('sqlite://')
+        try:
+            messages = self._messages()
+            store.messages_received(messages[:2])
+            store.flush()
+            store.messages_received(messages[2:])
+            store.flush()
+            self._check()
+        finally:
+            self._makeSession().remove()
+    
+    def testSkipsRecordedEvents(self):
+        for bulk in (True, False):
+            store = self._makeSAStore()('sqlite://', bulk=bulk)
+            try:
+                messages = self._messages()
+                for message in messages + messages[:1]:
+                    store.message_received(message)
+                store.flush()
+                for message in messages:
+                    store.message_received(message)
+                store.flush()
+                self._check()
+            finally:
+                self._makeSession().remove()
+    
+    def testFailedFlushRollsBack(self):
+        store = self._makeSAStore()('sqlite://')
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        try:
+            store.messages_received(self._messages())
+            store.summary_received = Mock(side_effect=ValueError)
+            store._summaries.append({})
+            self.assertRaises(ValueError, store.flush)
+            eq_(store.cache_stats()['groups']['size'], 0)
+            store.flush()
+            eq_(Session.query(Group).count(), 0)
+        finally:
+            Session.remove()
+    
+    def testMessagesPendingPerThread(self):
+        import threading
+        store = self._makeSAStore()('sqlite://')
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        messages = self._messages()
+        def flush():
+            store.flush()
+        try:
+            store.message_received(messages[0])
+            store.message_received(messages[1])
+            # Has nothing to write
+            thread = threading.Thread(target=flush)
+            thread.start()
+            thread.join()
+            eq_(store.pending_objects(), 2)
+            eq_(Session.query(Group).count(), 0)
+            store.message_received(messages[2])
+            store.flush()
+            self._check()
+        finally:
+            Session.remove()
+    
+    def testSteadyStateSkipsLookups(self):
+        from sqlalchemy import event
+        store = self._makeSAStore()('sqlite://')
+        statements = []
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = self._makeSession().bind
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        try:
+            messages = self._messages()
+            store.messages_received(messages[:2])
+            store.flush()
+            del statements[:]
+            hits = store.cache_stats()['groups']['hits']
+            store.messages_received(messages[2:])
+            store.flush()
+            # Only the ids of the events are looked up
+            eq_([s for s in statements if s.startswith('SELECT') and
+                 not s.startswith('SELECT event.event_id')], [])
+            self._check()
+            stats = store.cache_stats()
+            eq_(stats['groups']['hits'], hits + 1)
+            eq_(stats['tags']['size'], 2)
+        finally:
+            self._makeSession().remove()
+    
+    def testTagsLookedUpByPair(self):
+        store = self._makeSAStore()('sqlite://')
+        Session = self._makeSession()
+        try:
+            messages = []
+            for i in range(150):
+                message = self._messages()[0]
+                message['event_id'] = '%032d' % i
+                message['tags'] = [['Hostname', 'web%d' % i]]
+                messages.append(message)
+            from zilch.store import Event
+            from zilch.store import caches
+            store.messages_received(messages[:10])
+            store.flush()
+            caches.clear()
+            # More pairs than fit in one query, some of them recorded
+            store.messages_received(messages[5:])
+            store.flush()
+            eq_(Session.query(Event).count(), 150)
+            event = Session.query(Event).get('%032d' % 149)
+            eq_([(t.name, t.value) for t in event.tags],
+                [('Hostname', 'web149')])
+        finally:
+            Session.remove()
+    
+    def testRejectsMalformedMessages(self):
+        store = self._makeSAStore()('sqlite://')
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        try:
+            malformed = [('hash', None), ('hash', ''), ('hash', 1),
+                         ('event_id', None), ('time_spent', '1'),
+                         ('tags', 'Hostname'), ('tags', [['Hostname']]),
+                         ('tags', [['Hostname', 1]])]
+            for key, value in malformed:
+                message = self._messages()[0]
+                message[key] = value
+                self.assertRaises(ValueError, store.message_received,
+                                  message)
+            for message in self._messages():
+                store.message_received(message)
+            store.flush()
+            self._check()
+            eq_(Session.query(Group).count(), 2)
+        finally:
+            Session.remove()
+    
+    def testRollbackClearsCaches(self):
+        store = self._makeSAStore()('sqlite://')
+        Session = self._makeSession()
+        try:
+            messages = self._messages()
+            store.messages_received(messages[:2])
+            store.flush()
+            eq_(store.cache_stats()['event_types']['size'], 1)
+            store.messages_received(messages[2:])
+            Session.rollback()
+            eq_(store.cache_stats()['event_types']['size'], 0)
+            eq_(store.cache_stats()['groups']['size'], 0)
+        finally:
+            Session.remove()
+    
+    def testCachesIdsOnCommit(self):
+        import threading
+        from zilch.store import caches
+        store = self._makeSAStore()('sqlite://')
+        Session = self._makeSession()
+        seen = []
+        def lookup():
+            seen.append(caches.event_types.get('Log'))
+        try:
+            store.messages_received(self._messages())
+            # Seen by the transaction that wrote it, not by other threads
+            assert caches.event_types.get('Log') is not None
+            thread = threading.Thread(target=lookup)
+            thread.start()
+            thread.join()
+            eq_(store.cache_stats()['event_types']['size'], 0)
+            store.flush()
+            thread = threading.Thread(target=lookup)
+            thread.start()
+            thread.join()
+            eq_(seen[0], None)
+            eq_(seen[1], caches.event_types.get('Log'))
+            eq_(store.cache_stats()['groups']['size'], 2)
+        finally:
+            Session.remove()
+
+
+class TestIdentityCache(unittest.TestCase):
+    def _makeOne(self, max_size):
+        from zilch.store import IdentityCache
+        return IdentityCache(max_size)
+    
+    def testEvictsLeastRecentlyUsed(self):
+        cache = self._makeOne(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        eq_(cache.get('a'), 1)
+        cache.set('c', 3)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('c'), 3)
+        eq_(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+    
+    def testThreadSafe(self):
+        import random
+        import threading
+        cache = self._makeOne(50)
+        errors = []
+        def churn():
+            try:
+                for i in range(5000):
+                    key = random.randint(0, 100)
+                    if cache.get(key) is None:
+                        cache.set(key, i)
+                    if not i % 10:
+                        cache.discard(random.randint(0, 100))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=churn) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(errors, [])
+        assert len(cache) <= 50
+    
+    def testStagedUntilCommit(self):
+        cache = self._makeOne(10)
+        cache.stage('a', 1)
+        eq_(cache.get('a'), 1)
+        eq_(len(cache), 0)
+        cache.commit()
+        eq_(len(cache), 1)
+        cache.stage('b', 2)
+        cache.rollback()
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 1)
+
+
+class TestUpsertGroups(TestStore):
+    def setUp(self):
+        from zilch.store import init_db
+        init_db('sqlite://')
+    
+    def tearDown(self):
+        self._makeSession().remove()
+    
+    def _callFUT(self, rows):
+        from zilch.store import upsert_groups
+        return upsert_groups(rows)
+    
+    def _row(self, count, second):
+        import datetime
+        date = datetime.datetime(2011, 10, 1, 12, 0, second)
+        return {'type_id': 1, 'hash': 'a', 'message': 'Boom',
+                'count': count, 'first_seen': date, 'last_seen': date,
+                'score': second}
+    
+    def _check(self):
+        from zilch.store import _logaddexp
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        groups = Session.query(Group).filter_by(hash='a').all()
+        eq_(len(groups), 1)
+        eq_(groups[0].count, 4)
+        eq_(groups[0].first_seen.second, 1)
+        eq_(groups[0].last_seen.second, 5)
+        # The scores are combined by the database
+        self.assertAlmostEqual(groups[0].score, _logaddexp(5, 1))
+    
+    def _checkFarApart(self):
+        # Adding a much lower score leaves the score as it is
+        self._callFUT([dict(self._row(1, 5), hash='b', score=100)])
+        self._callFUT([dict(self._row(1, 5), hash='b', score=1)])
+        Group = self._makeGroup()
+        group = self._makeSession().query(Group).filter_by(hash='b').one()
+        eq_(group.score, 100)
+    
+    def testUpsert(self):
+        self._callFUT([self._row(1, 5)])
+        self._callFUT([self._row(3, 1)])
+        self._check()
+        self._checkFarApart()
+    
+    def testFallback(self):
+        with patch('zilch.store._upsert_clause') as clause:
+            clause.return_value = None
+            self._callFUT([self._row(1, 5)])
+            self._callFUT([self._row(3, 1)])
+            self._checkFarApart()
+        self._check()
+    
+    def testUniqueIndex(self):
+        from sqlalchemy.exc import IntegrityError
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        row = self._row(1, 5)
+        Session.execute(Group.__table__.insert(), row)
+        self.assertRaises(IntegrityError, Session.execute,
+                          Group.__table__.insert(), row)
+
+
+
+class TestMigrateGroups(TestStore):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.uri = 'sqlite:///%s/zilch.db' % self.directory
+    
+    def tearDown(self):
+        import shutil
+        self._makeSession().remove()
+        shutil.rmtree(self.directory)
+    
+    def _message(self, event_id):
+        return {'event_type': 'Log', 'event_id': event_id,
+                'time_spent': None, 'hash': 'a', 'tags': [],
+                'date': '2011-10-01T12:00:00.000000',
+                'data': {'message': 'Slow', 'logger': 'a',
+                         'template': 'Slow'}}
+    
+    def testMergesDuplicatesAndAddsIndex(self):
+        import zilch.store
+        from zilch.store import init_db
+        from zilch.store import migrate_groups
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        # A database created before the index existed
+        init_db(self.uri)
+        Session.execute('DROP INDEX idx_type_hash')
+        Session.commit()
+        Session.remove()
+        init_db(self.uri)
+        eq_(zilch.store.group_index, False)
+        
+        for bulk in (True, False):
+            Session.remove()
+            store = self._makeSAStore()(self.uri, bulk=bulk)
+            store.message_received(self._message('e1-%s' % bulk))
+            store.flush()
+        eq_(Session.query(Group).one().count, 2)
+        duplicate = Session.query(Group).one()
+        Session.execute(Group.__table__.insert(), {
+            'type_id': duplicate.type_id, 'hash': 'a', 'message': 'Slow',
+            'count': 3, 'first_seen': duplicate.first_seen,
+            'last_seen': duplicate.last_seen, 'score': 0})
+        Session.commit()
+        
+        eq_(migrate_groups(), 1)
+        eq_(zilch.store.group_index, True)
+        Session.remove()
+        group = Session.query(Group).one()
+        eq_(group.count, 5)
+        eq_(group.events.count(), 2)
+        store.message_received(self._message('e3'))
+        store.flush()
+        eq_(Session.query(Group).one().count, 6)
+        eq_(migrate_groups(), 0)
+
+
+class TestScore(TestStore):
+    def _message(self, hash, hours):
+        import datetime
+        date = datetime.datetime(2011, 10, 1) + datetime.timedelta(
+            hours=hours)
+        return {'event_type': 'Log', 'event_id': uuid.uuid4().hex,
+                'time_spent': None, 'hash': hash, 'tags': [],
+                'date': date.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                'data': {'message': 'Slow', 'logger': hash,
+                         'template': 'Slow'}}
+    
+    def _hottest(self, bulk):
+        store = self._makeSAStore()('sqlite://', bulk=bulk)
+        try:
+            # 'a' was seen a lot a day ago, 'b' a few times lately
+            for i in range(8):
+                store.message_received(self._message('a', i * 0.01))
+            store.flush()
+            for i in range(3):
+                store.message_received(self._message('b', 24 + i))
+            store.flush()
+            store.message_received(self._message('a', 1))
+            store.flush()
+            groups = self._makeGroup().hottest().all()
+            return [(g.hash, round(g.score, 9)) for g in groups]
+        finally:
+            self._makeSession().remove()
+    
+    def testHottest(self):
+        hottest = self._hottest(bulk=True)
+        eq_([hash for hash, score in hottest], ['b', 'a'])
+        eq_(self._hottest(bulk=False), hottest)
+    
+    def testScoreDecays(self):
+        import datetime
+        from zilch.store import _score, score_half_life
+        date = datetime.datetime(2011, 10, 1)
+        later = date + datetime.timedelta(seconds=score_half_life)
+        # Two occurrences count as much as one a half life later
+        self.assertAlmostEqual(_score(_score(None, 1, date), 1, date),
+                               _score(None, 1, later))
+        self.assertAlmostEqual(_score(None, 2, date),
+                               _score(_score(None, 1, date), 1, date))
+    
+    def testMigrateScores(self):
+        import datetime
+        from zilch.store import _index_names
+        from zilch.store import _score
+        from zilch.store import init_db
+        from zilch.store import migrate_scores
+        Session = self._makeSession()
+        Group = self._makeGroup()
+        try:
+            # A database scored and created by an earlier version
+            init_db('sqlite://')
+            Session.execute('DROP INDEX ix_group_score')
+            last_seen = datetime.datetime(2011, 10, 1)
+            Session.execute(Group.__table__.insert(), {
+                'type_id': 1, 'hash': 'a', 'message': 'Slow', 'count': 4,
+                'first_seen': last_seen, 'last_seen': last_seen,
+                'score': 1317470400})
+            Session.commit()
+            
+            eq_(migrate_scores(), True)
+            self.assertAlmostEqual(Session.query(Group).one().score,
+                                   _score(None, 4, last_seen))
+            assert 'ix_group_score' in _index_names(Session.connection(),
+                                                    'group')
+            eq_(migrate_scores(), False)
+        finally:
+            Session.remove()
+
+
+class TestCompressedJSON(TestStore):
+    def setUp(self):
+        from zilch.store import init_db
+        init_db('sqlite://')
+        self.data = {'frames': [{'filename': 'app.py', 'lineno': i,
+                                 'vars': {'i': str(i)}} for i in range(5)],
+                     'message': u'لي'}
+    
+    def tearDown(self):
+        import zilch.store
+        zilch.store.compression_dictionary = None
+        self._makeSession().remove()
+    
+    def testLevels(self):
+        from zilch.store import encode_json
+        from zilch.store import decode_json
+        for level in (0, 1, 9):
+            encoded = encode_json(self.data, level)
+            eq_(decode_json(encoded), self.data)
+        eq_(encode_json(self.data, 0)[0], '\x00')
+        eq_(encode_json(self.data, 6)[0], '\x01')
+    
+    def testReadsGzippedJSON(self):
+        from zilch.store import GzippedJSON
+        from zilch.store import decode_json
+        legacy = GzippedJSON().process_bind_param(self.data, None)
+        eq_(decode_json(legacy), self.data)
+        eq_(decode_json(unicode(legacy)), self.data)
+    
+    def testDictionary(self):
+        import simplejson
+        from zilch.store import add_dictionary
+        from zilch.store import encode_json
+        from zilch.store import decode_json
+        from zilch.store import train_dictionary
+        from zilch.store import _dictionaries
+        samples = [simplejson.dumps(self.data, separators=(',', ':'))] * 2
+        plain = encode_json(self.data)
+        id = add_dictionary(train_dictionary(samples))
+        encoded = encode_json(self.data)
+        eq_(encoded[0], '\x02')
+        self.assertTrue(len(encoded) < len(plain))
+        # Read the dictionary back from the database
+        _dictionaries.clear()
+        eq_(decode_json(encoded), self.data)
+        eq_(_dictionaries[id].id, id)
+    
+    def testMigrate(self):
+        from zilch.store import Event
+        from zilch.store import GzippedJSON
+        from zilch.store import migrate_event_data
+        Session = self._makeSession()
+        legacy = GzippedJSON().process_bind_param(self.data, None)
+        table = Event.__table__
+        raw = bindparam('raw', type_=Text)
+        Session.execute(table.insert().values(data=raw), [
+            {'event_id': str(i), 'hash': 'a',
+             'raw': legacy} for i in range(5)])
+        Session.execute(table.insert(), {'event_id': '5', 'hash': 'a',
+                                         'data': self.data})
+        eq_(migrate_event_data(batch_size=2), 5)
+        eq_(migrate_event_data(batch_size=2), 0)
+        for event in Session.query(Event):
+            eq_(event.data, self.data)
+    
+    def testWritesBase64ToTextColumn(self):
+        import base64
+        from zilch.store import Event
+        from zilch.store import init_db
+        Session = self._makeSession()
+        Session.remove()
+        # A PostgreSQL or MySQL database zilch-migrate hasn't run on yet
+        with patch('zilch.store._text_data_column') as text_column:
+            text_column.return_value = True
+            init_db('sqlite://')
+        try:
+            Session.execute(Event.__table__.insert(), {
+                'event_id': '1', 'hash': 'a', 'data': self.data})
+            raw = Session.execute('SELECT data FROM event').scalar()
+            assert isinstance(raw, unicode)
+            base64.b64decode(raw).decode('zlib')
+            eq_(Session.query(Event).one().data, self.data)
+        finally:
+            Session.remove()
+            init_db('sqlite://')
+        eq_(Event.__table__.c.data.type.text, False)
+
+
+class TestStacks(TestStore):
+    def _capture(self):
+        messages = []
+        cap = self._makeCapture()
+        with patch('zilch.client.send') as mock_send:
+            for i in range(3):
+                try:
+                    {}[i]
+                except KeyError:
+                    cap()
+                messages.append(simplejson.loads(simplejson.dumps(
+                    mock_send.call_args[1])))
+        return messages
+    
+    def _record(self, bulk):
+        from zilch.store import Event
+        from zilch.store import Stack
+        store = self._makeSAStore()('sqlite://', bulk=bulk)
+        Session = self._makeSession()
+        messages = self._capture()
+        try:
+            for message in messages:
+                store.message_received(message)
+            store.flush()
+            eq_(Session.query(Stack).count(), 1)
+            stored = [data for data, in Session.query(Event.data)]
+            eq_(['frames' in data for data in stored], [False] * 3)
+            eq_(len(set(data['stack'] for data in stored)), 1)
+            for message in messages:
+                event = Session.query(Event).get(message['event_id'])
+                eq_(event.data['frames'], message['data']['frames'])
+                eq_(event.data['traceback'], message['data']['traceback'])
+        finally:
+            Session.remove()
+    
+    def testBulk(self):
+        self._record(bulk=True)
+    
+    def testOrm(self):
+        self._record(bulk=False)
+    
+    def testCachedStackSkipsLookup(self):
+        from sqlalchemy import event
+        store = self._makeSAStore()('sqlite://')
+        messages = self._capture()
+        statements = []
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self._makeSession().bind, 'before_cursor_execute',
+                     before_execute)
+        try:
+            store.messages_received(messages[:1])
+            store.flush()
+            del statements[:]
+            store.messages_received(messages[1:])
+            store.flush()
+            eq_([s for s in statements if 'stack' in s], [])
+        finally:
+            self._makeSession().remove()
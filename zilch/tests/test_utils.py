@@ -0,0 +1,181 @@
+# coding: utf-8
+import unittest
+
+from nose.tools import eq_
+from mock import Mock
+
+
+class TestSourceCache(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from zilch.utils import SourceCache
+        return SourceCache(**kwargs)
+    
+    def _makeFrame(self, lineno, source):
+        frame = Mock()
+        frame.filename = __file__
+        frame.lineno = lineno
+        frame.get_source_line.return_value = source
+        return frame
+    
+    def test_repeat_lookup_is_cached(self):
+        cache = self._makeOne()
+        frame = self._makeFrame(10, 'line ten\n')
+        eq_(cache.get_source_line(frame), 'line ten\n')
+        eq_(cache.get_source_line(frame), 'line ten\n')
+        eq_(frame.get_source_line.call_count, 1)
+        eq_((cache.hits, cache.misses), (1, 1))
+    
+    def test_context_is_part_of_key(self):
+        cache = self._makeOne()
+        frame = self._makeFrame(10, 'line ten\n')
+        cache.get_source_line(frame)
+        cache.get_source_line(frame, context=5)
+        eq_(frame.get_source_line.call_count, 2)
+    
+    def test_evicts_least_recently_used(self):
+        cache = self._makeOne(max_bytes=20)
+        first = self._makeFrame(1, 'x' * 10)
+        second = self._makeFrame(2, 'y' * 10)
+        third = self._makeFrame(3, 'z' * 10)
+        cache.get_source_line(first)
+        cache.get_source_line(second)
+        cache.get_source_line(first)
+        cache.get_source_line(third)
+        eq_(cache.size, 20)
+        cache.get_source_line(first)
+        eq_(first.get_source_line.call_count, 1)
+        cache.get_source_line(second)
+        eq_(second.get_source_line.call_count, 2)
+    
+    def test_checks_linecache_when_file_changes(self):
+        import os
+        import shutil
+        import tempfile
+        from weberror.collector import ExceptionFrame
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'module.py')
+            open(filename, 'w').write('old = 1\n')
+            os.utime(filename, (1000, 1000))
+            frame = ExceptionFrame(filename=filename, lineno=1)
+            cache = self._makeOne()
+            eq_(cache.get_source_line(frame), 'old = 1\n')
+            open(filename, 'w').write('new = 2\n')
+            os.utime(filename, (2000, 2000))
+            eq_(cache.get_source_line(frame), 'new = 2\n')
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestLookupVersions(unittest.TestCase):
+    def _makeOne(self):
+        from zilch.utils import VersionIndex
+        return VersionIndex()
+    
+    def test_lookup_by_top_level_name(self):
+        import pkg_resources
+        dist = pkg_resources.working_set.by_key['mock']
+        index = self._makeOne()
+        eq_(index.lookup(['mock', 'mock.submodule', 'no_such_module']),
+            {'mock': dist.version})
+    
+    def test_lookup_dependencies(self):
+        import pkg_resources
+        index = self._makeOne()
+        versions = index.lookup(['pyramid'], include_deps=True)
+        eq_(versions['webob'], pkg_resources.working_set.by_key['webob'].version)
+    
+    def test_rebuilt_when_path_changes(self):
+        import sys
+        index = self._makeOne()
+        index.lookup(['mock'])
+        modules = index._modules
+        sys.path.append('/no/such/path')
+        try:
+            index.lookup(['mock'])
+        finally:
+            sys.path.remove('/no/such/path')
+        assert index._modules is not modules
+
+
+class TestSanitizer(unittest.TestCase):
+    def _makeOne(self, **kwargs):
+        from zilch.utils import Sanitizer
+        return Sanitizer(**kwargs)
+    
+    def test_transform_scalars(self):
+        import datetime
+        from zilch.utils import transform
+        eq_(transform(5), '5')
+        eq_(transform(None), 'None')
+        eq_(transform(u'ل'), u'ل')
+        eq_(transform(datetime.date(2012, 1, 13)), '2012-01-13')
+        eq_(transform((1, [2, set(['a'])], {3: 4})),
+            ('1', ['2', set(['a'])], {'3': '4'}))
+    
+    def test_truncates_while_walking(self):
+        sanitizer = self._makeOne(max_items=2, max_keys=1, max_string=3)
+        eq_(sanitizer.sanitize(range(1000000)),
+            ['0', '1', '...', '(999998 more elements)'])
+        eq_(sanitizer.sanitize({'a': 'abcdef', 'b': 1}).get('...'),
+            '(1 more items)')
+        eq_(sanitizer.sanitize('abcdef'), 'abc...')
+    
+    def test_depth_and_cycles(self):
+        sanitizer = self._makeOne(max_depth=2)
+        nested = [[[1]]]
+        eq_(sanitizer.sanitize(nested), [['(max depth reached)']])
+        cycle = []
+        cycle.append(cycle)
+        eq_(self._makeOne().sanitize(cycle), ['<...>'])
+        shared = ['x']
+        eq_(self._makeOne().sanitize([shared, shared]), [['x'], ['x']])
+    
+    def test_deep_nesting_does_not_recurse(self):
+        import sys
+        nested = []
+        for i in range(sys.getrecursionlimit() * 2):
+            nested = [nested]
+        self._makeOne().sanitize(nested)
+    
+    def test_byte_budget(self):
+        sanitizer = self._makeOne(max_bytes=10)
+        eq_(sanitizer.sanitize(['a' * 6, 'b' * 6, 'c']),
+            ['a' * 6, 'b' * 6, '(size limit reached)'])
+    
+    def test_handlers(self):
+        class Point(object):
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+        sanitizer = self._makeOne(
+            handlers={Point: lambda p: {'x': p.x, 'y': p.y}, int: repr})
+        eq_(sanitizer.sanitize([Point(1, 2)]), [{'x': '1', 'y': '2'}])
+
+
+class TestStreamingEncoder(unittest.TestCase):
+    def _payload(self):
+        import datetime
+        return {
+            'event_type': 'Exception',
+            'tags': [('Hostname', 'localhost')],
+            'data': {
+                'frames': [{'vars': {'uni': u"لي", 'n': 1}},
+                           {'vars': {}, 'nested': {'a': [[1], {2: 3}]}}],
+                'set': set(['a string']),
+                'date': datetime.datetime(2012, 1, 13),
+            },
+            'empty': [],
+        }
+    
+    def test_identical_to_dumps(self):
+        from zilch.utils import dumps, iterencode
+        payload = self._payload()
+        eq_(''.join(iterencode(payload)), dumps(payload))
+        eq_(''.join(iterencode(payload, depth=10)), dumps(payload))
+    
+    def test_dumps_compressed(self):
+        import zlib
+        from zilch.utils import dumps, dumps_compressed
+        payload = self._payload()
+        eq_(zlib.decompress(dumps_compressed(payload, buffer_size=8)),
+            dumps(payload))
@@ -1,17 +1,24 @@
 """Reporting/Collector Utility functions"""
 import datetime
+import hashlib
+import linecache
 import logging
+import os
+import sys
+import threading
 import types
 import uuid
+import zlib
+from collections import OrderedDict
 from decimal import Decimal
+from itertools import islice
 
 import simplejson
 from simplejson import JSONEncoder
+from simplejson.encoder import encode_basestring_ascii
 from sqlalchemy.engine.base import ResultProxy, RowProxy
 from weberror.collector import collect_exception
 
-import pkg_resources
-
 # JSON Encoder class
 class BetterJSONEncoder(JSONEncoder):
     def default(self, obj):
@@ -45,80 +52,446 @@ def loads(value, **kwargs):
     return simplejson.loads(value, object_hook=better_decoder)
 
 
+_chunk_encoder = BetterJSONEncoder()
+
+
+def encode_chunks(value, write, depth=3):
+    """Write the JSON encoding of ``value`` in chunks to ``write``"""
+    if isinstance(value, basestring):
+        write(encode_basestring_ascii(value))
+    elif depth and isinstance(value, dict) and value and \
+       all(isinstance(k, basestring) for k in value):
+        separator = '{'
+        for k, v in value.iteritems():
+            write(separator + encode_basestring_ascii(k) + ': ')
+            encode_chunks(v, write, depth - 1)
+            separator = ', '
+        write('}')
+    elif depth and isinstance(value, (list, tuple)) and value:
+        separator = '['
+        for v in value:
+            write(separator)
+            encode_chunks(v, write, depth - 1)
+            separator = ', '
+        write(']')
+    else:
+        write(_chunk_encoder.encode(value))
+
+
+def iterencode(value, depth=3):
+    """Return the JSON encoding of ``value`` as a list of chunks
+
+    The chunks join to exactly what :func:`dumps` returns, but only dicts
+    and lists nested more than ``depth`` levels deep are encoded as a
+    single chunk.
+
+    """
+    chunks = []
+    encode_chunks(value, chunks.append, depth)
+    return chunks
+
+
+class CompressingWriter(object):
+    """Buffers chunks written to it and feeds them to a compressor"""
+    def __init__(self, compressor, buffer_size=16384):
+        self.compressor = compressor
+        self.buffer_size = buffer_size
+        self.size = 0
+        self.output = []
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+        if self.pending_size >= self.buffer_size:
+            self.output.append(self.compressor.compress(''.join(self.pending)))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        """Flush the compressor and return the compressed data"""
+        self.output.append(self.compressor.compress(''.join(self.pending)))
+        self.output.append(self.compressor.flush())
+        return ''.join(self.output)
+
+
+def dumps_compressed(value, level=zlib.Z_DEFAULT_COMPRESSION,
+                     buffer_size=16384, compressor=None):
+    """Return the zlib compressed JSON encoding of ``value``
+
+    The JSON is fed to the compressor in chunks as it's encoded, rather
+    than being built as one string and compressed afterwards. A
+    ``compressor`` object may be passed in place of a ``level``.
+
+    """
+    if compressor is None:
+        compressor = zlib.compressobj(level)
+    writer = CompressingWriter(compressor, buffer_size)
+    encode_chunks(value, writer.write)
+    return writer.close()
+
+
+class VersionIndex(object):
+    """Index of module names to installed distributions
+
+    The index maps distribution keys and the top-level module names
+    listed in each distribution's ``top_level.txt`` metadata to the
+    distribution. It's built on first use, and rebuilt when ``sys.path``
+    or the ``pkg_resources`` working set changes.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._dists = {}
+        self._names = {}
+        self._modules = {}
+        self._requires = {}
+
+    def _current(self):
+        """Return the index tables, rebuilding them if necessary"""
+        import pkg_resources
+        working_set = pkg_resources.working_set
+        signature = (tuple(sys.path), id(working_set),
+                     tuple(working_set.entries), len(working_set.by_key))
+        self._lock.acquire()
+        try:
+            if signature != self._signature:
+                self._build(working_set)
+                self._signature = signature
+            return self._dists, self._names, self._modules, self._requires
+        finally:
+            self._lock.release()
+
+    def _build(self, working_set):
+        dists = {}
+        names = {}
+        for dist in working_set:
+            dists[dist.key] = dist
+            names[dist.key] = dist.key
+        for key, dist in dists.items():
+            try:
+                if not dist.has_metadata('top_level.txt'):
+                    continue
+                top_level = list(dist.get_metadata_lines('top_level.txt'))
+            except Exception:
+                continue
+            for name in top_level:
+                names.setdefault(name.strip(), key)
+        self._dists = dists
+        self._names = names
+        self._modules = {}
+        self._requires = {}
+
+    def lookup(self, module_list, include_deps=False):
+        dists, names, modules, requires = self._current()
+        libs = {}
+        check_list = []
+        for module in module_list:
+            try:
+                key = modules[module]
+            except KeyError:
+                key = modules[module] = self._find(module, names)
+            if key is not None and key not in libs:
+                libs[key] = dists[key].version
+                check_list.append(key)
+
+        while include_deps and check_list:
+            key = check_list.pop()
+            if key not in requires:
+                try:
+                    requires[key] = [req.key for req in dists[key].requires()
+                                     if req.key in dists]
+                except Exception:
+                    requires[key] = []
+            for dep in requires[key]:
+                if dep not in libs:
+                    libs[dep] = dists[dep].version
+                    check_list.append(dep)
+        return libs
+
+    def _find(self, module, names):
+        library_name = module
+        while library_name not in names:
+            # If we're out of chunks to break off, escape
+            if '.' not in library_name:
+                return None
+            library_name = library_name.rsplit('.', 1)[0]
+        return names[library_name]
+
+
+version_index = VersionIndex()
+
+
 def lookup_versions(module_list, include_deps=False):
     """Given a list of modules, look up their versions and return
     a dict of the located libraries and their versions along with
     all dependencies
     
     """
-    libs = {}
-    check_list = module_list[:]
-    for module in check_list:
-        # Don't check modules we already recorded info for
-        if module in libs:
-            continue
-        
-        missing_lib = True
-        library_name = module
-        while missing_lib:
-            if library_name in pkg_resources.working_set.by_key:
-                missing_lib = False
-                pkg = pkg_resources.working_set.by_key[library_name]
-                libs[library_name] = pkg.version
-                
-                if include_deps:
-                    # Add unchecked dependencies for lib lookup
-                    unchecked_deps = [x.key for x in pkg.requires() if x.key not in libs]
-                    check_list.extend(unchecked_deps)
-            else:
-                # If we're out of chunks to break off, escape
-                if '.' not in library_name:
-                    break
-                library_name = '.'.join(library_name.split('.')[:-1])
-    return libs
-
-
-def transform(value, stack=[], context=None):
-    # TODO: make this extendable
-    # TODO: include some sane defaults, like UUID
-    # TODO: dont coerce strings to unicode, leave them as strings
-    if context is None:
-        context = {}
-    objid = id(value)
-    if objid in context:
-        return '<...>'
-    context[objid] = 1
-    if any(value is s for s in stack):
-        ret = 'cycle'
-    transform_rec = lambda o: transform(o, stack + [value], context)
-    if isinstance(value, (tuple, list, set, frozenset)):
+    return version_index.lookup(module_list, include_deps=include_deps)
+
+
+class SourceCache(object):
+    """LRU cache of frame source lines
+
+    Source is cached per ``(filename, mtime, lineno, context)`` so that
+    repeated captures of the same stack don't go back to the source
+    files. The cache holds at most ``max_bytes`` of source text, evicting
+    the least recently used entries first. When a file's mtime changes,
+    :mod:`linecache` is checked so the new source is read instead of the
+    lines it cached for the old file.
+
+    """
+    def __init__(self, max_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._mtimes = {}
+        self._lock = threading.Lock()
+
+    def get_source_line(self, frame, context=0, mtimes=None):
+        """Return the source line of a weberror frame
+
+        ``mtimes`` may be a dict shared across calls for the same
+        traceback to only stat each source file once.
+
+        """
+        filename = frame.filename
+        if not filename or not frame.lineno:
+            return None
+        if mtimes is None:
+            mtimes = {}
+        if filename in mtimes:
+            mtime = mtimes[filename]
+        else:
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                mtime = None
+            mtimes[filename] = mtime
+        key = (filename, mtime, frame.lineno, context)
+
+        self._lock.acquire()
+        try:
+            source = self._entries.pop(key, None)
+            if source is not None:
+                self._entries[key] = source
+                self.hits += 1
+                return source
+            self.misses += 1
+            stale = self._mtimes.get(filename) != mtime
+            self._mtimes[filename] = mtime
+        finally:
+            self._lock.release()
+
+        if stale:
+            linecache.checkcache(filename)
+        source = frame.get_source_line(context=context)
+        if len(source) > self.max_bytes:
+            return source
+        self._lock.acquire()
         try:
-            ret = type(value)(transform_rec(o) for o in value)
-        except:
-            ret = repr(value)
-    elif isinstance(value, uuid.UUID):
-        ret = repr(value)
-    elif isinstance(value, datetime.datetime):
-        ret = value.strftime('%Y-%m-%dT%H:%M:%S.%f')
-    elif isinstance(value, datetime.date):
-        ret = value.strftime('%Y-%m-%d')
-    elif isinstance(value, dict):
-        ret = dict((k if isinstance(k, str) or isinstance(k, unicode) else repr(k),
-                    transform_rec(v)) for k, v in value.iteritems())
-    elif isinstance(value, unicode):
-        ret = to_unicode(value)
-    elif isinstance(value, str):
+            if key not in self._entries:
+                self._entries[key] = source
+                self.size += len(source)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+        finally:
+            self._lock.release()
+        return source
+
+    def clear(self):
+        self._lock.acquire()
         try:
-            ret = str(value)
-        except:
-            ret = to_unicode(value)
-    elif not isinstance(value, (int, bool)) and value is not None:
-        # XXX: we could do transform(repr(value)) here
-        ret = to_unicode(value)
-    else:
-        ret = repr(value)
-    del context[objid]
-    return ret
+            self._entries.clear()
+            self._mtimes.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+
+source_cache = SourceCache()
+
+
+def _format_datetime(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def _format_date(value):
+    return value.strftime('%Y-%m-%d')
+
+
+# Conversions for non-container values, looked up along the type's MRO
+sanitize_handlers = {
+    uuid.UUID: repr,
+    datetime.datetime: _format_datetime,
+    datetime.date: _format_date,
+    unicode: lambda value: to_unicode(value),
+    str: str,
+    int: repr,
+    bool: repr,
+    types.NoneType: repr,
+}
+
+
+def register_handler(cls, handler):
+    """Register how values of type ``cls`` are sanitized
+
+    ``handler`` is called with the value and should return a string, or a
+    list/tuple/set/dict which will be sanitized in turn.
+
+    """
+    sanitize_handlers[cls] = handler
+
+
+class Sanitizer(object):
+    """Budgeted conversion of captured values into serializable data
+
+    Values are walked iteratively, and truncated while walking so that no
+    more than the budget is ever copied:
+
+    * ``max_depth`` - containers nested deeper are replaced by a marker
+    * ``max_items`` - items kept per list, tuple or set
+    * ``max_keys`` - keys kept per dict
+    * ``max_string`` - characters kept per string
+    * ``max_bytes`` - approximate size of the entire result
+
+    A budget of ``None`` is unlimited. Dropped list items are recorded as
+    ``'...', '(N more elements)'``, dropped dict keys as a ``'...'`` key,
+    and truncated strings end in ``'...'``. Values past the depth or byte
+    budget are replaced by a marker string.
+
+    Non-container values are converted by the handler registered for
+    their type in ``handlers``, which defaults to the module wide
+    ``sanitize_handlers``.
+
+    """
+    containers = (tuple, list, set, frozenset, dict)
+    depth_marker = '(max depth reached)'
+    bytes_marker = '(size limit reached)'
+    cycle_marker = '<...>'
+
+    def __init__(self, max_depth=None, max_items=None, max_keys=None,
+                 max_string=None, max_bytes=None, handlers=None):
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_keys = max_keys
+        self.max_string = max_string
+        self.max_bytes = max_bytes
+        if handlers is None:
+            handlers = sanitize_handlers
+        self.handlers = handlers
+
+    def sanitize(self, value):
+        root = [None]
+        # Work items are (value, parent, key, depth), an item with a
+        # parent of None marks the end of a container's children
+        stack = [(value, root, 0, 0)]
+        path = set()
+        fixups = []
+        remaining = self.max_bytes
+        containers = self.containers
+
+        while stack:
+            value, parent, key, depth = stack.pop()
+            if parent is None:
+                path.discard(value)
+                continue
+            if remaining is not None and remaining <= 0:
+                parent[key] = self.bytes_marker
+                continue
+
+            if not isinstance(value, containers):
+                value = self._convert(value)
+                if isinstance(value, containers):
+                    stack.append((value, parent, key, depth))
+                    continue
+                if isinstance(value, basestring):
+                    if (self.max_string is not None and
+                        len(value) > self.max_string):
+                        value = value[:self.max_string] + '...'
+                    if remaining is not None:
+                        remaining -= len(value)
+                parent[key] = value
+                continue
+
+            objid = id(value)
+            if objid in path:
+                parent[key] = self.cycle_marker
+                continue
+            if self.max_depth is not None and depth >= self.max_depth:
+                parent[key] = self.depth_marker
+                continue
+            if remaining is not None:
+                remaining -= 2
+            path.add(objid)
+            stack.append((objid, None, None, None))
+
+            if isinstance(value, dict):
+                builder = parent[key] = {}
+                items = value.iteritems()
+                if self.max_keys is not None:
+                    items = islice(items, self.max_keys)
+                children = []
+                for k, v in items:
+                    if not isinstance(k, basestring):
+                        k = repr(k)
+                    children.append((v, builder, k, depth + 1))
+                dropped = len(value) - len(children)
+                if dropped > 0:
+                    builder['...'] = '(%d more items)' % dropped
+            else:
+                items = value
+                if self.max_items is not None:
+                    items = islice(value, self.max_items)
+                builder = list(items)
+                children = [(v, builder, i, depth + 1)
+                            for i, v in enumerate(builder)]
+                dropped = len(value) - len(builder)
+                if dropped > 0:
+                    builder.extend(['...', '(%d more elements)' % dropped])
+                parent[key] = builder
+                if type(value) is not list:
+                    fixups.append((parent, key, builder, value))
+            children.reverse()
+            stack.extend(children)
+
+        # Children were added after their parents, convert them first
+        for parent, key, builder, value in reversed(fixups):
+            try:
+                parent[key] = type(value)(builder)
+            except Exception:
+                parent[key] = repr(value)[:self.max_string or None]
+        return root[0]
+
+    def _convert(self, value):
+        handlers = self.handlers
+        for cls in type(value).__mro__:
+            handler = handlers.get(cls)
+            if handler is not None:
+                break
+        else:
+            handler = to_unicode
+        try:
+            return handler(value)
+        except Exception:
+            return to_unicode(value)
+
+
+_transformer = Sanitizer()
+_shortener = Sanitizer(max_depth=10, max_items=20, max_keys=100,
+                       max_string=255, max_bytes=64 * 1024)
+
+
+def transform(value):
+    """Convert a value into serializable data without truncating it"""
+    return _transformer.sanitize(value)
 
 
 def to_unicode(value):
@@ -148,6 +521,13 @@ def is_protected_type(obj):
     )
 
 
+def log_hash(logger, template):
+    """Return the group hash of log messages from ``logger`` logged with
+    the message ``template``"""
+    key = u'%s\n%s' % (to_unicode(logger), to_unicode(template))
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
 def update_frame_visibility(frames):
     """Attaches data to the frames indicating visibility"""
     frame_hash = {}
@@ -244,15 +624,6 @@ def force_unicode(s, encoding='utf-8', strings_only=False, errors='strict'):
 
 
 def shorten(var):
-    var = transform(var)
-    MAX_LENGTH_LIST = 20
-    MAX_LENGTH_STRING = 255
-    if isinstance(var, basestring) and len(var) > MAX_LENGTH_STRING:
-        var = var[:MAX_LENGTH_STRING] + '...'
-    elif isinstance(var, (list, tuple, set, frozenset)) and len(var) > MAX_LENGTH_LIST:
-        # TODO: we should write a real API for storing some metadata with vars when
-        # we get around to doing ref storage
-        # TODO: when we finish the above, we should also implement this for dicts
-        var = list(var)[:MAX_LENGTH_LIST] + ['...', '(%d more elements)' % (len(var) - MAX_LENGTH_LIST,)]
-    return var
-
+    """Convert a value into serializable data, truncating long strings,
+    containers and deeply nested values"""
+    return _shortener.sanitize(var)
@@ -34,11 +34,15 @@ def home(request):
 
 @view_config(context=DatabaseTable, path_info='/group/', renderer='/group/index.mak')
 def group_index(context, request):
-    groups = list(Group.recently_seen())
+    sort = request.params.get('sort')
+    if sort == 'hot':
+        groups = list(Group.hottest())
+    else:
+        groups = list(Group.recently_seen())
     for group in groups:
         tags = ['%s:%s' % (tag.name, tag.value) for tag in group.all_tags()]
         group.tags = ' '.join(tags)
-    return {'groups': groups}
+    return {'groups': groups, 'sort': sort}
 
 
 @view_config(context=Group, renderer='/group/show.mak')